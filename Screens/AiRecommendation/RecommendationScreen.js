@@ -34,7 +34,7 @@ export default function RecommendationScreen({ navigation, route }) {
       await fetch(`${API_URL}/feedback`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ outfit: outfitData, feedback }),
+        body: JSON.stringify({ outfit: outfitData, feedback, user_id: getAuth().currentUser?.uid }),
       });
     } catch (error) {
       console.error('Failed to send feedback:', error);
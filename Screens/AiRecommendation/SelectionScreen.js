@@ -18,6 +18,7 @@ import {
 import { Ionicons } from '@expo/vector-icons';
 import axios from 'axios';
 import Toast from 'react-native-toast-message';
+import { getAuth } from 'firebase/auth';
 
 if (Platform.OS === 'android' && UIManager.setLayoutAnimationEnabledExperimental) {
   UIManager.setLayoutAnimationEnabledExperimental(true);
@@ -155,6 +156,7 @@ const SelectionScreen = ({ navigation }) => {
         time: timeInput,
         gender: genderInput,
         weather: String(temperature), // Ensure weather is sent as a string
+        user_id: getAuth().currentUser?.uid, // Skips outfits this user rejected before
       };
 
       console.log('Sending payload to API:', JSON.stringify(payload, null, 2));
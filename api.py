@@ -1,175 +1,140 @@
-import pandas as pd
 from flask import Flask, request, jsonify
 import random
 import re
 import traceback
-import json
 import csv
+import math
 import os
-from itertools import product
+import hmac
+import threading
+import time
+import numpy as np
+from capsule_planner import (SLOTS, Inventory, ItemMatcher, combined_feasibility, fitting_items, plan_capsule,
+                             strict_feasibility)
+from color_scoring import SCORED_CANDIDATES, ColorScorer, pool_candidates, select_top_scored
+from dataset_loader import load_dataset, source_stamp
+from shared_dataset import current_generation, load_shared
+from feedback_store import BufferedWriter, CsvSink, RejectionIndex, SqliteRejectionIndex, SqliteSink, table_for
+from image_index import UploadsIndex
+from instrumentation import REGISTRY, LapTimer, configure_logging, instrument_app, request_logger
+from ttl_cache import TTLCache
+from user_rejections import UserRejectionStore
+from uploads_server import ORIGINAL_SIZE, THUMBNAIL_SIZES, send_upload, upload_url
+from rule_engine import DIVERSITY_CANDIDATES, OUTFIT_COLUMNS, intersect_rows, select_diverse
 
 # --- Flask App Initialization ---
 app = Flask(__name__)
-
-# --- Data Loading and Column Standardization ---
-def load_data(file_path='dataset.xlsx'):
-    """Load and standardize the dataset."""
-    if not os.path.exists(file_path):
-        print(f"Error: The file '{file_path}' was not found.")
-        return pd.DataFrame()
-        
-    try:
-        # Load Excel file
-        excel_data = pd.ExcelFile(file_path)
-        
-        # Parse first sheet
-        df = excel_data.parse(excel_data.sheet_names[0])
-        
-        if df.empty:
-            print("Warning: Dataset is empty")
-            return pd.DataFrame()
-            
-        # Standardize column names
-        original_columns = df.columns.tolist()
-        df.columns = [re.sub(r'[^a-zA-Z0-9]+', '_', str(col)).lower().strip('_') for col in original_columns]
-        
-        # Fill NaN values with empty string for string operations
-        string_columns = df.select_dtypes(include=['object']).columns
-        df[string_columns] = df[string_columns].fillna('')
-        
-        print(f"Dataset loaded successfully with {len(df)} rows.")
-        return df
-        
-    except Exception as e:
-        print(f"Error loading dataset: {str(e)}")
-        return pd.DataFrame()
-
-# Load dataset
-rule_data = load_data()
+# Request timings and /metrics; per-request log lines are sampled (LOG_SAMPLE_RATE)
+configure_logging()
+instrument_app(app)
+request_log = request_logger('groomify.recommend')
+
+# --- Data Loading ---
+# With DATASET_SHARED_DIR set, workers map one published copy of the indexes read-only
+# (see shared_dataset.py) instead of each loading its own; rule_data is then None.
+DATASET_SHARED_DIR = os.environ.get('DATASET_SHARED_DIR')
+
+DATASET_FILE = os.environ.get('DATASET_FILE', 'dataset.xlsx')
+
+def load_data(file_path=DATASET_FILE, force=False):
+    """Load the standardized dataset and its indexes (from the binary snapshot when fresh)."""
+    if DATASET_SHARED_DIR:
+        return load_shared(file_path, DATASET_SHARED_DIR, force=force)
+    return load_dataset(file_path)
+
+# The dataset and its indexes are only ever replaced as a whole (see reload_dataset), so
+# a request reads this reference once and uses that snapshot throughout
+dataset = load_data()
+
+# Item images are looked up in an in-memory listing of uploads/ rather than the disk
+UPLOADS_DIR = os.path.join(os.getcwd(), 'uploads')
+uploads_index = UploadsIndex(UPLOADS_DIR)
+# Optional background rescan (seconds); otherwise each request does one stat of uploads/
+UPLOADS_RESCAN_INTERVAL = float(os.environ.get('UPLOADS_RESCAN_INTERVAL', '0'))
+if UPLOADS_RESCAN_INTERVAL > 0:
+    uploads_index.start_watcher(UPLOADS_RESCAN_INTERVAL)
+# Image size linked from recommendations unless the client asks for another: a
+# thumbnail name from THUMBNAIL_SIZES or 'original'
+RECOMMENDATION_IMAGE_SIZE = os.environ.get('RECOMMENDATION_IMAGE_SIZE', 'md')
+IMAGE_SIZES = (ORIGINAL_SIZE, *THUMBNAIL_SIZES)
+
+# --- Metrics ---
+STAGE_SECONDS = REGISTRY.histogram('recommend_stage_seconds', 'Seconds spent in each stage of get_recommendations',
+                                   ('stage',))
+REQUESTS_BY_TIER = REGISTRY.counter('recommend_requests_total',
+                                    'get_recommendations calls by the last tier they needed (none: invalid or no data)',
+                                    ('tier',))
+OUTFITS_BY_TIER = REGISTRY.counter('recommend_outfits_total', 'Outfits returned, by the tier that produced them',
+                                   ('tier',))
+TIER2_CANDIDATES = REGISTRY.counter('recommend_tier2_candidates_total', 'Candidate outfits drawn by Tier 2',
+                                    ('ranking',))
+
+# Figures owned by other objects, read when /metrics is scraped
+REGISTRY.gauge('dataset_rows', 'Rows in the loaded rule dataset', callback=lambda: dataset.num_rows)
+REGISTRY.gauge('rejected_outfits', 'Distinct outfits rejected through feedback', callback=lambda: len(rejection_index))
+REGISTRY.gauge('uploads_indexed', 'Files in the uploads image index', callback=lambda: len(uploads_index))
+REGISTRY.counter('cache_lookups_total', 'Context and pool cache lookups by result', ('cache', 'result'),
+                 callback=lambda: {(name, result): cache.stats()[result] for name, cache in
+                                   (('context', recommendation_cache), ('pool', pool_cache), ('scorer', scorer_cache))
+                                   for result in ('hits', 'misses')})
+REGISTRY.gauge('feedback_writer_queued', 'Feedback rows waiting to be written',
+               callback=lambda: feedback_writer.stats()["queued"])
+REGISTRY.gauge('user_rejections_hot_users', 'Users whose rejections are cached in this worker',
+               callback=lambda: len(user_rejections.cache))
+REGISTRY.counter('user_rejections_lookups_total', 'Per-user rejection cache lookups by result', ('result',),
+                 callback=lambda: {(result,): user_rejections.cache.stats()[result] for result in ('hits', 'misses')})
 
 # --- Helper Functions ---
-def split_and_strip(s):
-    if not isinstance(s, str) or not s.strip(): return []
-    return [x.strip() for x in s.split(',') if x.strip()]
-
-def find_diverse_outfits(pools, existing_outfits, num_needed, rejection_set):
-    """Intelligently finds diverse outfits by gradually relaxing criteria."""
+def find_diverse_outfits(pools, existing_outfits, num_needed, rejection_set, rng=random, exclude=()):
+    """Adds up to ``num_needed`` outfits that differ as much as possible from each other and the existing ones."""
+    # select_diverse draws every combination of small pools, else DIVERSITY_CANDIDATES samples
+    TIER2_CANDIDATES.inc(min(math.prod(len(pool) for pool in pools.values()), DIVERSITY_CANDIDATES), ranking='random')
     recommendations = list(existing_outfits)
-    seen_outfits = {tuple(rec) for rec in recommendations}
-
-    # Try to find outfits with decreasing levels of required difference
-    for required_diff_count in [4, 3, 2, 1]:
-        if len(recommendations) >= 3: break
-        print(f"Seeking outfits with at least {required_diff_count} different attributes...")
-        
-        for _ in range(50):
-            if len(recommendations) >= 3: break
-            new_outfit = tuple(random.choice(pool) for pool in pools.values())
-            
-            if new_outfit in seen_outfits or new_outfit in rejection_set: continue
-
-            is_diverse_enough = True
-            if recommendations:
-                for existing_outfit in recommendations:
-                    diff_count = sum(1 for a, b in zip(new_outfit, existing_outfit) if a != b)
-                    if diff_count < required_diff_count:
-                        is_diverse_enough = False
-                        break
-            
-            if is_diverse_enough:
-                recommendations.append(new_outfit)
-                seen_outfits.add(new_outfit)
-
-    # Final fallback: if still not enough, just add any unique outfits
-    if len(recommendations) < 3:
-        print("Diversity criteria not met, filling with any unique outfits...")
-        for _ in range(100): # More attempts for the final fill
-            if len(recommendations) >= 3: break
-            new_outfit = tuple(random.choice(pool) for pool in pools.values())
-            if new_outfit not in seen_outfits:
-                recommendations.append(new_outfit)
-                seen_outfits.add(new_outfit)
-
-    return recommendations
-
-def max_distinct_outfits(all_outfits, max_outfits=3, existing_outfits=None):
-    """Robustly finds distinct outfits, perfect for fallback tiers."""
-    recommendations = list(existing_outfits) if existing_outfits is not None else []
-    # Correctly handle that items in recommendations can be lists or tuples
-    seen_outfits = {tuple(item) for item in recommendations}
-
-    random.shuffle(all_outfits)
-
-    for outfit in all_outfits:
-        if len(recommendations) >= max_outfits:
-            break
-        # Ensure the outfit to be checked is a tuple
-        outfit_tuple = tuple(outfit)
-        if outfit_tuple not in seen_outfits:
-            recommendations.append(outfit) # Append original format
-            seen_outfits.add(outfit_tuple)
-
+    recommendations.extend(select_diverse(list(pools.values()), num_needed, recommendations, rejection_set, rng,
+                                          exclude=exclude))
     return recommendations
 
 # --- Core Recommendation Logic (Creative & Guaranteed) ---
 FEEDBACK_FILE = 'user_feedback.csv'
 OUTFIT_FIELDS = ["Dress Type", "Dress Color", "Dress Fabric/Texture", "Shoes Type", "Shoes Color", "Upper Layer", "Upper Layer Color", "image_url"]
-
-def get_recommendations(current_temp: str, gender: str, event: str, outfit: str, time_of_day: str) -> list[dict]:
-    # Validate gender input strictly
-    valid_genders = {'male', 'female'}
-    gender = gender.lower() if gender else ''
-    if gender not in valid_genders:
-        print(f"Error: Invalid gender '{gender}'. Must be 'male' or 'female'.")
-        return []
-    # --- Reinforcement Learning: Load rejected outfits --- #
-    rejection_set = set()
-    if os.path.exists(FEEDBACK_FILE):
-        try:
-            feedback_df = pd.read_csv(FEEDBACK_FILE)
-            if not feedback_df.empty and 'feedback_type' in feedback_df.columns:
-                rejected_df = feedback_df[feedback_df['feedback_type'] == 'rejected']
-                # Create a tuple of all fields except the last one (feedback_type)
-                for _, row in rejected_df.iterrows():
-                    outfit_tuple = tuple(row[field] for field in OUTFIT_FIELDS)
-                    rejection_set.add(outfit_tuple)
-                print(f"Loaded {len(rejection_set)} rejected outfits for filtering.")
-        except Exception as e:
-            print(f"[WARNING] Could not load feedback file: {e}")
-    if rule_data.empty or gender is None:
-        return []
-
-    # --- CRITICAL: The Gender Wall ---
-    # Strict gender validation and filtering
-    if rule_data.empty:
-        print("Error: Empty dataset")
-        return []
-
-    # Convert gender to lowercase for case-insensitive comparison
-    gender = gender.lower()
-    
-    # Filter dataset strictly by gender
-    gender_specific_data = rule_data[
-        rule_data['gender'].str.lower().str.strip().str.contains(gender, na=False)
-    ].copy()
-    
-    # Strict validation of gender-specific data
-    if gender_specific_data.empty:
-        print(f"CRITICAL: No data found for gender '{gender}'. Cannot proceed.")
-        return []
-
-    # Double-check for any cross-gender contamination
-    invalid_gender_data = gender_specific_data[
-        gender_specific_data['gender'].str.lower().str.strip() != gender
-    ]
-    if not invalid_gender_data.empty:
-        print(f"WARNING: Found {len(invalid_gender_data)} rows with incorrect gender data")
-        gender_specific_data = gender_specific_data.drop(invalid_gender_data.index)
-        if gender_specific_data.empty:
-            print("CRITICAL: All data removed due to gender validation")
-            return []
-
-    # Parse temperature
+# user_id is empty for anonymous feedback; feedback_type stays the last column
+FEEDBACK_FIELDS = OUTFIT_FIELDS + ['user_id', 'feedback_type']
+
+SAVED_RECOMMENDATIONS_FILE = 'saved_recommendations.csv'
+
+# Feedback and saved recommendations are appended by a background writer, either to the
+# CSV files (default) or to tables in a SQLite database in WAL mode
+FEEDBACK_BACKEND = os.environ.get('FEEDBACK_BACKEND', 'csv')
+FEEDBACK_DB = os.environ.get('FEEDBACK_DB', 'feedback.sqlite3')
+
+# Rejections are keyed on the seven outfit attributes so they line up with candidate tuples
+if FEEDBACK_BACKEND == 'sqlite':
+    rejection_index = SqliteRejectionIndex(FEEDBACK_DB, table_for(FEEDBACK_FILE), OUTFIT_FIELDS[:7])
+    feedback_sink = SqliteSink(FEEDBACK_DB)
+else:
+    feedback_sink = CsvSink(verdict_last={FEEDBACK_FILE})
+    # Logs written before a column was added get the current header before they are read
+    feedback_sink.migrate(FEEDBACK_FILE, FEEDBACK_FIELDS)
+    rejection_index = RejectionIndex(FEEDBACK_FILE, OUTFIT_FIELDS[:7])
+
+def on_feedback_flush(targets):
+    if FEEDBACK_FILE in targets:
+        refresh_rejections()
+
+feedback_writer = BufferedWriter(feedback_sink, on_flush=on_feedback_flush)
+
+# Rejections sent with a user_id only filter that user's recommendations. They are kept
+# per user in a SQLite store; each worker caches the ids of its most recent users and
+# re-reads a cached user after USER_REJECTIONS_TTL seconds to see other workers' writes.
+USER_REJECTIONS_DB = os.environ.get('USER_REJECTIONS_DB', 'user_rejections.sqlite3')
+user_rejections = UserRejectionStore(USER_REJECTIONS_DB,
+                                     max_users=int(os.environ.get('USER_REJECTIONS_HOT_USERS', '10000')),
+                                     ttl=float(os.environ.get('USER_REJECTIONS_TTL', '5')))
+user_rejection_writer = BufferedWriter(user_rejections)
+MAX_USER_ID_LENGTH = 128
+
+def parse_weather_range(current_temp):
+    """Collapse a temperature (number or free text) into one of the dataset's weather buckets."""
     try:
         # Handle numeric input
         if isinstance(current_temp, (int, float)):
@@ -178,7 +143,7 @@ def get_recommendations(current_temp: str, gender: str, event: str, outfit: str,
         else:
             match = re.search(r'(-?\d+(\.\d+)?)', str(current_temp))
             if not match:
-                print(f"Warning: Could not parse temperature '{current_temp}', defaulting to 25")
+                request_log.warning("Could not parse temperature '%s', defaulting to 25", current_temp)
                 temp = 25
             else:
                 temp = float(match.group(0))
@@ -187,121 +152,369 @@ def get_recommendations(current_temp: str, gender: str, event: str, outfit: str,
         temp = max(0, min(45, temp))
         
         # Determine weather range
-        if 0 <= temp <= 10: weather_range = "0-10"
-        elif 11 <= temp <= 20: weather_range = "10-20"
-        elif 21 <= temp <= 30: weather_range = "20-30"
-        elif 31 <= temp <= 40: weather_range = "30-40"
-        else: weather_range = "41+"
+        if 0 <= temp <= 10: return "0-10"
+        elif 11 <= temp <= 20: return "10-20"
+        elif 21 <= temp <= 30: return "20-30"
+        elif 31 <= temp <= 40: return "30-40"
+        else: return "41+"
             
     except Exception as e:
-        print(f"Warning: Temperature parsing failed: {str(e)}, defaulting to 20-30 range")
-        weather_range = "20-30"
-
-    print(f"\n--- Starting Recommendation Generation for: Gender='{gender}', Event='{event}', Outfit='{outfit}', Time='{time_of_day}', Weather='{weather_range}' ---")
-
-    def generate_outfits_from_rows(df):
-        all_outfits = []
-        for _, row in df.iterrows():
-            # Ensure all required fields are present, defaulting to 'N/A'
-            items = [
-                split_and_strip(row.get('dress_type')) or ['N/A'],
-                split_and_strip(row.get('dress_color')) or ['N/A'],
-                split_and_strip(row.get('dress_fabric_texture')) or ['N/A'],
-                split_and_strip(row.get('shoes_type')) or ['N/A'],
-                split_and_strip(row.get('shoes_color')) or ['N/A'],
-                split_and_strip(row.get('upper_layer')) or ['N/A'],
-                split_and_strip(row.get('upper_layer_color')) or ['N/A']
-            ]
-            all_outfits.extend(list(product(*items)))
-        # Return a list of unique tuples
-        return list(set(all_outfits))
-                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                        
+        request_log.warning("Temperature parsing failed: %s, defaulting to 20-30 range", e)
+        return "20-30"
+
+# --- Recommendation Context Cache ---
+# Filtering results depend only on (gender, weather bucket, event, outfit, time), so they
+# are computed once per context and reused; outfits are still drawn at random per call.
+recommendation_cache = TTLCache(maxsize=int(os.environ.get('RECOMMENDATION_CACHE_SIZE', '512')),
+                                ttl=float(os.environ.get('RECOMMENDATION_CACHE_TTL', '600')))
+
+def context_key(ds, gender, weather_range, event, outfit, time_of_day):
+    # Event, outfit and time are matched case-insensitively, so case is normalized away
+    lower = lambda value: value.lower() if isinstance(value, str) else value
+    return (ds.rule_index.version, gender, weather_range, lower(event), lower(outfit), lower(time_of_day))
+
+def build_context(ds, gender, weather_range, event, outfit, time_of_day):
+    """Row sets and Tier 1 candidates for one normalized request context."""
+    rule_index = ds.rule_index
+    gender_rows = rule_index.exact('gender', gender)
+    weather_rows = rule_index.contains('weather_range', weather_range)
+    event_rows = rule_index.contains('event_name', event, case=False)
+    strict_rows = intersect_rows(
+        gender_rows,
+        weather_rows,
+        event_rows,
+        rule_index.contains('outfittype', outfit, case=False),
+        rule_index.contains('time', time_of_day, case=False),
+    )
+    return {
+        "gender": gender,
+        "gender_rows": gender_rows,
+        "weather_rows": weather_rows,
+        "event_rows": event_rows,
+        "strict_rows": strict_rows,
+        "strict_candidates": ds.candidate_store.enumerate_distinct(strict_rows),
+        "strict_scores": None,  # (codes, colour scores) of strict_candidates, filled in on first use
+        "item_pools": None,  # Tier 2 pools, filled in on first use
+        "pool_codes": None,  # item_pools as vocabulary codes for scoring
+    }
+
+def get_context(ds, gender, weather_range, event, outfit, time_of_day):
+    key = context_key(ds, gender, weather_range, event, outfit, time_of_day)
+    return recommendation_cache.get_or_create(key, lambda: build_context(ds, gender, weather_range, event, outfit, time_of_day))
+
+def refresh_rejections():
+    """Pick up new feedback; cached contexts are dropped whenever the rejection set changes."""
+    try:
+        if rejection_index.refresh():
+            recommendation_cache.clear()
+    except Exception as e:
+        request_log.warning("Could not load feedback file: %s", e)
+    return rejection_index.rejected
+
+# Tier 2 pools only depend on (gender, event) for the dress half and (gender, weather)
+# for the shoes/upper-layer half, so each half is shared across outfit types and times
+pool_cache = TTLCache(maxsize=1024, ttl=recommendation_cache.ttl)
+
+def attribute_pools(candidate_store, rows, columns):
+    return [candidate_store.attribute_pool(rows, OUTFIT_COLUMNS.index(column)) for column in columns]
+
+def build_item_pools(ds, context, event, weather_range):
+    """Tier 2 per-attribute item pools for a context."""
+    # Create pools of clothing items ONLY from gender-specific data
+    gender = context["gender"]
+    gender_rows = context["gender_rows"]
+
+    def dress_pools():
+        rows = intersect_rows(gender_rows, context["event_rows"])
+        if not len(rows):
+            request_log.info("No matching dress pool found, using all gender-specific data")
+            rows = gender_rows
+        return attribute_pools(ds.candidate_store, rows, ('dress_type', 'dress_color', 'dress_fabric_texture'))
+
+    def weather_pools():
+        rows = intersect_rows(gender_rows, context["weather_rows"])
+        if not len(rows):
+            request_log.info("No matching weather pool found, using all gender-specific data")
+            rows = gender_rows
+        return attribute_pools(ds.candidate_store, rows, ('shoes_type', 'shoes_color', 'upper_layer', 'upper_layer_color'))
+
+    lower_event = event.lower() if isinstance(event, str) else event
+    dress_type, dress_color, fabric = pool_cache.get_or_create(
+        (ds.rule_index.version, 'dress', gender, lower_event), dress_pools)
+    shoes_type, shoes_color, upper_layer, upper_color = pool_cache.get_or_create(
+        (ds.rule_index.version, 'weather', gender, weather_range), weather_pools)
+    return {
+        'dress_type': dress_type,
+        'dress_color': dress_color,
+        'fabric': fabric,
+        'shoes_type': shoes_type,
+        'shoes_color': shoes_color,
+        'upper_layer': upper_layer,
+        'upper_color': upper_color,
+    }
+
+# --- Colour Scoring ---
+# 'score' ranks candidates by colour harmony and psychology (see color_scoring.py);
+# 'random' keeps the old uniformly random picks
+RECOMMENDATION_RANKING = os.environ.get('RECOMMENDATION_RANKING', 'score')
+RANKINGS = ('score', 'random')
+
+# Scoring tables depend only on the dataset's colour vocabulary
+scorer_cache = TTLCache(maxsize=4, ttl=recommendation_cache.ttl)
+
+def get_scorer(ds):
+    return scorer_cache.get_or_create(ds.rule_index.version, lambda: ColorScorer(ds.candidate_store.vocab))
+
+def ranked_strict_outfits(ds, context, num_outfits, rejection_set=frozenset(), rng=random, exclude=()):
+    """Tier 1 by score: the context's enumerated candidates (scored once), or a fresh sample of its rows.
+
+    Rejected outfits are skipped while walking the ranking, so they never take one of the top slots.
+    """
+    candidate_store = ds.candidate_store
+    if not len(context["strict_rows"]):
+        return []
+    if context["strict_candidates"] is not None:
+        if context["strict_scores"] is None:
+            codes = np.array(context["strict_candidates"], dtype=np.int64).reshape(-1, len(OUTFIT_COLUMNS))
+            context["strict_scores"] = (codes, get_scorer(ds).score(codes))
+        codes, scores = context["strict_scores"]
+    else:
+        codes = candidate_store.sample_codes(context["strict_rows"], SCORED_CANDIDATES, rng)
+        scores = get_scorer(ds).score(codes)
+    return select_top_scored(scores, num_outfits, lambda i: candidate_store.decode(codes[i]),
+                             rejection_set=rejection_set, rng=rng, exclude=exclude)
+
+def ranked_pool_outfits(ds, context, existing_outfits, num_needed, rejection_set, rng=random, exclude=()):
+    """Tier 2 by score: adds up to ``num_needed`` well-scored, distinct outfits drawn from the item pools."""
+    pools = list(context["item_pools"].values())
+    if context["pool_codes"] is None:
+        context["pool_codes"] = get_scorer(ds).encode_pools(pools)
+    pool_codes = context["pool_codes"]
+    candidates = pool_candidates(pools, rng)
+    TIER2_CANDIDATES.inc(len(candidates), ranking='score')
+    scores = get_scorer(ds).score(np.column_stack([pool_codes[a][candidates[:, a]] for a in range(len(pools))]))
+    decode = lambda i: tuple(pools[a][j] for a, j in enumerate(candidates[i].tolist()))
+    return list(existing_outfits) + select_top_scored(scores, num_needed, decode, existing_outfits, rejection_set, rng,
+                                                      exclude=exclude)
+
+# --- Capsule Planner ---
+# Item postings depend only on the dataset and row masks on the inventory. Feasibility
+# is cached per day context and, for Tiers 2 and 3, per context half as pool_cache does,
+# so re-planning after one day changes builds at most that day's tensor
+matcher_cache = TTLCache(maxsize=4, ttl=recommendation_cache.ttl)
+inventory_cache = TTLCache(maxsize=64, ttl=recommendation_cache.ttl)
+feasibility_cache = TTLCache(maxsize=4096, ttl=recommendation_cache.ttl)
+
+def get_matcher(ds):
+    return matcher_cache.get_or_create(ds.rule_index.version, lambda: ItemMatcher(ds.candidate_store))
+
+def get_inventory_rows(ds, inventory):
+    return inventory_cache.get_or_create((ds.rule_index.version, inventory.key),
+                                         lambda: get_matcher(ds).inventory_rows(inventory))
+
+def build_day_feasibility(ds, inventory, inventory_rows, gender, weather_range, event, outfit, time_of_day):
+    """(feasibility tensor, tier) for one day context, through the recommender's tiers; (None, None) if nothing fits."""
+    context = get_context(ds, gender, weather_range, event, outfit, time_of_day)
+    feasible = strict_feasibility(inventory_rows, context["strict_rows"])
+    if feasible is not None:
+        return feasible, '1'
+
+    gender_rows = context["gender_rows"]
+
+    def fitting(half, key, find_rows):
+        def build():
+            # The Tier 2 halves are widened to the gender slice when empty, as in build_item_pools
+            rows = find_rows()
+            return fitting_items(inventory_rows, rows if len(rows) else gender_rows)
+        return feasibility_cache.get_or_create((ds.rule_index.version, inventory.key, half, gender, key), build)
+
+    lower_event = event.lower() if isinstance(event, str) else event
+    dress_fit = fitting('dress', lower_event, lambda: intersect_rows(gender_rows, context["event_rows"]))
+    weather_fit = fitting('weather', weather_range, lambda: intersect_rows(gender_rows, context["weather_rows"]))
+    feasible = combined_feasibility(dress_fit, weather_fit)
+    if feasible is not None:
+        return feasible, '2'
+    gender_fit = fitting('gender', None, lambda: gender_rows)
+    feasible = combined_feasibility(gender_fit, gender_fit)
+    return (feasible, '3') if feasible is not None else (None, None)
+
+# --- Dataset Hot Reload ---
+# Seconds between checks of the sheet (and in shared mode the published generation); 0 disables
+DATASET_RELOAD_INTERVAL = float(os.environ.get('DATASET_RELOAD_INTERVAL', '10'))
+# Required as X-Admin-Token by admin endpoints; without it they are disabled
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+# Seconds between forced reloads; each one reparses the sheet (and publishes a new shared generation)
+ADMIN_RELOAD_MIN_INTERVAL = float(os.environ.get('ADMIN_RELOAD_MIN_INTERVAL', '30'))
+reload_lock = threading.Lock()
+forced_reload_lock = threading.Lock()
+last_forced_reload = None
+
+def dataset_is_stale(ds):
+    try:
+        source = source_stamp(DATASET_FILE)
+    except FileNotFoundError:
+        # A missing sheet never replaces a loaded dataset
+        return False
+    if source != ds.source:
+        return True
+    return bool(DATASET_SHARED_DIR) and current_generation(DATASET_SHARED_DIR) != getattr(ds, 'generation', None)
+
+def reload_dataset(force=False):
+    """Parse and index the sheet again if it changed (or ``force``), then swap it in.
+
+    The new dataset is fully built before the one assignment that publishes it, and
+    requests already running keep the snapshot they started with. A sheet that fails
+    to parse (e.g. still being written) leaves the current dataset in place and is
+    retried on the next check. Returns True if a new dataset was swapped in.
+    """
+    global dataset
+    with reload_lock:
+        if not force and not dataset_is_stale(dataset):
+            return False
+        started = time.perf_counter()
+        try:
+            fresh = load_data(DATASET_FILE, force=force)
+        except Exception as e:
+            print(f"[WARNING] Dataset reload failed, keeping the current one: {e}")
+            return False
+        if fresh.empty:
+            print("[WARNING] Reloaded dataset is empty, keeping the current one")
+            return False
+        previous, dataset = dataset, fresh
+        # Cache keys carry the index version, so old entries can't be hit again; free them now
+        recommendation_cache.clear()
+        pool_cache.clear()
+        scorer_cache.clear()
+        matcher_cache.clear()
+        inventory_cache.clear()
+        feasibility_cache.clear()
+        print(f"Dataset reloaded with {fresh.num_rows} rows (index version {previous.rule_index.version} -> "
+              f"{fresh.rule_index.version}) in {time.perf_counter() - started:.2f}s")
+        return True
+
+def watch_dataset(interval):
+    def watch():
+        while True:
+            time.sleep(interval)
+            try:
+                reload_dataset()
+            except Exception as e:
+                print(f"[WARNING] Dataset check failed: {e}")
+    threading.Thread(target=watch, name='dataset-watcher', daemon=True).start()
+
+if DATASET_RELOAD_INTERVAL > 0:
+    watch_dataset(DATASET_RELOAD_INTERVAL)
+
+# Outfits returned per request unless the client asks for another count (capped).
+DEFAULT_NUM_OUTFITS = 3
+MAX_NUM_OUTFITS = 20
+
+def get_recommendations(current_temp: str, gender: str, event: str, outfit: str, time_of_day: str,
+                        num_outfits: int = DEFAULT_NUM_OUTFITS, seed=None, exclude=(),
+                        image_size: str = RECOMMENDATION_IMAGE_SIZE, ranking: str = RECOMMENDATION_RANKING,
+                        user_id: str = None) -> list[dict]:
+    # A seed makes the random choices below reproducible; outfits in exclude are never returned
+    rng = random.Random(seed) if seed is not None else random
+    # Each lap() records the time since the previous one under that stage's name
+    timer = LapTimer(STAGE_SECONDS)
+    # Validate gender input strictly
+    valid_genders = {'male', 'female'}
+    gender = gender.lower() if gender else ''
+    if gender not in valid_genders:
+        request_log.warning("Invalid gender '%s'. Must be 'male' or 'female'.", gender)
+        REQUESTS_BY_TIER.inc(tier='none')
+        return []
+    # --- Reinforcement Learning: Load rejected outfits --- #
+    # Only rows appended since the last request are parsed; a user also skips their own rejections
+    rejection_set = refresh_rejections()
+    if user_id:
+        rejection_set = user_rejections.for_user(user_id, rejection_set)
+    timer.lap('feedback')
+    # One read of the global: a reload swapping in a new dataset mid-request can't mix versions
+    ds = dataset
+    candidate_store = ds.candidate_store
+    if ds.empty or gender is None:
+        REQUESTS_BY_TIER.inc(tier='none')
+        return []
+
+    # --- CRITICAL: The Gender Wall ---
+    # Strict gender validation and filtering
+    if ds.empty:
+        request_log.warning("Empty dataset")
+        return []
+
+    weather_range = parse_weather_range(current_temp)
+
+    request_log.info("Starting recommendation generation for: gender='%s', event='%s', outfit='%s', time='%s', weather='%s'",
+                     gender, event, outfit, time_of_day, weather_range)
+
+    context = get_context(ds, gender, weather_range, event, outfit, time_of_day)
+
+    # Filter dataset strictly by gender (exact match on the normalized value, so
+    # 'male' can never pick up 'female' rows)
+    gender_rows = context["gender_rows"]
+    timer.lap('filtering')
+    if not len(gender_rows):
+        request_log.warning("No data found for gender '%s'. Cannot proceed.", gender)
+        REQUESTS_BY_TIER.inc(tier='none')
+        return []
+
     # Tier 1: Perfect Match (within gender-specific data)
-    print("--- Tier 1: Attempting Perfect Match ---")
-    strict_rules = gender_specific_data[
-        (gender_specific_data['weather_range'].astype(str).str.contains(weather_range, na=False)) &
-        (gender_specific_data['event_name'].str.contains(event, na=False, case=False)) &
-        (gender_specific_data['outfittype'].str.contains(outfit, na=False, case=False)) &
-        (gender_specific_data['time'].str.contains(time_of_day, na=False, case=False))
-    ].copy()
-    recommendations = max_distinct_outfits(generate_outfits_from_rows(strict_rules))
-    print(f"Found {len(recommendations)} distinct outfits in Tier 1.")
+    request_log.debug("Tier 1: attempting perfect match")
+    tier = '1'
+    if ranking == 'score':
+        recommendations = ranked_strict_outfits(ds, context, num_outfits, rejection_set, rng, exclude)
+    else:
+        recommendations = candidate_store.sample_distinct(context["strict_rows"], max_outfits=num_outfits,
+                                                          rng=rng, candidates=context["strict_candidates"], exclude=exclude)
+    request_log.debug("Found %d distinct outfits in Tier 1.", len(recommendations))
+    OUTFITS_BY_TIER.inc(len(recommendations), tier='1')
+    timer.lap('tier1')
 
     # Tier 2: The Creative Stylist (Lightweight & Iterative)
-    if len(recommendations) < 3:
-        print(f"--- Tier 2: Activating Creative Stylist (Need {3 - len(recommendations)} more) ---")
-        # Create pools of clothing items ONLY from gender-specific data
-        # Extra validation to ensure we never mix genders
-        dress_pool_df = gender_specific_data[
-            (gender_specific_data['event_name'].str.contains(event, na=False, case=False)) &
-            (gender_specific_data['gender'].str.lower().str.strip() == gender)
-        ]
-        weather_pool_df = gender_specific_data[
-            (gender_specific_data['weather_range'].astype(str).str.contains(weather_range, na=False)) &
-            (gender_specific_data['gender'].str.lower().str.strip() == gender)
-        ]
-        
-        # Validate pools
-        if dress_pool_df.empty: 
-            print("WARNING: No matching dress pool found, using all gender-specific data")
-            dress_pool_df = gender_specific_data
-        if weather_pool_df.empty: 
-            print("WARNING: No matching weather pool found, using all gender-specific data")
-            weather_pool_df = gender_specific_data
-
-        # Create lists of items to pick from with strict gender validation
-        item_pools = {
-            'dress_type': list(set(item for _, row in dress_pool_df.iterrows() 
-                                if row['gender'].lower().strip() == gender 
-                                for item in split_and_strip(row.get('dress_type')))) or ['N/A'],
-            'dress_color': list(set(item for _, row in dress_pool_df.iterrows() 
-                                  if row['gender'].lower().strip() == gender 
-                                  for item in split_and_strip(row.get('dress_color')))) or ['N/A'],
-            'fabric': list(set(item for _, row in dress_pool_df.iterrows() 
-                             if row['gender'].lower().strip() == gender 
-                             for item in split_and_strip(row.get('dress_fabric_texture')))) or ['N/A'],
-            'shoes_type': list(set(item for _, row in weather_pool_df.iterrows() 
-                                 if row['gender'].lower().strip() == gender 
-                                 for item in split_and_strip(row.get('shoes_type')))) or ['N/A'],
-            'shoes_color': list(set(item for _, row in weather_pool_df.iterrows() 
-                                 if row['gender'].lower().strip() == gender 
-                                 for item in split_and_strip(row.get('shoes_color')))) or ['N/A'],
-            'upper_layer': list(set(item for _, row in weather_pool_df.iterrows() 
-                                 if row['gender'].lower().strip() == gender 
-                                 for item in split_and_strip(row.get('upper_layer')))) or ['N/A'],
-            'upper_color': list(set(item for _, row in weather_pool_df.iterrows() 
-                                 if row['gender'].lower().strip() == gender 
-                                 for item in split_and_strip(row.get('upper_layer_color')))) or ['N/A']
-        }
+    if len(recommendations) < num_outfits:
+        request_log.debug("Tier 2: activating creative stylist (need %d more)", num_outfits - len(recommendations))
+        tier, found = '2', len(recommendations)
+        if context["item_pools"] is None:
+            context["item_pools"] = build_item_pools(ds, context, event, weather_range)
+        item_pools = context["item_pools"]
 
         # Use the new intelligent function to find diverse outfits
-        recommendations = find_diverse_outfits(item_pools, recommendations, 3 - len(recommendations), rejection_set)
-        print(f"Total recommendations after Tier 2: {len(recommendations)}")
+        if ranking == 'score':
+            recommendations = ranked_pool_outfits(ds, context, recommendations, num_outfits - len(recommendations),
+                                                  rejection_set, rng, exclude)
+        else:
+            recommendations = find_diverse_outfits(item_pools, recommendations, num_outfits - len(recommendations), rejection_set, rng,
+                                                   exclude=exclude)
+        request_log.debug("Total recommendations after Tier 2: %d", len(recommendations))
+        OUTFITS_BY_TIER.inc(len(recommendations) - found, tier='2')
+        timer.lap('tier2')
 
     # Tier 3: Ultimate Fallback (if still needed)
-    if len(recommendations) < 3:
-        print(f"--- Tier 3: Activating Ultimate Fallback (Need {3 - len(recommendations)} more) ---")
-        # Extra validation in fallback
-        fallback_data = gender_specific_data[gender_specific_data['gender'].str.lower().str.strip() == gender]
-        if fallback_data.empty:
-            print("CRITICAL: No valid gender-specific data for fallback")
-            return []
-            
-        fallback_outfits = generate_outfits_from_rows(fallback_data)
-        # Use the robust max_distinct_outfits to fill up the list
-        recommendations = max_distinct_outfits(fallback_outfits, max_outfits=3, existing_outfits=recommendations)
-        print(f"Total recommendations after Fallback: {len(recommendations)}")
+    if len(recommendations) < num_outfits:
+        request_log.debug("Tier 3: activating ultimate fallback (need %d more)", num_outfits - len(recommendations))
+        tier, found = '3', len(recommendations)
+        # Sample straight from the whole gender slice without expanding it
+        recommendations = candidate_store.sample_distinct(gender_rows, max_outfits=num_outfits,
+                                                          existing_outfits=recommendations, rng=rng, exclude=exclude)
+        request_log.debug("Total recommendations after fallback: %d", len(recommendations))
+        OUTFITS_BY_TIER.inc(len(recommendations) - found, tier='3')
+        timer.lap('tier3')
+    REQUESTS_BY_TIER.inc(tier=tier)
 
     # --- Image Fetching Helper ---
+    if UPLOADS_RESCAN_INTERVAL <= 0:
+        uploads_index.refresh()
+
+    image_urls = {}
+
     def find_image_for_item(item_type, item_value):
-        uploads_dir = os.path.join(os.getcwd(), 'uploads')
-        if not os.path.exists(uploads_dir):
+        fname = uploads_index.find(item_value)
+        if not fname:
             return None
-        # Search for image files that match item_value (case-insensitive, partial match)
-        for fname in os.listdir(uploads_dir):
-            if fname.lower().endswith(('.jpg', '.jpeg', '.png')) and item_value and item_value.lower() in fname.lower():
-                return f'/uploads/{fname}'
-        return None
+        if fname not in image_urls:
+            image_urls[fname] = upload_url(UPLOADS_DIR, fname, image_size, uploads_index.mtime(fname))
+        return image_urls[fname]
 
     # Final Formatting with images
     final_recommendations = []
@@ -324,6 +537,7 @@ def get_recommendations(current_temp: str, gender: str, event: str, outfit: str,
         rec["Upper Layer Image"] = find_image_for_item("upper_layer", item[5])
         rec["Upper Layer Color Image"] = find_image_for_item("upper_layer_color", item[6])
         final_recommendations.append(rec)
+    timer.lap('images')
     return final_recommendations
 
 # --- Feedback Endpoint ---
@@ -332,23 +546,25 @@ def handle_feedback():
     data = request.get_json()
     outfit = data.get('outfit')
     feedback = data.get('feedback') # 'accepted' or 'rejected'
+    user_id = data.get('user_id') or ''
 
     if not outfit or not feedback:
         return jsonify({"error": "Missing outfit or feedback"}), 400
+    if not isinstance(user_id, str) or len(user_id) > MAX_USER_ID_LENGTH:
+        return jsonify({"error": f"user_id must be a string of at most {MAX_USER_ID_LENGTH} characters"}), 400
 
     try:
-        # Ensure the file exists with a header
-        if not os.path.exists(FEEDBACK_FILE):
-            with open(FEEDBACK_FILE, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.writer(f)
-                writer.writerow(OUTFIT_FIELDS + ['feedback_type'])
-
-        with open(FEEDBACK_FILE, 'a', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            # Ensure all fields are present in the row
-            row = [outfit.get(field, 'N/A') for field in OUTFIT_FIELDS]
-            row.append(feedback)
-            writer.writerow(row)
+        # Ensure all fields are present in the row; the header is added by the writer
+        row = [outfit.get(field, 'N/A') for field in OUTFIT_FIELDS]
+        row.extend([user_id, feedback])
+        if not feedback_writer.submit(FEEDBACK_FILE, FEEDBACK_FIELDS, [row]):
+            return jsonify({"error": "Feedback is backed up, please retry shortly"}), 503
+        if user_id and feedback == 'rejected':
+            # This worker filters it at once; the store write follows in the background
+            rows = user_rejections.record(user_id, [tuple(row[:7])])
+            if not user_rejection_writer.submit(USER_REJECTIONS_DB, ('user_id', 'outfit_id'), rows):
+                user_rejections.cancel(rows)
+                request_log.warning("User rejection queue is full; dropped a rejection for '%s'", user_id)
         return jsonify({"status": "success", "message": "Feedback received"}), 200
     except Exception as e:
         print(f"[FEEDBACK_ERROR] {e}")
@@ -358,7 +574,85 @@ def handle_feedback():
 # --- API Endpoints ---
 @app.route('/')
 def home():
-    return jsonify({"status": "success", "message": "Groomify API is running.", "dataset_loaded": not rule_data.empty})
+    return jsonify({"status": "success", "message": "Groomify API is running.", "dataset_loaded": not dataset.empty})
+
+@app.route('/cache/stats')
+def cache_stats():
+    ds = dataset
+    return jsonify({"dataset": {"rows": ds.num_rows, "version": ds.rule_index.version,
+                                "generation": getattr(ds, 'generation', None)},
+                    "recommendation_cache": recommendation_cache.stats(), "rejected_outfits": len(rejection_index),
+                    "user_rejections": user_rejections.stats(), "feedback_writer": feedback_writer.stats()})
+
+# --- Admin Endpoints ---
+def is_admin_request():
+    # Client addresses can't be trusted behind a local reverse proxy, so there is no token-less access
+    if not ADMIN_TOKEN:
+        return False
+    return hmac.compare_digest(request.headers.get('X-Admin-Token', '').encode(), ADMIN_TOKEN.encode())
+
+@app.route('/admin/reload', methods=['POST'])
+def admin_reload():
+    """Rebuild the dataset if the sheet changed, in the background; ?wait=1 returns once it is live.
+
+    ?force=1 rebuilds even an unchanged sheet, at most once per ADMIN_RELOAD_MIN_INTERVAL.
+    """
+    global last_forced_reload
+    if not ADMIN_TOKEN:
+        return jsonify({"error": "Admin endpoints are disabled; set ADMIN_TOKEN to enable them"}), 403
+    if not is_admin_request():
+        return jsonify({"error": "Forbidden"}), 403
+    force = request.args.get('force') in ('1', 'true', 'yes')
+    if force:
+        with forced_reload_lock:
+            now = time.monotonic()
+            retry_after = 0 if last_forced_reload is None else last_forced_reload + ADMIN_RELOAD_MIN_INTERVAL - now
+            if retry_after > 0:
+                return (jsonify({"error": "A forced reload ran recently, retry later"}), 429,
+                        {"Retry-After": str(math.ceil(retry_after))})
+            last_forced_reload = now
+    elif not dataset_is_stale(dataset):
+        return jsonify({"reloaded": False, "status": "current", "version": dataset.rule_index.version}), 200
+    if request.args.get('wait') in ('1', 'true', 'yes'):
+        reloaded = reload_dataset(force=force)
+        ds = dataset
+        return jsonify({"reloaded": reloaded, "rows": ds.num_rows, "version": ds.rule_index.version}), 200 if reloaded else 500
+    threading.Thread(target=reload_dataset, kwargs={'force': force}, name='dataset-reload', daemon=True).start()
+    return jsonify({"status": "reloading", "version": dataset.rule_index.version}), 202
+
+# --- Uploaded Item Images ---
+@app.route('/uploads/<path:filename>')
+def serve_upload(filename):
+    """Item images linked from recommendations; ?size=sm|md|lg serves a WebP thumbnail."""
+    return send_upload(UPLOADS_DIR, filename, request.args.get('size'), versioned='v' in request.args)
+
+# Context fields taken from request bodies; weather may also be a number of degrees
+CONTEXT_TEXT_FIELDS = ('gender', 'event', 'outfit', 'time')
+# Matched against the sheet as case-insensitive patterns, so every context needs them
+PATTERN_FIELDS = ('event', 'outfit', 'time')
+
+def context_error(ctx):
+    """Why the context fields of ``ctx`` (a request body or one day of a batch) are malformed, or None."""
+    for field in CONTEXT_TEXT_FIELDS:
+        if ctx.get(field) is not None and not isinstance(ctx[field], str):
+            return f"{field} must be a string"
+    for field in PATTERN_FIELDS:
+        if ctx.get(field) is None:
+            return f"{field} is required"
+        try:
+            re.compile(ctx[field])
+        except re.error as e:
+            return f"{field} is not a valid pattern: {e}"
+    weather = ctx.get('weather')
+    if weather is not None and (isinstance(weather, bool) or not isinstance(weather, (str, int, float))):
+        return "weather must be a string or a number"
+    return None
+
+def seed_error(seed):
+    """Why a client-supplied ``seed`` can't seed ``random.Random``, or None."""
+    if seed is not None and (isinstance(seed, bool) or not isinstance(seed, (int, str))):
+        return "seed must be an integer or a string"
+    return None
 
 @app.route('/recommend', methods=['POST'])
 def recommend():
@@ -366,7 +660,24 @@ def recommend():
     if not data:
         return jsonify({"error": "Invalid input"}), 400
 
-    print(f"\n--- RAW REQUEST RECEIVED ---\n{json.dumps(data, indent=2)}")
+    request_log.debug("Raw request received: %s", data)
+    error = context_error(data) or seed_error(data.get('seed'))
+    if error:
+        return jsonify({"error": error}), 400
+
+    try:
+        num_outfits = max(1, min(MAX_NUM_OUTFITS, int(data.get('count') or DEFAULT_NUM_OUTFITS)))
+    except (TypeError, ValueError):
+        return jsonify({"error": "count must be an integer"}), 400
+    image_size = data.get('image_size') or RECOMMENDATION_IMAGE_SIZE
+    if image_size not in IMAGE_SIZES:
+        return jsonify({"error": f"image_size must be one of {', '.join(IMAGE_SIZES)}"}), 400
+    ranking = data.get('rank') or RECOMMENDATION_RANKING
+    if ranking not in RANKINGS:
+        return jsonify({"error": f"rank must be one of {', '.join(RANKINGS)}"}), 400
+    user_id = data.get('user_id') or None
+    if user_id is not None and (not isinstance(user_id, str) or len(user_id) > MAX_USER_ID_LENGTH):
+        return jsonify({"error": f"user_id must be a string of at most {MAX_USER_ID_LENGTH} characters"}), 400
 
     try:
         recommendations = get_recommendations(
@@ -374,15 +685,208 @@ def recommend():
             gender=data.get('gender'),
             event=data.get('event'),
             outfit=data.get('outfit'),
-            time_of_day=data.get('time')
+            time_of_day=data.get('time'),
+            num_outfits=num_outfits,
+            seed=data.get('seed'),
+            image_size=image_size,
+            ranking=ranking,
+            user_id=user_id
         )
-        print(f"--- RECOMMENDATION SENT: {len(recommendations)} items ---")
+        request_log.info("Recommendation sent: %d items", len(recommendations))
         return jsonify(recommendations)
     except Exception as e:
         print(f"[API_ERROR] An unexpected error occurred: {e}")
         traceback.print_exc()
         return jsonify({"error": "An internal server error occurred."}), 500
 
+# Upper bound on days a single batch request may plan.
+MAX_BATCH_CONTEXTS = 62
+
+@app.route('/recommend/batch', methods=['POST'])
+def recommend_batch():
+    """Recommendations for many contexts (e.g. the days of a calendar) in one round trip.
+
+    Body: {"contexts": [{"weather", "gender", "event", "outfit", "time", ...}, ...],
+    "count": 3, "seed": ..., "avoid_repeats": false, "image_size": "md", "rank": "score", "user_id": ...}. Contexts
+    that normalize to the same key share their filtering and pools; with
+    avoid_repeats an outfit given to one context is not offered again later in the batch.
+    """
+    data = request.get_json(silent=True)
+    contexts = data.get('contexts') if isinstance(data, dict) else None
+    if not isinstance(contexts, list) or not contexts:
+        return jsonify({"error": "Request must include a non-empty contexts list"}), 400
+    if len(contexts) > MAX_BATCH_CONTEXTS:
+        return jsonify({"error": f"At most {MAX_BATCH_CONTEXTS} contexts per batch"}), 400
+    if not all(isinstance(ctx, dict) for ctx in contexts):
+        return jsonify({"error": "Each context must be an object"}), 400
+    error = next((f"contexts[{i}]: {e}" for i, e in enumerate(map(context_error, contexts)) if e), None)
+    if error:
+        return jsonify({"error": error}), 400
+    try:
+        num_outfits = max(1, min(MAX_NUM_OUTFITS, int(data.get('count') or DEFAULT_NUM_OUTFITS)))
+    except (TypeError, ValueError):
+        return jsonify({"error": "count must be an integer"}), 400
+    image_size = data.get('image_size') or RECOMMENDATION_IMAGE_SIZE
+    if image_size not in IMAGE_SIZES:
+        return jsonify({"error": f"image_size must be one of {', '.join(IMAGE_SIZES)}"}), 400
+    ranking = data.get('rank') or RECOMMENDATION_RANKING
+    if ranking not in RANKINGS:
+        return jsonify({"error": f"rank must be one of {', '.join(RANKINGS)}"}), 400
+    user_id = data.get('user_id') or None
+    if user_id is not None and (not isinstance(user_id, str) or len(user_id) > MAX_USER_ID_LENGTH):
+        return jsonify({"error": f"user_id must be a string of at most {MAX_USER_ID_LENGTH} characters"}), 400
+    seed = data.get('seed')
+    error = seed_error(seed)
+    if error:
+        return jsonify({"error": error}), 400
+    avoid_repeats = bool(data.get('avoid_repeats'))
+
+    try:
+        # Build each distinct context once up front; every day then draws from the cache
+        ds = dataset
+        keys = {}
+        for ctx in contexts:
+            gender = (ctx.get('gender') or '').lower()
+            if gender in ('male', 'female') and not ds.empty:
+                weather_range = parse_weather_range(ctx.get('weather'))
+                key = context_key(ds, gender, weather_range, ctx.get('event'), ctx.get('outfit'), ctx.get('time'))
+                if key not in keys:
+                    keys[key] = get_context(ds, gender, weather_range, ctx.get('event'), ctx.get('outfit'), ctx.get('time'))
+
+        used = set()
+        results = []
+        for i, ctx in enumerate(contexts):
+            recommendations = get_recommendations(
+                current_temp=ctx.get('weather'),
+                gender=ctx.get('gender'),
+                event=ctx.get('event'),
+                outfit=ctx.get('outfit'),
+                time_of_day=ctx.get('time'),
+                num_outfits=num_outfits,
+                seed=None if seed is None else f"{seed}:{i}",
+                exclude=used,
+                image_size=image_size,
+                ranking=ranking,
+                user_id=user_id
+            )
+            if avoid_repeats:
+                used.update(tuple(rec[field] for field in OUTFIT_FIELDS[:7]) for rec in recommendations)
+            result = {"index": i, "recommendations": recommendations}
+            if 'date' in ctx:
+                result["date"] = ctx['date']
+            results.append(result)
+        request_log.info("Batch recommendation sent: %d contexts, %d distinct", len(results), len(keys))
+        return jsonify({"results": results, "distinct_contexts": len(keys)})
+    except Exception as e:
+        print(f"[API_ERROR] An unexpected error occurred: {e}")
+        traceback.print_exc()
+        return jsonify({"error": "An internal server error occurred."}), 500
+
+def previous_outfits(inventory, previous, days):
+    """Index triples of an earlier /capsule/plan response's outfits, aligned with ``days``.
+
+    Days are matched by date when both sides have one, else by position.
+    """
+    earlier = previous.get('days') if isinstance(previous.get('days'), list) else []
+    by_date = {day.get('date'): day for day in earlier if isinstance(day, dict) and day.get('date') is not None}
+    outfits = []
+    for i, ctx in enumerate(days):
+        day = by_date.get(ctx.get('date')) if ctx.get('date') is not None else None
+        if day is None and not by_date and i < len(earlier) and isinstance(earlier[i], dict):
+            day = earlier[i]
+        outfit = day.get('outfit') if day is not None else None
+        triple = None
+        if isinstance(outfit, dict):
+            ids = {slot: outfit[slot].get('id') if isinstance(outfit.get(slot), dict) else None for slot in SLOTS}
+            # No upper layer is the index past the owned ones
+            triple = (inventory.index_of('dress', ids['dress']), inventory.index_of('shoes', ids['shoes']),
+                      inventory.index_of('upper_layer', ids['upper_layer']) if ids['upper_layer'] is not None
+                      else len(inventory.items['upper_layer']))
+        outfits.append(None if triple is None or None in triple else triple)
+    return outfits
+
+@app.route('/capsule/plan', methods=['POST'])
+def capsule_plan():
+    """A small capsule of owned items that dresses every day of a range, and each day's outfit.
+
+    Body: {"inventory": [{"id", "slot": "dress"|"shoes"|"upper_layer", "type", "color", "fabric"}, ...],
+    "days": [{"date", "weather", "gender", "event", "outfit", "time"}, ...], "previous": {...}}.
+    Context fields given at the top level apply to every day that leaves them out.
+    Send back an earlier response as previous after editing some days: the plan starts
+    from its capsule and days whose outfit still fits keep it, so only the changed days
+    are planned again. Days nothing owned can dress are listed under "uncovered".
+    """
+    data = request.get_json(silent=True)
+    days = data.get('days') if isinstance(data, dict) else None
+    if not isinstance(days, list) or not days:
+        return jsonify({"error": "Request must include a non-empty days list"}), 400
+    if len(days) > MAX_BATCH_CONTEXTS:
+        return jsonify({"error": f"At most {MAX_BATCH_CONTEXTS} days per plan"}), 400
+    if not all(isinstance(ctx, dict) for ctx in days):
+        return jsonify({"error": "Each day must be an object"}), 400
+    # Top-level context fields apply to days that leave them out
+    defaults = {field: data[field] for field in (*CONTEXT_TEXT_FIELDS, 'weather') if field in data}
+    days = [{**defaults, **ctx} for ctx in days]
+    error = next((f"days[{i}]: {e}" for i, e in enumerate(map(context_error, days)) if e), None)
+    if error:
+        return jsonify({"error": error}), 400
+    try:
+        inventory = Inventory(data.get('inventory'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    previous = data.get('previous') if isinstance(data.get('previous'), dict) else {}
+
+    try:
+        ds = dataset
+        inventory_rows = get_inventory_rows(ds, inventory) if not ds.empty else None
+        # Days sharing a normalized context share one feasibility tensor
+        classes, class_feasible, class_tiers, day_classes = {}, [], [], []
+        for ctx in days:
+            gender = (ctx.get('gender') or '').lower()
+            if gender not in ('male', 'female') or inventory_rows is None:
+                key = None
+            else:
+                weather_range = parse_weather_range(ctx.get('weather'))
+                args = (gender, weather_range, ctx.get('event'), ctx.get('outfit'), ctx.get('time'))
+                key = context_key(ds, *args)
+            if key not in classes:
+                classes[key] = len(class_feasible)
+                if key is None:
+                    feasible, tier = None, None
+                else:
+                    feasible, tier = feasibility_cache.get_or_create(
+                        (key, inventory.key), lambda: build_day_feasibility(ds, inventory, inventory_rows, *args))
+                class_feasible.append(feasible)
+                class_tiers.append(tier)
+            day_classes.append(classes[key])
+
+        seed_capsule = [item.get('id') if isinstance(item, dict) else item for item in previous.get('capsule') or []]
+        scores = inventory.outfit_scores()
+        used, outfits = plan_capsule(inventory, day_classes, class_feasible, scores, seed_capsule,
+                                     previous_outfits(inventory, previous, days) if previous else ())
+
+        results = []
+        for i, (ctx, outfit) in enumerate(zip(days, outfits)):
+            result = {"index": i, "outfit": None, "score": None, "tier": None}
+            if 'date' in ctx:
+                result["date"] = ctx['date']
+            if outfit is not None:
+                dress, shoes, upper = outfit
+                result["outfit"] = {"dress": inventory.items['dress'][dress], "shoes": inventory.items['shoes'][shoes],
+                                    "upper_layer": inventory.items['upper_layer'][upper]
+                                    if upper < len(inventory.items['upper_layer']) else None}
+                result["score"] = round(float(scores[outfit]), 3)
+                result["tier"] = class_tiers[day_classes[i]]
+            results.append(result)
+        capsule = [item for s, slot in enumerate(SLOTS) for i, item in enumerate(inventory.items[slot]) if used[s][i]]
+        request_log.info("Capsule plan sent: %d days, %d distinct, %d items", len(results), len(classes), len(capsule))
+        return jsonify({"capsule": capsule, "days": results, "distinct_contexts": len(classes),
+                        "uncovered": [r["index"] for r in results if r["outfit"] is None]})
+    except Exception as e:
+        print(f"[API_ERROR] An unexpected error occurred: {e}")
+        traceback.print_exc()
+        return jsonify({"error": "An internal server error occurred."}), 500
+
 @app.route('/save_recommendations', methods=['POST'])
 def save_recommendations():
     """Save recommendations to CSV file."""
@@ -398,18 +902,15 @@ def save_recommendations():
     if not data or not isinstance(data, list):
         return jsonify({'error': 'No valid recommendations provided'}), 400
         
-    try:
-        # Save to CSV
-        file_path = 'saved_recommendations.csv'
-        write_header = not os.path.exists(file_path) or os.stat(file_path).st_size == 0
+    if not all(isinstance(rec, dict) for rec in data):
+        return jsonify({'error': 'Each recommendation must be an object'}), 400
         
-        with open(file_path, 'a', newline='', encoding='utf-8') as f:
-            if data:  # Check if we have any recommendations
-                writer = csv.DictWriter(f, fieldnames=data[0].keys())
-                if write_header:
-                    writer.writeheader()
-                for rec in data:
-                    writer.writerow(rec)
+    try:
+        # Queue for the background writer; the first recommendation's keys define the columns
+        fieldnames = list(data[0].keys())
+        rows = [[rec.get(field) for field in fieldnames] for rec in data]
+        if not feedback_writer.submit(SAVED_RECOMMENDATIONS_FILE, fieldnames, rows):
+            return jsonify({'error': 'Server is busy, please retry shortly'}), 503
                     
         return jsonify({'message': f'Successfully saved {len(data)} recommendations'}), 200
         
@@ -420,13 +921,13 @@ def save_recommendations():
 # --- Main Execution ---
 if __name__ == '__main__':
     # --- Initialize Feedback File ---
-    if not os.path.exists(FEEDBACK_FILE):
+    if FEEDBACK_BACKEND == 'csv' and not os.path.exists(FEEDBACK_FILE):
         with open(FEEDBACK_FILE, 'w', newline='', encoding='utf-8') as f:
             writer = csv.writer(f)
-            writer.writerow(OUTFIT_FIELDS + ['feedback_type'])
+            writer.writerow(FEEDBACK_FIELDS)
     print("Starting Flask server...")
-    if not rule_data.empty:
-        print(f"Dataset loaded successfully with {len(rule_data)} rows.")
+    if not dataset.empty:
+        print(f"Dataset loaded successfully with {dataset.num_rows} rows.")
     else:
         print("Warning: Dataset is empty or failed to load.")
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -1,19 +1,31 @@
 
 
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify
 from werkzeug.utils import secure_filename
 import os
-import cv2
-import numpy as np
-from rembg import remove
 from PIL import Image
 from io import BytesIO
 import base64
+import hashlib
+import json
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FutureTimeout
 from flask_cors import CORS
+from instrumentation import REGISTRY, configure_logging, instrument_app, request_logger
+from uploads_server import make_thumbnails, send_upload, upload_url
+from avatar_cache import AvatarCache
+from avatar_pipeline import OUTPUT_FORMATS, PIPELINE_VERSION, init_worker, run_batch_job, run_job, worker_ready
+from job_queue import JobQueue, QueueFull
+from segmentation import DEFAULT_MODEL
 
 # Initialize Flask App
 app = Flask(__name__)
 CORS(app)
+# Request timings and /metrics; per-request log lines are sampled (LOG_SAMPLE_RATE)
+configure_logging()
+instrument_app(app)
+request_log = request_logger('groomify.cartoonify')
 
 # Set up folders
 UPLOAD_FOLDER = "uploads"
@@ -23,11 +35,206 @@ os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 app.config["OUTPUT_FOLDER"] = OUTPUT_FOLDER
 
+# Cartoonify jobs run on a pool of worker processes, each holding its own warm
+# background-removal model. CARTOONIFY_WORKERS=0 runs them on threads in this process.
+cartoonify_jobs = JobQueue(workers=int(os.environ.get('CARTOONIFY_WORKERS', '2')),
+                           max_pending=int(os.environ.get('CARTOONIFY_MAX_PENDING', '32')),
+                           initializer=init_worker, ready=worker_ready)
+CARTOONIFY_TIMEOUT = float(os.environ.get('CARTOONIFY_TIMEOUT', '60'))
+MAX_POLL_WAIT = 30.0
+CARTOONIFY_BATCH_SIZE = int(os.environ.get('CARTOONIFY_BATCH_SIZE', '4'))
+MAX_BATCH_IMAGES = int(os.environ.get('MAX_BATCH_IMAGES', '16'))
+AVATAR_SIZE = (512, 512)
+
+# Spawn the workers and load their models before serving, unless REMBG_WARMUP=0.
+# Spawned workers re-import this module when it is run as a script, hence the
+# parent check; under gunicorn --preload, call cartoonify_jobs.start() from a
+# post_fork hook instead.
+if os.environ.get('REMBG_WARMUP', '1') != '0' and multiprocessing.parent_process() is None:
+    if not cartoonify_jobs.start(timeout=CARTOONIFY_TIMEOUT):
+        print("[WARNING] Cartoonify workers were not all ready at start-up")
+
+# Finished cartoons keyed by a hash of the upload and the processing parameters, so
+# re-uploading the same photo skips the pipeline. Sizes are in megabytes.
+avatar_cache = AvatarCache(os.path.join(OUTPUT_FOLDER, 'avatar_cache'),
+                           max_memory_bytes=int(float(os.environ.get('AVATAR_CACHE_MEMORY_MB', '64')) * 1024 * 1024),
+                           max_disk_bytes=int(float(os.environ.get('AVATAR_CACHE_DISK_MB', '512')) * 1024 * 1024))
+
+# Uploads are processed from memory; keeping the original on disk is an optional
+# side effect done off the request thread (PERSIST_UPLOADS=0 disables it).
+PERSIST_UPLOADS = os.environ.get('PERSIST_UPLOADS', '1') != '0'
+upload_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='upload-writer')
+
+
+# --- Metrics ---
+# Workers are separate processes, so pipeline stage times travel back in each job's
+# output (see avatar_pipeline._measured) and are recorded here when the job finishes
+CARTOONIFY_IMAGES = REGISTRY.counter('cartoonify_images_total', 'Images submitted for cartoonifying, by outcome',
+                                     ('outcome',))
+CARTOONIFY_JOBS = REGISTRY.counter('cartoonify_jobs_total', 'Finished cartoonify jobs', ('job', 'status'))
+CARTOONIFY_STAGE_SECONDS = REGISTRY.histogram('cartoonify_stage_seconds',
+                                              'Seconds per pipeline stage; batch jobs report the sum over their images',
+                                              ('job', 'stage'))
+REGISTRY.gauge('cartoonify_queue_pending', 'Cartoonify jobs queued or running',
+               callback=lambda: cartoonify_jobs.stats()["pending"])
+REGISTRY.counter('cartoonify_queue_rejected_total', 'Jobs refused because the queue was full',
+                 callback=lambda: cartoonify_jobs.stats()["rejected"])
+REGISTRY.counter('avatar_cache_lookups_total', 'Avatar cache lookups by result', ('result',),
+                 callback=lambda: avatar_cache_lookups())
+REGISTRY.gauge('avatar_cache_bytes', 'Bytes held by each avatar cache tier', ('tier',),
+               callback=lambda: {('memory',): avatar_cache.stats()["memory_bytes"],
+                                 ('disk',): avatar_cache.stats()["disk_bytes"]})
+
+
+def avatar_cache_lookups():
+    stats = avatar_cache.stats()
+    return {('memory_hit',): stats["hits"] - stats["disk_hits"], ('disk_hit',): stats["disk_hits"],
+            ('miss',): stats["misses"]}
+
+
+def record_job(job, kind):
+    """Done callback: count the job and record its queue wait and per-stage times."""
+    output = job.output
+    CARTOONIFY_JOBS.inc(job=kind, status=job.status)
+    if 'started_at' in output:
+        CARTOONIFY_STAGE_SECONDS.observe(max(0.0, output['started_at'] - job.submitted_at), job=kind, stage='queue')
+        CARTOONIFY_STAGE_SECONDS.observe(output['processing_seconds'], job=kind, stage='total')
+    for stage, seconds in (output.get('stages') or {}).items():
+        CARTOONIFY_STAGE_SECONDS.observe(seconds, job=kind, stage=stage)
+
+
+def persist_upload(filename, data):
+    def write():
+        try:
+            with open(os.path.join(app.config["UPLOAD_FOLDER"], filename), 'wb') as f:
+                f.write(data)
+        except OSError as e:
+            print(f"[WARNING] Could not save upload '{filename}': {e}")
+            return
+        write_thumbnails(filename, data)
+    if PERSIST_UPLOADS and filename:
+        upload_writer.submit(write)
+
+
+def write_thumbnails(filename, data=None):
+    """Pre-generate the served thumbnail sizes so the first client doesn't wait for them."""
+    try:
+        make_thumbnails(app.config["UPLOAD_FOLDER"], filename, data)
+    except Exception as e:
+        print(f"[WARNING] Could not thumbnail upload '{filename}': {e}")
+
+
+def request_option(name):
+    return (request.args.get(name) or request.form.get(name) or '').lower()
+
+
+def wants_async():
+    return request_option('async') in ('1', 'true', 'yes')
+
+
+def output_format():
+    """'webp' if asked for via ?format=webp or an Accept header preferring it, else 'png'."""
+    requested = request_option('format')
+    if requested in OUTPUT_FORMATS:
+        return requested
+    return 'webp' if request.accept_mimetypes.best_match(['image/png', 'image/webp']) == 'image/webp' else 'png'
+
+
+def wants_binary():
+    """Raw image body instead of a base64 data URI in JSON (?response=binary or Accept: image/*)."""
+    if request_option('response') == 'binary':
+        return True
+    return request.accept_mimetypes.best_match(['application/json', 'image/png', 'image/webp']) in ('image/png', 'image/webp')
+
+
+def cartoon_response(image_bytes, image_format):
+    mimetype = OUTPUT_FORMATS[image_format][1]
+    if wants_binary():
+        return Response(image_bytes, mimetype=mimetype, headers={"Content-Length": str(len(image_bytes))})
+    base64_cartoon = base64.b64encode(image_bytes).decode('utf-8')
+    request_log.debug("Cartoonified image: %d bytes of base64", len(base64_cartoon))
+    return jsonify({"cartoonImage": f"data:{mimetype};base64,{base64_cartoon}"})
+
+
+def data_uri(image_bytes, image_format):
+    return f"data:{OUTPUT_FORMATS[image_format][1]};base64,{base64.b64encode(image_bytes).decode('utf-8')}"
+
+
+def decode_web_upload(data):
+    """Decode a base64 (optionally data-URI) image and save a copy named after its content.
+
+    Raises ValueError if it is not an image PIL can identify.
+    """
+    if data.startswith('data:image'):
+        header, data = data.split(',', 1)
+    try:
+        image_bytes = base64.b64decode(data)
+        # Only the header is parsed here; the decoded bytes go to the pipeline as-is
+        image_format = Image.open(BytesIO(image_bytes)).format or 'PNG'
+    except Exception as e:
+        raise ValueError(str(e)) from e
+    # Named by content so concurrent web uploads don't overwrite each other
+    persist_upload(f"web_upload_{hashlib.sha256(image_bytes).hexdigest()[:16]}.{image_format.lower()}", image_bytes)
+    return image_bytes
+
+
+def cartoon_cache_key(image_bytes, image_format):
+    return avatar_cache.key(image_bytes, crop_coords=None, avatar_size=AVATAR_SIZE,
+                            model=DEFAULT_MODEL, output_format=image_format, pipeline=PIPELINE_VERSION)
+
+
+def start_cartoonify(image_bytes):
+    """Queue an upload for processing; async callers get a job id, others wait for the cartoon."""
+    image_format = output_format()
+    cache_key = cartoon_cache_key(image_bytes, image_format)
+    cached = avatar_cache.get(cache_key)
+    if cached is not None:
+        CARTOONIFY_IMAGES.inc(outcome='cache_hit')
+        if wants_async():
+            job = cartoonify_jobs.completed({"result": cached, "cached": True})
+            job.image_format = image_format
+            return jsonify({"job_id": job.id, "status": job.status, "status_url": f"/cartoonify/{job.id}"}), 202
+        return cartoon_response(cached, image_format)
+
+    try:
+        job = cartoonify_jobs.submit(run_job, image_bytes, avatar_size=AVATAR_SIZE, output_format=image_format)
+    except QueueFull:
+        CARTOONIFY_IMAGES.inc(outcome='rejected')
+        return jsonify({"error": "Too many images are being processed, please retry shortly"}), 503, {"Retry-After": "2"}
+    job.image_format = image_format
+    job.future.add_done_callback(lambda _: store_cartoon(cache_key, job))
+    job.future.add_done_callback(lambda _: record_job(job, 'single'))
+    if wants_async():
+        CARTOONIFY_IMAGES.inc(outcome='queued')
+        return jsonify({"job_id": job.id, "status": job.status, "status_url": f"/cartoonify/{job.id}"}), 202
+    if not job.wait(CARTOONIFY_TIMEOUT):
+        CARTOONIFY_IMAGES.inc(outcome='timeout')
+        return jsonify({"error": "Image processing timed out", "job_id": job.id,
+                        "status_url": f"/cartoonify/{job.id}"}), 504
+    cartoon = job.output.get('result')
+    if not cartoon:
+        CARTOONIFY_IMAGES.inc(outcome='failed')
+        return jsonify({"error": "Failed to process image"}), 500
+    CARTOONIFY_IMAGES.inc(outcome='processed')
+    return cartoon_response(cartoon, image_format)
+
+
+def store_cartoon(cache_key, job):
+    cartoon = job.output.get('result')
+    if cartoon:
+        avatar_cache.put(cache_key, cartoon)
+
+
+def store_batch(group, job):
+    for (_, _, cache_key), cartoon in zip(group, job.output.get('result') or ()):
+        if cartoon:
+            avatar_cache.put(cache_key, cartoon)
+
 
 @app.route('/cartoonify', methods=['GET', 'POST'])
 def upload_image():
-    print("DEBUG: request.files:", request.files)
-    print("DEBUG: request.form:", request.form)
+    request_log.debug("request.files: %s", request.files)
+    request_log.debug("request.form keys: %s", list(request.form))
     if request.method == 'GET':
         return jsonify({"message": "Use POST method to upload an image"}), 200
 
@@ -38,41 +245,146 @@ def upload_image():
             return jsonify({"error": "No selected file"}), 400
         if not file.filename.lower().endswith(('png', 'jpg', 'jpeg', 'webp')):
             return jsonify({"error": "Unsupported file type"}), 400
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-        file.save(filepath)
-        base64_cartoon = process_image(filepath)
-        if not base64_cartoon:
-            return jsonify({"error": "Failed to process image"}), 500
-        print(f"Cartoonified Image Base64: {base64_cartoon[:100]}...")
-        return jsonify({"cartoonImage": f"data:image/png;base64,{base64_cartoon}"})
+        image_bytes = file.read()
+        persist_upload(secure_filename(file.filename), image_bytes)
+        return start_cartoonify(image_bytes)
 
     # Try to get image from request.form (base64 string, possible from web)
     elif 'image' in request.form:
-        data = request.form['image']
-        import base64
-        from PIL import Image
-        from io import BytesIO
-        if data.startswith('data:image'):
-            header, data = data.split(',', 1)
         try:
-            image_data = base64.b64decode(data)
-            image = Image.open(BytesIO(image_data))
-            filename = 'web_upload.png'
-            filepath = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-            image.save(filepath)
-            base64_cartoon = process_image(filepath)
-            if not base64_cartoon:
-                return jsonify({"error": "Failed to process image"}), 500
-            print(f"Cartoonified Image Base64: {base64_cartoon[:100]}...")
-            return jsonify({"cartoonImage": f"data:image/png;base64,{base64_cartoon}"})
-        except Exception as e:
-            print(f"❌ Web upload decode error: {e}")
+            image_bytes = decode_web_upload(request.form['image'])
+        except ValueError as e:
+            request_log.warning("Web upload decode error: %s", e)
             return jsonify({"error": "Invalid image data"}), 400
+        return start_cartoonify(image_bytes)
 
     return jsonify({"error": "No file uploaded"}), 400
 
 
+@app.route('/cartoonify/batch', methods=['POST'])
+def cartoonify_batch():
+    """Cartoonify several images, streaming one JSON line per image as soon as it is ready.
+
+    Takes multipart files or base64 strings under ``images`` (or repeated ``image``)
+    fields, or a JSON body ``{"images": [...]}``. Images are grouped into jobs of
+    CARTOONIFY_BATCH_SIZE so each worker runs one batched model call per group.
+    Lines look like ``{"index", "filename", "cartoonImage"}`` or ``{"index", "filename", "error"}``.
+    """
+    files = request.files.getlist('images') + request.files.getlist('image')
+    payload = request.get_json(silent=True) if request.is_json else None
+    encoded = request.form.getlist('images') + request.form.getlist('image')
+    if isinstance(payload, dict) and isinstance(payload.get('images'), list):
+        encoded += payload['images']
+    # Refuse oversized batches before reading, decoding or saving any image
+    if not files and not encoded:
+        return jsonify({"error": "No images uploaded"}), 400
+    if len(files) + len(encoded) > MAX_BATCH_IMAGES:
+        return jsonify({"error": f"At most {MAX_BATCH_IMAGES} images per batch"}), 400
+
+    uploads = []
+    for file in files:
+        if not file.filename.lower().endswith(('png', 'jpg', 'jpeg', 'webp')):
+            uploads.append((file.filename, None, "Unsupported file type"))
+            continue
+        image_bytes = file.read()
+        persist_upload(secure_filename(file.filename), image_bytes)
+        uploads.append((file.filename, image_bytes, None))
+    for data in encoded:
+        try:
+            uploads.append((None, decode_web_upload(data), None))
+        except (ValueError, AttributeError) as e:
+            request_log.warning("Web upload decode error: %s", e)
+            uploads.append((None, None, "Invalid image data"))
+
+    image_format = output_format()
+    ready, pending = [], []
+    for index, (filename, image_bytes, error) in enumerate(uploads):
+        line = {"index": index, "filename": filename}
+        if error:
+            ready.append({**line, "error": error})
+            continue
+        cache_key = cartoon_cache_key(image_bytes, image_format)
+        cached = avatar_cache.get(cache_key)
+        if cached is not None:
+            CARTOONIFY_IMAGES.inc(outcome='cache_hit')
+            ready.append({**line, "cartoonImage": data_uri(cached, image_format), "cached": True})
+        else:
+            pending.append((line, image_bytes, cache_key))
+
+    jobs = {}
+    for start in range(0, len(pending), CARTOONIFY_BATCH_SIZE):
+        group = pending[start:start + CARTOONIFY_BATCH_SIZE]
+        try:
+            job = cartoonify_jobs.submit(run_batch_job, [image_bytes for _, image_bytes, _ in group],
+                                         avatar_size=AVATAR_SIZE, output_format=image_format)
+        except QueueFull:
+            CARTOONIFY_IMAGES.inc(len(group), outcome='rejected')
+            ready.extend({**line, "error": "Too many images are being processed, please retry shortly"}
+                         for line, _, _ in group)
+            continue
+        CARTOONIFY_IMAGES.inc(len(group), outcome='queued')
+        job.future.add_done_callback(lambda _, job=job, group=group: store_batch(group, job))
+        job.future.add_done_callback(lambda _, job=job: record_job(job, 'batch'))
+        jobs[job.future] = (job, group)
+    if pending and not jobs and not any('cartoonImage' in line for line in ready):
+        return jsonify({"error": "Too many images are being processed, please retry shortly"}), 503, {"Retry-After": "2"}
+
+    def generate():
+        for line in ready:
+            yield json.dumps(line) + "\n"
+        unfinished = dict(jobs)
+        try:
+            for future in as_completed(jobs, timeout=CARTOONIFY_TIMEOUT * max(1, len(jobs))):
+                job, group = unfinished.pop(future)
+                results = job.output.get('result') or [None] * len(group)
+                for (line, _, _), cartoon in zip(group, results):
+                    if cartoon:
+                        yield json.dumps({**line, "cartoonImage": data_uri(cartoon, image_format)}) + "\n"
+                    else:
+                        yield json.dumps({**line, "error": "Failed to process image"}) + "\n"
+        except FutureTimeout:
+            for job, group in unfinished.values():
+                for line, _, _ in group:
+                    yield json.dumps({**line, "error": "Image processing timed out"}) + "\n"
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+@app.route('/cartoonify/stats')
+def cartoonify_stats():
+    return jsonify({**cartoonify_jobs.stats(), "avatar_cache": avatar_cache.stats()})
+
+
+@app.route('/cartoonify/<job_id>')
+def cartoonify_status(job_id):
+    """Poll a queued cartoonify job; ?wait=N long-polls for up to N seconds (max 30)."""
+    job = cartoonify_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown or expired job"}), 404
+    try:
+        wait = min(float(request.args.get('wait') or 0), MAX_POLL_WAIT)
+    except ValueError:
+        return jsonify({"error": "wait must be a number of seconds"}), 400
+    if wait > 0:
+        job.wait(wait)
+
+    status = job.status
+    if status == 'done' and wants_binary():
+        return cartoon_response(job.output['result'], job.image_format)
+    body = {"job_id": job.id, "status": status, "timings": job.timings()}
+    if status == 'done':
+        body["cartoonImage"] = data_uri(job.output['result'], job.image_format)
+    elif status == 'failed':
+        body["error"] = "Failed to process image"
+    return jsonify(body)
+
+
+@app.route('/uploads/<path:filename>')
+def serve_upload(filename):
+    """Uploaded images; ?size=sm|md|lg serves a WebP thumbnail instead of the original."""
+    return send_upload(app.config["UPLOAD_FOLDER"], filename, request.args.get('size'), versioned='v' in request.args)
+
+
 @app.route('/update_profile_image', methods=['POST'])
 def update_profile_image():
     """Endpoint to update user's profile image (avatar). Accepts user_id/email and image (file or base64)."""
@@ -90,7 +402,8 @@ def update_profile_image():
         filename = secure_filename(f"{user_id}_profile_{file.filename}")
         filepath = os.path.join(app.config["UPLOAD_FOLDER"], filename)
         file.save(filepath)
-        image_url = f"/uploads/{filename}"
+        upload_writer.submit(write_thumbnails, filename)
+        image_url = upload_url(app.config["UPLOAD_FOLDER"], filename)
         return jsonify({'success': True, 'image_url': image_url}), 200
 
     # Try to get image from request.form (base64 string)
@@ -104,7 +417,8 @@ def update_profile_image():
             filename = secure_filename(f"{user_id}_profile.png")
             filepath = os.path.join(app.config["UPLOAD_FOLDER"], filename)
             image.save(filepath)
-            image_url = f"/uploads/{filename}"
+            upload_writer.submit(write_thumbnails, filename)
+            image_url = upload_url(app.config["UPLOAD_FOLDER"], filename)
             return jsonify({'success': True, 'image_url': image_url}), 200
         except Exception as e:
             print(f"❌ Profile image decode error: {e}")
@@ -113,63 +427,5 @@ def update_profile_image():
     return jsonify({'error': 'No image uploaded'}), 400
 
 
-def process_image(image_path, crop_coords=None, avatar_size=(512, 512)):
-    """Process the image: remove background and apply cartoon effect."""
-    try:
-        # Open and remove background
-        with open(image_path, "rb") as img_file:
-            input_image = img_file.read()
-        removed_bg = remove(input_image)  # Remove background
-
-        # Convert to PIL image
-        if isinstance(removed_bg, bytes):
-            image_no_bg = Image.open(BytesIO(removed_bg)).convert("RGBA")
-        else:
-            image_no_bg = Image.fromarray(removed_bg).convert("RGBA")
-
-        # Crop if coordinates are provided
-        if crop_coords:
-            x, y, w, h = crop_coords
-            img_width, img_height = image_no_bg.size
-
-            x = max(0, min(x, img_width))
-            y = max(0, min(y, img_height))
-            w = max(1, min(w, img_width - x))
-            h = max(1, min(h, img_height - y))
-
-            image_no_bg = image_no_bg.crop((x, y, x + w, y + h))
-
-        # Convert to OpenCV format
-        image_rgba = np.array(image_no_bg)
-        if image_rgba.shape[-1] == 4:
-            image_rgb = cv2.cvtColor(image_rgba[:, :, :3], cv2.COLOR_RGBA2RGB)
-        else:
-            image_rgb = image_rgba
-
-        # Apply cartoon effect
-        gray = cv2.cvtColor(image_rgb, cv2.COLOR_RGB2GRAY)
-        edges = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 9, 9)
-        edges_colored = cv2.cvtColor(edges, cv2.COLOR_GRAY2RGB)
-        cartoon = cv2.bitwise_and(image_rgb, edges_colored)
-
-        # Ensure transparency is preserved
-        alpha_channel = image_rgba[:, :, 3] if image_rgba.shape[-1] == 4 else np.ones_like(gray) * 255
-        cartoon_rgba = np.dstack((cartoon, alpha_channel))
-
-        # Convert back to PIL and resize
-        final_avatar = Image.fromarray(cartoon_rgba, mode="RGBA")
-        final_avatar = final_avatar.resize(avatar_size, Image.Resampling.LANCZOS)
-
-        # Encode image to base64
-        buffer = BytesIO()
-        final_avatar.save(buffer, format="PNG")
-        buffer.seek(0)
-        base64_image = base64.b64encode(buffer.read()).decode('utf-8')
-
-        return base64_image
-    except Exception as e:
-        print(f"❌ Processing Error: {e}")
-        return None
-
 if __name__ == '__main__':
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+
+# --- Processed Avatar Cache ---
+class AvatarCache:
+    """Processed avatars keyed by a hash of the input bytes plus the processing parameters.
+
+    Two byte-bounded LRU tiers: a small in-memory one in front of a larger on-disk
+    directory shared by every worker on the host. Disk recency is the file mtime, so
+    a restarted worker rebuilds its LRU order from the directory listing.
+
+    ``max_disk_bytes`` bounds the directory as a whole, not one worker's share: other
+    workers' writes are invisible to this one's byte count, so each ``put`` re-reads
+    the listing before evicting (one scandir, small next to the pipeline run that
+    produced the entry).
+    """
+
+    def __init__(self, directory, max_memory_bytes=64 * 1024 * 1024, max_disk_bytes=512 * 1024 * 1024):
+        self.directory = directory
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._scan_disk()
+
+    @staticmethod
+    def key(image_bytes, **params):
+        """Content address for ``image_bytes`` processed with ``params``."""
+        digest = hashlib.sha256(image_bytes)
+        digest.update(json.dumps(params, sort_keys=True, default=str).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return data
+        try:
+            path = self._path(key)
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+            self.disk_hits += 1
+            if key in self._disk:
+                self._disk.move_to_end(key)
+            self._remember(key, data)
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            written = True
+        except OSError as e:
+            print(f"[WARNING] Could not write avatar cache entry: {e}")
+            written = False
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        with self._lock:
+            self._remember(key, data)
+            if not written:
+                return
+            # Count every worker's entries (this one's included) before deciding what to evict
+            self._scan_disk()
+            while self._disk_bytes > self.max_disk_bytes and len(self._disk) > 1:
+                old_key, size = self._disk.popitem(last=False)
+                self._disk_bytes -= size
+                self.evictions += 1
+                try:
+                    os.remove(self._path(old_key))
+                except OSError:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+            }
+
+    def _remember(self, key, data):
+        if len(data) > self.max_memory_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= len(old)
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.bin")
+
+    def _scan_disk(self):
+        """Rebuild the disk tier's LRU order and byte count from the shared directory."""
+        entries = []
+        with os.scandir(self.directory) as names:
+            for entry in names:
+                if entry.name.endswith('.bin'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        # Evicted by another worker since the listing
+                        continue
+                    entries.append((stat.st_mtime_ns, entry.name[:-4], stat.st_size))
+        self._disk = OrderedDict((key, size) for _, key, size in sorted(entries))
+        self._disk_bytes = sum(self._disk.values())
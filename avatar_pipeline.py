@@ -0,0 +1,221 @@
+import base64
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+
+from instrumentation import Stopwatch
+from segmentation import SessionManager, available_cores
+
+if os.name != 'nt':
+    import resource
+
+# One persistent background-removal session per process (REMBG_MODEL, REMBG_THREADS)
+segmentation_sessions = SessionManager()
+
+# Per-image decode and OpenCV stages of a batch; threads are only started when used
+stage_threads = ThreadPoolExecutor(max_workers=available_cores(), thread_name_prefix='cartoon-stage')
+
+
+# Part of the avatar cache key; bump when a change alters the generated image.
+PIPELINE_VERSION = 2
+
+# Encodings the cartoon can be returned in: name -> (PIL format, MIME type)
+OUTPUT_FORMATS = {'png': ('PNG', 'image/png'), 'webp': ('WEBP', 'image/webp')}
+
+
+# Effects run at about the output resolution rather than the camera's; values above
+# 1 keep extra detail for the final LANCZOS resize at the cost of more CPU.
+WORKING_OVERSAMPLE = float(os.environ.get('CARTOON_WORKING_OVERSAMPLE', '1.0'))
+
+EXIF_ORIENTATION = 0x0112
+
+
+def crop_box(crop_coords, size):
+    """Clamp (x, y, w, h) to an image of ``size`` and return it as a PIL box."""
+    x, y, w, h = crop_coords
+    img_width, img_height = size
+
+    x = max(0, min(x, img_width))
+    y = max(0, min(y, img_height))
+    w = max(1, min(w, img_width - x))
+    h = max(1, min(h, img_height - y))
+    return (x, y, x + w, y + h)
+
+
+def load_working_image(input_image, crop_coords=None, avatar_size=(512, 512)):
+    """Decode, orient and crop an upload at the smallest size that still covers ``avatar_size``.
+
+    JPEGs are decoded with DCT scaling (``Image.draft``), so a 12MP photo never
+    exists at full size in memory. Crop coordinates refer to the upright photo at
+    its original size, as before.
+    """
+    image = Image.open(BytesIO(input_image))
+    transposed = image.getexif().get(EXIF_ORIENTATION, 1) in (5, 6, 7, 8)
+    full_size = image.size[::-1] if transposed else image.size
+    box = crop_box(crop_coords, full_size) if crop_coords else (0, 0) + full_size
+    box_width, box_height = box[2] - box[0], box[3] - box[1]
+    scale = min(1.0, max(avatar_size[0] / box_width, avatar_size[1] / box_height) * WORKING_OVERSAMPLE)
+    working_size = (max(1, round(box_width * scale)), max(1, round(box_height * scale)))
+
+    # Ask the decoder for just enough pixels, then orient, crop and resize in one pass
+    draft_size = (max(1, round(full_size[0] * scale)), max(1, round(full_size[1] * scale)))
+    image.draft('RGB', draft_size[::-1] if transposed else draft_size)
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGB')
+    fx, fy = image.size[0] / full_size[0], image.size[1] / full_size[1]
+    return image.resize(working_size, Image.Resampling.LANCZOS,
+                        box=(box[0] * fx, box[1] * fy, box[2] * fx, box[3] * fy))
+
+
+def apply_cartoon(working, mask, avatar_size=(512, 512), output_format='png', stopwatch=None):
+    """Cut ``working`` out with its foreground ``mask``, apply the cartoon effect and encode it."""
+    stopwatch = stopwatch or Stopwatch()
+    with stopwatch.stage('opencv'):
+        cartoon_rgba = cartoon_effect(working, mask)
+    with stopwatch.stage('encode'):
+        # Convert back to PIL and resize
+        final_avatar = Image.fromarray(cartoon_rgba, mode="RGBA")
+        final_avatar = final_avatar.resize(avatar_size, Image.Resampling.LANCZOS)
+
+        # Encode straight into memory
+        buffer = BytesIO()
+        pil_format = OUTPUT_FORMATS[output_format][0]
+        final_avatar.save(buffer, format=pil_format, **({"lossless": True} if pil_format == 'WEBP' else {}))
+    return buffer.getvalue()
+
+
+def cartoon_effect(working, mask):
+    """RGBA array of the cut-out subject with the cartoon edges applied."""
+    mask = np.asarray(mask.convert('L'))
+    image_rgba = np.asarray(working.convert('RGBA'))
+    if working.mode == 'RGBA':
+        mask = cv2.multiply(mask, image_rgba[:, :, 3], scale=1 / 255)
+
+    # Cut out the subject the way rembg does: background fades to transparent black
+    image_rgb = cv2.multiply(image_rgba[:, :, :3], cv2.merge((mask, mask, mask)), scale=1 / 255)
+
+    # Apply cartoon effect
+    gray = cv2.cvtColor(image_rgb, cv2.COLOR_RGB2GRAY)
+    edges = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 9, 9)
+    edges_colored = cv2.cvtColor(edges, cv2.COLOR_GRAY2RGB)
+    cartoon = cv2.bitwise_and(image_rgb, edges_colored)
+
+    # Ensure transparency is preserved
+    return np.dstack((cartoon, mask))
+
+
+def cartoonify_bytes(input_image, crop_coords=None, avatar_size=(512, 512), output_format='png', stopwatch=None):
+    """Remove the background and apply the cartoon effect to an encoded image held in memory.
+
+    Everything after decoding runs at a working resolution derived from
+    ``avatar_size``. Returns the encoded avatar bytes (PNG or lossless WebP), or
+    None on failure. Stage timings are added to ``stopwatch`` if given.
+    """
+    stopwatch = stopwatch or Stopwatch()
+    try:
+        with stopwatch.stage('decode'):
+            working = load_working_image(input_image, crop_coords, avatar_size)
+
+        # Remove background: the model runs at its own input size and only the
+        # mask is scaled back up, to the working size
+        with stopwatch.stage('rembg'):
+            mask = segmentation_sessions.remove(working, only_mask=True)
+        return apply_cartoon(working, mask, avatar_size, output_format, stopwatch)
+    except Exception as e:
+        print(f"❌ Processing Error: {e}")
+        return None
+
+
+def cartoonify_many(images, avatar_size=(512, 512), output_format='png', stopwatch=None):
+    """``cartoonify_bytes`` for several encoded images, returning results in input order.
+
+    Decoding and the OpenCV stages (which release the GIL) run on a thread pool; the
+    background-removal model sees all decodable images in a single batched call.
+    A failed image yields None without affecting the others. Per-image stage times
+    are summed in ``stopwatch``.
+    """
+    stopwatch = stopwatch or Stopwatch()
+
+    def load(image_bytes):
+        try:
+            with stopwatch.stage('decode'):
+                return load_working_image(image_bytes, None, avatar_size)
+        except Exception as e:
+            print(f"❌ Processing Error: {e}")
+            return None
+
+    def finish(working, mask):
+        try:
+            return apply_cartoon(working, mask, avatar_size, output_format, stopwatch)
+        except Exception as e:
+            print(f"❌ Processing Error: {e}")
+            return None
+
+    workings = list(stage_threads.map(load, images))
+    loaded = [i for i, working in enumerate(workings) if working is not None]
+    results = [None] * len(images)
+    try:
+        with stopwatch.stage('rembg'):
+            masks = segmentation_sessions.masks([workings[i] for i in loaded])
+    except Exception as e:
+        print(f"❌ Processing Error: {e}")
+        return results
+    for i, result in zip(loaded, stage_threads.map(finish, [workings[i] for i in loaded], masks)):
+        results[i] = result
+    return results
+
+
+def process_image(image_path, crop_coords=None, avatar_size=(512, 512)):
+    """Process the image: remove background and apply cartoon effect."""
+    with open(image_path, "rb") as img_file:
+        result = cartoonify_bytes(img_file.read(), crop_coords, avatar_size)
+    return base64.b64encode(result).decode('utf-8') if result else None
+
+
+# --- Job Worker Entry Points ---
+def init_worker():
+    """Process-pool initializer: load and warm this worker's model before any job arrives."""
+    segmentation_sessions.warm_up()
+
+
+def worker_ready():
+    """No-op job the queue submits once per worker at start-up; runs after ``init_worker``."""
+    return os.getpid()
+
+
+def run_job(image_bytes, crop_coords=None, avatar_size=(512, 512), output_format='png'):
+    """Run ``cartoonify_bytes`` in a pool worker, reporting when it started and what it cost.
+
+    CPU time is the whole process's, so it includes the model's threads (and is
+    only approximate when jobs share a process). Peak RSS is the worker's high-water
+    mark; ``stages`` holds the seconds spent decoding, in rembg, in OpenCV and encoding.
+    """
+    return _measured(cartoonify_bytes, image_bytes, crop_coords, avatar_size, output_format)
+
+
+def run_batch_job(images, avatar_size=(512, 512), output_format='png'):
+    """Run ``cartoonify_many`` in a pool worker; ``result`` is the list of per-image outputs."""
+    return _measured(cartoonify_many, images, avatar_size, output_format)
+
+
+def _measured(fn, *args):
+    started_at = time.time()
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    stopwatch = Stopwatch()
+    result = fn(*args, stopwatch=stopwatch)
+    output = {"result": result, "started_at": started_at, "processing_seconds": time.perf_counter() - started,
+              "cpu_seconds": time.process_time() - cpu_started, "worker_pid": os.getpid(),
+              "stages": stopwatch.seconds}
+    if os.name != 'nt':
+        # ru_maxrss is kilobytes on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        output["worker_peak_rss_mb"] = round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+    return output
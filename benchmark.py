@@ -0,0 +1,507 @@
+"""Load-test the recommender and avatar services against synthetic data.
+
+    python benchmark.py run [--scales 1,10,100,1000] [--fanout 3] [--scenarios ...] [--output FILE]
+    python benchmark.py compare OLD.json NEW.json
+
+For each scale a workspace is generated under --work-dir (and reused by later runs
+with the same parameters): a rule sheet with the 12 columns of dataset.xlsx and
+``scale`` times its rows, whose outfit cells hold comma lists of up to ``fanout``
+values, plus a feedback log, an uploads directory and a few 12MP test photos.
+
+Every (scale, scenario) pair runs in a fresh interpreter started inside the
+workspace, so module-level state, caches and peak RSS are measured per run and the
+services see the synthetic files exactly where they expect dataset.xlsx,
+user_feedback.csv and uploads/. Results are JSON records (p50/p95/p99 latency,
+throughput, start-up time and peak RSS) tagged with the git revision, so runs on
+different commits can be compared with ``compare``.
+"""
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+if os.name != 'nt':
+    import resource
+
+# Sheet headers, as listed in column_names.txt.
+SHEET_COLUMNS = ['Event Name', 'Gender', 'Time', 'OutfitType', 'Dress Type', 'Dress Color',
+                 'Dress Fabric/Texture', 'Shoes Type', 'Shoes Color', 'Upper layer',
+                 'Upper layer color', 'Weather Range']
+CONTEXT_COLUMNS = ('event_name', 'gender', 'time', 'outfittype', 'weather_range')
+# Columns of user_feedback.csv, as api.FEEDBACK_FIELDS writes them.
+FEEDBACK_FIELDS = ["Dress Type", "Dress Color", "Dress Fabric/Texture", "Shoes Type", "Shoes Color",
+                   "Upper Layer", "Upper Layer Color", "image_url", "user_id", "feedback_type"]
+
+SCENARIOS = ('get_recommendations', 'api_recommend', 'api_batch', 'api_capsule', 'process_image', 'cartoonify')
+# Requests per scenario unless --requests overrides it; the image paths are far slower.
+DEFAULT_REQUESTS = {'get_recommendations': 500, 'api_recommend': 300, 'api_batch': 20, 'api_capsule': 20,
+                    'process_image': 8, 'cartoonify': 8}
+BATCH_DAYS = 30
+# Owned items per slot in the api_capsule inventories.
+CAPSULE_ITEMS = 15
+PHOTO_SIZE = (3024, 4032)
+
+# Bump when the generated data changes so stale workspaces are rebuilt.
+WORKSPACE_FORMAT = 1
+
+
+# --- Synthetic Data ---
+def read_base_sheet(path):
+    from dataset_loader import read_rule_sheet
+    df = read_rule_sheet(path)
+    if df.empty:
+        sys.exit(f"Cannot generate synthetic data: '{path}' produced an empty dataset.")
+    return df
+
+
+def column_vocab(df, column):
+    from rule_engine import split_and_strip
+    values = {item for cell in df[column] for item in split_and_strip(cell)}
+    return sorted(values) or ['N/A']
+
+
+def generate_sheet(base, path, num_rows, fanout, rng):
+    """Write ``num_rows`` rule rows: context cells copied from random base rows, outfit
+    cells as comma lists of 1..``fanout`` values drawn from that column's vocabulary."""
+    import pandas as pd
+    from rule_engine import OUTFIT_COLUMNS
+    headers = dict(zip(['event_name', 'gender', 'time', 'outfittype', *OUTFIT_COLUMNS, 'weather_range'], SHEET_COLUMNS))
+    np_rng = np.random.default_rng(rng.getrandbits(64))
+    picks = np_rng.integers(0, len(base), num_rows)
+    columns = {}
+    for column in CONTEXT_COLUMNS:
+        columns[headers[column]] = base[column].to_numpy()[picks] if column in base.columns else [''] * num_rows
+    for column in OUTFIT_COLUMNS:
+        vocab = np.array(column_vocab(base, column), dtype=object)
+        counts = np_rng.integers(1, fanout + 1, num_rows)
+        values = vocab[np_rng.integers(0, len(vocab), int(counts.sum()))]
+        ends = np.cumsum(counts)
+        columns[headers[column]] = [', '.join(values[end - n:end]) for n, end in zip(counts.tolist(), ends.tolist())]
+    pd.DataFrame({header: columns[header] for header in SHEET_COLUMNS}).to_excel(path, index=False)
+
+
+def generate_feedback(base, path, num_rows, rng, rejected_share=0.3):
+    """Feedback log in the format /feedback appends: anonymous verdicts without images."""
+    from rule_engine import OUTFIT_COLUMNS
+    vocabs = [column_vocab(base, column) for column in OUTFIT_COLUMNS]
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(FEEDBACK_FIELDS)
+        for _ in range(num_rows):
+            outfit = [rng.choice(vocab) for vocab in vocabs]
+            writer.writerow(outfit + ['', '', 'rejected' if rng.random() < rejected_share else 'accepted'])
+
+
+def synthetic_photo(size, rng):
+    """A smooth RGB test photo (blurred sine gradients), so it compresses roughly like a real one."""
+    from PIL import Image, ImageFilter
+    width, height = size
+    small = (max(1, width // 16), max(1, height // 16))
+    y, x = np.mgrid[0:small[1], 0:small[0]]
+    channels = []
+    for _ in range(3):
+        fx, fy, phase = rng.uniform(0.5, 3), rng.uniform(0.5, 3), rng.uniform(0, 6.3)
+        channels.append(127 + 100 * np.sin(fx * x / small[0] * 6.3 + phase) * np.cos(fy * y / small[1] * 6.3))
+    image = Image.fromarray(np.dstack(channels).clip(0, 255).astype(np.uint8))
+    image = image.resize(size, Image.Resampling.BICUBIC).filter(ImageFilter.GaussianBlur(2))
+    return image
+
+
+def generate_uploads(base, directory, num_files, rng, matching_share=0.5):
+    """Item images named after sheet values (so lookups hit) mixed with unrelated files."""
+    from rule_engine import OUTFIT_COLUMNS
+    from werkzeug.utils import secure_filename
+    os.makedirs(directory, exist_ok=True)
+    values = sorted({value for column in OUTFIT_COLUMNS for value in column_vocab(base, column) if value != 'N/A'})
+    tile = synthetic_photo((256, 256), rng)
+    for i in range(num_files):
+        if values and rng.random() < matching_share:
+            name = secure_filename(f"{rng.choice(values)}_{i}.jpg") or f"item_{i}.jpg"
+        else:
+            name = f"upload_{i}.{rng.choice(['jpg', 'png', 'webp'])}"
+        tile.rotate(rng.choice([0, 90, 180, 270])).save(os.path.join(directory, name))
+
+
+def sample_contexts(base, num_contexts, rng):
+    """Request contexts: half taken from sheet rows (Tier 1 hits), half mixed at random."""
+    from rule_engine import split_and_strip
+    pools = {column: column_vocab(base, column) for column in ('event_name', 'outfittype', 'time')}
+    contexts = []
+    for i in range(num_contexts):
+        row = base.iloc[rng.randrange(len(base))]
+        if i % 2 == 0:
+            pick = lambda column: (split_and_strip(row[column]) or [''])[0]
+            event, outfit, time_of_day = pick('event_name'), pick('outfittype'), pick('time')
+            weather = (split_and_strip(row['weather_range']) or ['20-30'])[0]
+            low = int(''.join(ch for ch in weather.split('-')[0] if ch.isdigit()) or 25)
+            temperature = low + 5 if '-' in weather else low + 2
+            gender = str(row['gender']).strip().lower()
+            gender = gender if gender in ('male', 'female') else rng.choice(['male', 'female'])
+        else:
+            event, outfit, time_of_day = (rng.choice(pools[c]) for c in ('event_name', 'outfittype', 'time'))
+            temperature = rng.randint(0, 45)
+            gender = rng.choice(['male', 'female'])
+        contexts.append({"weather": f"{temperature}°C", "gender": gender,
+                         "event": event, "outfit": outfit, "time": time_of_day})
+    return contexts
+
+
+def prepare_workspace(args, scale):
+    """Generate (or reuse) the synthetic files for ``scale``; returns the workspace path and its manifest."""
+    name = f"scale{scale}-fanout{args.fanout}-seed{args.seed}"
+    workspace = os.path.join(args.work_dir, name)
+    manifest_path = os.path.join(workspace, 'manifest.json')
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get("format") == WORKSPACE_FORMAT and manifest.get("params") == workspace_params(args, scale):
+            return workspace, manifest
+    except (OSError, ValueError):
+        pass
+
+    rng = random.Random(f"{args.seed}:{scale}")
+    base = read_base_sheet(args.base)
+    num_rows = len(base) * scale
+    os.makedirs(workspace, exist_ok=True)
+    log(f"Generating workspace {name}: {num_rows} rows, {args.feedback_per_scale * scale} feedback rows, "
+        f"{args.uploads} uploads")
+    started = time.perf_counter()
+    generate_sheet(base, os.path.join(workspace, 'dataset.xlsx'), num_rows, args.fanout, rng)
+    generate_feedback(base, os.path.join(workspace, 'user_feedback.csv'), args.feedback_per_scale * scale, rng)
+    generate_uploads(base, os.path.join(workspace, 'uploads'), args.uploads, rng)
+    photos = os.path.join(workspace, 'photos')
+    os.makedirs(photos, exist_ok=True)
+    for i in range(args.photos):
+        synthetic_photo(PHOTO_SIZE, rng).save(os.path.join(photos, f"photo_{i}.jpg"), quality=90)
+    with open(os.path.join(workspace, 'contexts.json'), 'w') as f:
+        json.dump(sample_contexts(base, args.contexts, rng), f)
+
+    # Snapshot the sheet the way a deploy would, timing the openpyxl parse on the way
+    parse_started = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(REPO_DIR, 'dataset_loader.py'), 'dataset.xlsx'],
+                   cwd=workspace, check=True, stdout=subprocess.DEVNULL)
+    manifest = {"format": WORKSPACE_FORMAT, "params": workspace_params(args, scale), "rows": num_rows,
+                "sheet_parse_seconds": round(time.perf_counter() - parse_started, 3),
+                "generate_seconds": round(time.perf_counter() - started, 3)}
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return workspace, manifest
+
+
+def workspace_params(args, scale):
+    return {"base": os.path.abspath(args.base), "scale": scale, "fanout": args.fanout, "seed": args.seed,
+            "feedback_rows": args.feedback_per_scale * scale, "uploads": args.uploads,
+            "photos": args.photos, "contexts": args.contexts}
+
+
+# --- Scenario Runner (inside the workspace) ---
+def peak_rss_mb(who=None):
+    if os.name == 'nt':
+        return None
+    # ru_maxrss is kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF if who is None else who).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def percentile_ms(latencies, q):
+    return round(float(np.percentile(latencies, q)) * 1000, 3) if latencies else None
+
+
+def measure(call, payloads, concurrency):
+    """Run ``call`` over ``payloads``; returns per-call latencies, wall time and errors.
+
+    ``call`` returns None on success or a short error description.
+    """
+    def timed(payload):
+        started = time.perf_counter()
+        try:
+            error = call(payload)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        return time.perf_counter() - started, error
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            outcomes = list(pool.map(timed, payloads))
+    else:
+        outcomes = [timed(payload) for payload in payloads]
+    wall = time.perf_counter() - started
+    return [latency for latency, _ in outcomes], wall, [error for _, error in outcomes if error]
+
+
+def recommend_scenario(scenario, contexts, num_requests, rng):
+    import api
+    if scenario == 'get_recommendations':
+        payloads = [rng.choice(contexts) for _ in range(num_requests)]
+
+        def call(ctx):
+            api.get_recommendations(ctx["weather"], ctx["gender"], ctx["event"], ctx["outfit"], ctx["time"])
+        return call, payloads
+
+    client = api.app.test_client()
+    if scenario == 'api_recommend':
+        payloads = [rng.choice(contexts) for _ in range(num_requests)]
+
+        def call(ctx):
+            response = client.post('/recommend', json=ctx)
+            if response.status_code != 200:
+                return f"HTTP {response.status_code}"
+            if not all(field in rec for rec in response.get_json() for field in api.OUTFIT_FIELDS[:7]):
+                return "malformed recommendation"
+        return call, payloads
+
+    if scenario == 'api_capsule':
+        # A month of days and a wardrobe drawn from the sheet's own item values
+        from capsule_planner import SLOTS
+        from rule_engine import OUTFIT_COLUMNS
+        vocab = api.dataset.candidate_store.vocab
+
+        def inventory():
+            return [{"id": f"{slot}-{i}", "slot": slot,
+                     **dict(zip(('type', 'color', 'fabric'), (rng.choice(vocab[OUTFIT_COLUMNS.index(c)]) for c in columns)))}
+                    for slot, columns in SLOTS.items() for i in range(CAPSULE_ITEMS)]
+        payloads = [{"inventory": inventory(), "days": [rng.choice(contexts) for _ in range(BATCH_DAYS)]}
+                    for _ in range(num_requests)]
+
+        def call(body):
+            response = client.post('/capsule/plan', json=body)
+            if response.status_code != 200:
+                return f"HTTP {response.status_code}"
+        return call, payloads
+
+    # A month of days per request, as the calendar screen plans it
+    payloads = [{"contexts": [rng.choice(contexts) for _ in range(BATCH_DAYS)], "avoid_repeats": True}
+                for _ in range(num_requests)]
+
+    def call(body):
+        response = client.post('/recommend/batch', json=body)
+        if response.status_code != 200:
+            return f"HTTP {response.status_code}"
+    return call, payloads
+
+
+def unique_photo(data, i):
+    """``data`` with bytes appended after the JPEG end marker, so content-addressed caches miss."""
+    return data + f"bench-{i}-{time.time_ns()}".encode()
+
+
+def image_scenario(scenario, photos, num_requests):
+    if scenario == 'process_image':
+        from avatar_pipeline import process_image
+        payloads = [photos[i % len(photos)] for i in range(num_requests)]
+
+        def call(path):
+            if process_image(path) is None:
+                return "process_image returned None"
+        return call, payloads, None
+
+    import app
+    client = app.app.test_client()
+    photo_bytes = []
+    for path in photos:
+        with open(path, 'rb') as f:
+            photo_bytes.append(f.read())
+    # The service keeps a copy of each upload; reusing the photo names keeps uploads/ the same size
+    payloads = [(os.path.basename(photos[i % len(photos)]), unique_photo(photo_bytes[i % len(photos)], i))
+                for i in range(num_requests)]
+
+    def call(payload):
+        from io import BytesIO
+        name, data = payload
+        response = client.post('/cartoonify?response=binary', data={"image": (BytesIO(data), name)},
+                               content_type='multipart/form-data')
+        if response.status_code != 200:
+            return f"HTTP {response.status_code}: {response.get_data(as_text=True)[:120]}"
+
+    def cleanup():
+        app.cartoonify_jobs.shutdown(wait=True)
+        app.upload_writer.shutdown(wait=True)
+    return call, payloads, cleanup
+
+
+def run_scenario(options):
+    """Child-process entry point: import the service, run one scenario, write one JSON record."""
+    os.chdir(options.workspace)
+    sys.path.insert(0, REPO_DIR)
+    os.environ.setdefault('DATASET_RELOAD_INTERVAL', '0')
+    rng = random.Random(f"{options.seed}:{options.scenario}")
+    record = {"scenario": options.scenario, "requests": options.requests, "concurrency": options.concurrency}
+
+    started = time.perf_counter()
+    cleanup = None
+    if options.scenario in ('process_image', 'cartoonify'):
+        photos = sorted(os.path.join('photos', name) for name in os.listdir('photos'))
+        call, payloads, cleanup = image_scenario(options.scenario, photos, options.requests)
+    else:
+        with open('contexts.json') as f:
+            contexts = json.load(f)
+        call, payloads = recommend_scenario(options.scenario, contexts, options.requests, rng)
+    record["startup_seconds"] = round(time.perf_counter() - started, 3)
+    record["startup_peak_rss_mb"] = peak_rss_mb()
+
+    latencies, wall, errors = measure(call, payloads, options.concurrency)
+    if cleanup is not None:
+        cleanup()
+    record.update({
+        "errors": len(errors),
+        "error_sample": errors[0] if errors else None,
+        "p50_ms": percentile_ms(latencies, 50),
+        "p95_ms": percentile_ms(latencies, 95),
+        "p99_ms": percentile_ms(latencies, 99),
+        "mean_ms": round(float(np.mean(latencies)) * 1000, 3) if latencies else None,
+        "max_ms": round(max(latencies) * 1000, 3) if latencies else None,
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(len(latencies) / wall, 2) if wall else None,
+        "peak_rss_mb": peak_rss_mb(),
+    })
+    if os.name != 'nt':
+        # Worker processes (the cartoonify pool) once they have exited
+        record["children_peak_rss_mb"] = peak_rss_mb(resource.RUSAGE_CHILDREN)
+    with open(options.result_file, 'w') as f:
+        json.dump(record, f)
+
+
+# --- Orchestration ---
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def git_revision():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True,
+                                  check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_DIR,
+                               capture_output=True, text=True).stdout.strip()
+        return f"{revision}{'-dirty' if dirty else ''}"
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    scales = [int(s) for s in args.scales.split(',')]
+    scenarios = args.scenarios.split(',')
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        sys.exit(f"Unknown scenario(s) {', '.join(unknown)}; choose from {', '.join(SCENARIOS)}")
+    os.makedirs(args.work_dir, exist_ok=True)
+    results = []
+    for scale in scales:
+        workspace, manifest = prepare_workspace(args, scale)
+        for scenario in scenarios:
+            num_requests = args.requests or DEFAULT_REQUESTS[scenario]
+            result_file = os.path.join(workspace, f"result-{scenario}.json")
+            command = [sys.executable, os.path.abspath(__file__), '_scenario', '--workspace', workspace,
+                       '--scenario', scenario, '--requests', str(num_requests), '--concurrency',
+                       str(args.concurrency), '--seed', str(args.seed), '--result-file', result_file]
+            log(f"scale {scale} ({manifest['rows']} rows): {scenario} x{num_requests}")
+            completed = subprocess.run(command, stdout=None if args.verbose else subprocess.DEVNULL,
+                                       stderr=None if args.verbose else subprocess.PIPE, text=True)
+            if completed.returncode != 0:
+                record = {"scenario": scenario, "failed": True,
+                          "error_sample": (completed.stderr or '').strip().splitlines()[-1:] or None}
+            else:
+                with open(result_file) as f:
+                    record = json.load(f)
+            record.update({"scale": scale, "rows": manifest["rows"], "fanout": args.fanout,
+                           "sheet_parse_seconds": manifest["sheet_parse_seconds"]})
+            results.append(record)
+            log(summary_line(record))
+
+    report = {
+        "meta": {
+            "git_revision": git_revision(),
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": {k: v for k, v in vars(args).items() if k != 'command'},
+        },
+        "results": results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    log(f"Wrote {len(results)} results to {args.output}")
+
+
+def summary_line(record):
+    if record.get("failed"):
+        return f"  FAILED: {record.get('error_sample')}"
+    return (f"  p50 {record['p50_ms']} ms, p95 {record['p95_ms']} ms, p99 {record['p99_ms']} ms, "
+            f"{record['throughput_rps']} req/s, peak RSS {record['peak_rss_mb']} MB, "
+            f"start-up {record['startup_seconds']} s, errors {record['errors']}")
+
+
+def compare(args):
+    """Print p95 latency, throughput and peak RSS of two result files side by side."""
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    key = lambda r: (r["scale"], r["scenario"])
+    before = {key(r): r for r in old["results"] if not r.get("failed")}
+    print(f"{old['meta'].get('git_revision')} -> {new['meta'].get('git_revision')}")
+    for record in new["results"]:
+        previous = before.get(key(record))
+        if previous is None or record.get("failed"):
+            continue
+        cells = []
+        for metric in ('p95_ms', 'throughput_rps', 'peak_rss_mb'):
+            a, b = previous.get(metric), record.get(metric)
+            change = f" ({(b - a) / a:+.0%})" if a and b is not None else ''
+            cells.append(f"{metric} {a} -> {b}{change}")
+        print(f"scale {record['scale']:>5} {record['scenario']:<20} " + ', '.join(cells))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='generate workspaces and run scenarios')
+    run_parser.add_argument('--scales', default='10,100,1000', help='comma-separated row multipliers of the base sheet')
+    run_parser.add_argument('--fanout', type=int, default=3, help='maximum values per comma-list outfit cell')
+    run_parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    run_parser.add_argument('--requests', type=int, default=0, help='requests per scenario (default: per scenario)')
+    run_parser.add_argument('--concurrency', type=int, default=1, help='threads issuing requests')
+    run_parser.add_argument('--contexts', type=int, default=64, help='distinct request contexts to draw from')
+    run_parser.add_argument('--feedback-per-scale', type=int, default=100, help='feedback rows per unit of scale')
+    run_parser.add_argument('--uploads', type=int, default=500, help='files in the synthetic uploads directory')
+    run_parser.add_argument('--photos', type=int, default=4, help='12MP test photos for the image scenarios')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--base', default=os.path.join(REPO_DIR, 'dataset.xlsx'), help='sheet to scale up')
+    run_parser.add_argument('--work-dir', default=os.path.join(REPO_DIR, '.benchmark'))
+    run_parser.add_argument('--output', default='benchmark_results.json')
+    run_parser.add_argument('--verbose', action='store_true', help="show the services' own output")
+
+    compare_parser = commands.add_parser('compare', help='compare two result files')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+
+    scenario_parser = commands.add_parser('_scenario')
+    for option in ('--workspace', '--scenario', '--result-file'):
+        scenario_parser.add_argument(option, required=True)
+    scenario_parser.add_argument('--requests', type=int, required=True)
+    scenario_parser.add_argument('--concurrency', type=int, default=1)
+    scenario_parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        run(args)
+    elif args.command == 'compare':
+        compare(args)
+    else:
+        run_scenario(args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,293 @@
+"""Plan a small capsule of owned items that dresses every day of a date range.
+
+An owned item fits a rule row when the row lists its type and colour (and fabric,
+if known); rows with no colour or fabric accept any. A day is a recommendation
+context, and an outfit of one dress, one pair of shoes and an optional upper layer
+fits it when one row of the day's strict context fits all of its items (Tier 1).
+Failing that, as in the recommender's Tier 2 and 3, each item only has to fit some
+row of its half of the context (event for the dress, weather for the rest), and
+then some row of the gender slice.
+
+Per distinct day context the caller builds ``feasible[i, j, k]`` over dress, shoes
+and upper-layer indices of the inventory (the last upper-layer index means none)
+from the first tier that yields any outfit. Choosing the capsule is then a weighted
+set cover with days as the universe: each step adds the outfit whose new items
+cover the most uncovered days per item added, ties going to the better colour score. Seeding the cover with a previous capsule makes a
+re-plan incremental: days it still covers cost nothing and keep their outfits.
+"""
+from collections import Counter
+
+import numpy as np
+
+from color_scoring import ColorScorer, normalize_color
+from rule_engine import OUTFIT_COLUMNS
+
+# Inventory slots and the outfit attributes an item of each slot fills (type, colour[, fabric]).
+SLOTS = {
+    'dress': ('dress_type', 'dress_color', 'dress_fabric_texture'),
+    'shoes': ('shoes_type', 'shoes_color'),
+    'upper_layer': ('upper_layer', 'upper_layer_color'),
+}
+# Bounds the (dress x shoes x upper layer) tensor built per day context.
+MAX_SLOT_ITEMS = 50
+# Rule rows multiplied out at once when building a Tier 1 tensor.
+ROW_BLOCK = 1024
+# Normalized cells meaning "nothing here": such rows accept any colour or fabric, and
+# an upper-layer cell like this lets the outfit go without one.
+NONE_VALUES = frozenset({'', 'n/a', 'na', 'nan', 'none', 'no'})
+
+
+def normalize_value(value):
+    """Case- and separator-insensitive form of a sheet or inventory value ('Light-Grey' -> 'light gray')."""
+    return normalize_color(value).lower() if isinstance(value, str) else ''
+
+
+# --- Item Matching ---
+class ItemMatcher:
+    """Which rule rows accept an item, from per-attribute postings of normalized values.
+
+    Built once per dataset from the ``CandidateStore`` CSR arrays, so spelling variants
+    in the sheet ('Shalwar-Kameez', 'Shalwar Kameez') share one posting list.
+    """
+
+    def __init__(self, candidate_store):
+        self.num_rows = candidate_store.num_rows
+        self.postings = {}
+        self.unconstrained = {}
+        for column in {column for columns in SLOTS.values() for column in columns}:
+            a = OUTFIT_COLUMNS.index(column)
+            names = [normalize_value(value) for value in candidate_store.vocab[a]]
+            name_ids = {}
+            code_names = np.array([name_ids.setdefault(name, len(name_ids)) for name in names], dtype=np.int64)
+            keys = code_names[np.asarray(candidate_store.codes[a])]
+            rows = np.repeat(np.arange(self.num_rows, dtype=np.int32), np.asarray(candidate_store.lengths[a]))
+            order = np.argsort(keys, kind='stable')
+            bounds = np.searchsorted(keys[order], np.arange(len(name_ids) + 1))
+            sorted_rows = rows[order]
+            self.postings[column] = {name: sorted_rows[bounds[i]:bounds[i + 1]] for name, i in name_ids.items()}
+            unconstrained = np.zeros(self.num_rows, dtype=bool)
+            for name in NONE_VALUES & name_ids.keys():
+                unconstrained[self.postings[column][name]] = True
+            self.unconstrained[column] = unconstrained
+
+    def rows_listing(self, column, value, required=True):
+        """Mask of rows whose ``column`` lists ``value``; unless ``required``, rows listing nothing match too."""
+        mask = np.zeros(self.num_rows, dtype=bool)
+        posting = self.postings[column].get(normalize_value(value))
+        if posting is not None:
+            mask[posting] = True
+        if not required:
+            mask |= self.unconstrained[column]
+        return mask
+
+    def item_rows(self, slot, item):
+        """Mask of rows ``item`` (an Inventory entry of ``slot``) fits."""
+        columns = SLOTS[slot]
+        mask = self.rows_listing(columns[0], item['type']) & self.rows_listing(columns[1], item['color'], required=False)
+        if len(columns) > 2 and normalize_value(item.get('fabric')) not in NONE_VALUES:
+            mask &= self.rows_listing(columns[2], item['fabric'], required=False)
+        return mask
+
+    def inventory_rows(self, inventory):
+        """``InventoryRows`` of ``inventory``; the upper layers gain a trailing "none" entry."""
+        masks = [np.array([self.item_rows(slot, item) for item in inventory.items[slot]], dtype=bool).reshape(-1, self.num_rows)
+                 for slot in SLOTS]
+        masks[2] = np.vstack([masks[2], self.unconstrained['upper_layer']])
+        return InventoryRows(masks)
+
+
+class InventoryRows:
+    """Rule rows each owned item fits, per slot (dress, shoes, upper layer).
+
+    ``masks`` are (items, rows) booleans for gathering a context's few strict rows;
+    ``lists`` hold each item's rows as a sorted array, for testing the large row sets
+    of Tiers 2 and 3 at a cost that follows the item's rows rather than the set's.
+    """
+
+    def __init__(self, masks):
+        self.masks = masks
+        self.lists = [[np.flatnonzero(item) for item in mask] for mask in masks]
+        self.num_rows = masks[0].shape[1]
+
+
+# --- Inventory ---
+class Inventory:
+    """A user's owned items grouped by slot, validated from the request body.
+
+    Each item is ``{"id", "slot", "type", "color", "fabric"}``; only slot and type are
+    required, and a missing id becomes ``"<slot>-<n>"``.
+    """
+
+    def __init__(self, items):
+        if not isinstance(items, list):
+            raise ValueError("inventory must be a list of items")
+        self.items = {slot: [] for slot in SLOTS}
+        seen_ids = set()
+        for n, item in enumerate(items):
+            if not isinstance(item, dict):
+                raise ValueError("Each inventory item must be an object")
+            slot = item.get('slot')
+            if slot not in SLOTS:
+                raise ValueError(f"Item slot must be one of {', '.join(SLOTS)}")
+            if not isinstance(item.get('type'), str) or not item['type'].strip():
+                raise ValueError("Each inventory item needs a type")
+            item_id = str(item.get('id') or f"{slot}-{n}")
+            if item_id in seen_ids:
+                raise ValueError(f"Duplicate inventory item id '{item_id}'")
+            seen_ids.add(item_id)
+            self.items[slot].append({"id": item_id, "slot": slot, "type": item['type'],
+                                     "color": item.get('color') if isinstance(item.get('color'), str) else '',
+                                     "fabric": item.get('fabric') if isinstance(item.get('fabric'), str) else ''})
+        for slot, slot_items in self.items.items():
+            if len(slot_items) > MAX_SLOT_ITEMS:
+                raise ValueError(f"At most {MAX_SLOT_ITEMS} items per slot ({slot} has {len(slot_items)})")
+        # What the row masks depend on, for caching them
+        self.key = tuple(tuple((item['type'], item['color'], item['fabric']) for item in self.items[slot]) for slot in SLOTS)
+
+    @property
+    def shape(self):
+        return len(self.items['dress']), len(self.items['shoes']), len(self.items['upper_layer']) + 1
+
+    def index_of(self, slot, item_id):
+        for i, item in enumerate(self.items[slot]):
+            if item['id'] == item_id:
+                return i
+        return None
+
+    def outfit_scores(self):
+        """Colour score of every (dress, shoes, upper layer) index triple, shape ``self.shape``."""
+        vocab = [[] for _ in OUTFIT_COLUMNS]
+        for slot, columns in SLOTS.items():
+            vocab[OUTFIT_COLUMNS.index(columns[1])] = [item['color'] for item in self.items[slot]]
+        # No upper layer: a missing colour, left out of the score
+        vocab[OUTFIT_COLUMNS.index('upper_layer_color')].append('N/A')
+        grid = np.indices(self.shape).reshape(3, -1)
+        codes = np.zeros((grid.shape[1], len(OUTFIT_COLUMNS)), dtype=np.int64)
+        for slot, axis in zip(SLOTS, grid):
+            codes[:, OUTFIT_COLUMNS.index(SLOTS[slot][1])] = axis
+        return ColorScorer(vocab).score(codes).reshape(self.shape)
+
+
+# --- Feasibility ---
+def strict_feasibility(inventory_rows, rows):
+    """Outfits whose items all fit one row of ``rows`` (Tier 1), or None if there are none."""
+    dress, shoes, upper = (mask[:, rows] for mask in inventory_rows.masks)
+    # Only rows fitting some item of every slot take part, and each such row makes at least one outfit
+    keep = dress.any(axis=0) & shoes.any(axis=0) & upper.any(axis=0)
+    if not keep.any():
+        return None
+    dress, shoes, upper = dress[:, keep], shoes[:, keep], upper[:, keep]
+    shape = (len(dress), len(shoes), len(upper))
+    feasible = np.zeros(shape, dtype=bool)
+    for start in range(0, dress.shape[1], ROW_BLOCK):
+        block = slice(start, start + ROW_BLOCK)
+        # feasible[i, j, k] = any row fitting all three: (dress & shoes) pairs times upper layers
+        pairs = (dress[:, None, block] & shoes[None, :, block]).reshape(shape[0] * shape[1], -1).astype(np.float32)
+        feasible |= (pairs @ upper[:, block].T.astype(np.float32) > 0).reshape(shape)
+    return feasible
+
+
+def fitting_items(inventory_rows, rows):
+    """Per slot, which items fit at least one row of ``rows``."""
+    selected = np.zeros(inventory_rows.num_rows, dtype=bool)
+    selected[rows] = True
+    return tuple(np.array([selected[item].any() for item in lists], dtype=bool) for lists in inventory_rows.lists)
+
+
+def combined_feasibility(dress_fit, weather_fit):
+    """Outfits whose dress fits the dress half and the rest the weather half (Tier 2 and 3), or None."""
+    feasible = dress_fit[0][:, None, None] & weather_fit[1][None, :, None] & weather_fit[2][None, None, :]
+    return feasible if feasible.any() else None
+
+
+def coverable(feasible, chosen):
+    """For every outfit (i, j, k): can the day be dressed from the chosen items plus that outfit's?
+
+    The allowed items form a product of per-slot sets, so the check expands one axis at a time.
+    """
+    dress, shoes, upper = chosen
+    covered = feasible | feasible[dress].any(axis=0, keepdims=True)
+    covered = covered | covered[:, shoes].any(axis=1, keepdims=True)
+    return covered | covered[:, :, upper].any(axis=2, keepdims=True)
+
+
+def is_covered(feasible, chosen):
+    return bool(feasible[np.ix_(*chosen)].any())
+
+
+# --- Planning ---
+def choose_capsule(feasible, weights, scores, chosen):
+    """Greedy weighted set cover of the day contexts in ``feasible`` (None entries are skipped).
+
+    ``chosen`` holds one boolean mask per slot; it seeds the cover and is extended in place.
+    """
+    uncovered = [c for c, f in enumerate(feasible) if f is not None and not is_covered(f, chosen)]
+    while uncovered:
+        gain = np.zeros(scores.shape)
+        for c in uncovered:
+            gain += weights[c] * coverable(feasible[c], chosen)
+        cost = ((~chosen[0])[:, None, None].astype(np.int64) + (~chosen[1])[None, :, None]
+                + (~chosen[2])[None, None, :])
+        ratio = np.where(cost > 0, gain / np.maximum(cost, 1), 0.0).ravel()
+        best = ratio.max()
+        if best <= 0:
+            break
+        ties = np.flatnonzero(ratio >= best - 1e-9)
+        outfit = np.unravel_index(ties[np.argmax(scores.ravel()[ties])], scores.shape)
+        for mask, index in zip(chosen, outfit):
+            mask[index] = True
+        uncovered = [c for c in uncovered if not is_covered(feasible[c], chosen)]
+    return chosen
+
+
+def assign_outfits(day_feasible, chosen, scores, previous=()):
+    """One outfit per day from the capsule, or None where it cannot dress the day.
+
+    A day keeps its ``previous`` outfit while that still fits; otherwise it takes the
+    best-scoring outfit not worn the day before, preferring the least worn so far.
+    """
+    previous = list(previous) + [None] * (len(day_feasible) - len(previous))
+    worn = Counter()
+    outfits = []
+    last = None
+    for feasible, kept in zip(day_feasible, previous):
+        outfit = None
+        if feasible is not None:
+            if kept is not None and all(mask[i] for mask, i in zip(chosen, kept)) and feasible[kept]:
+                outfit = kept
+            else:
+                available = feasible & chosen[0][:, None, None] & chosen[1][None, :, None] & chosen[2][None, None, :]
+                options = [tuple(o) for o in np.argwhere(available).tolist()]
+                if options:
+                    outfit = min(options, key=lambda o: (o == last, worn[o], -scores[o]))
+        if outfit is not None:
+            worn[outfit] += 1
+        outfits.append(outfit)
+        last = outfit
+    return outfits
+
+
+def plan_capsule(inventory, day_classes, class_feasible, scores, seed_capsule=(), previous=()):
+    """Capsule and per-day outfits for days mapped to distinct contexts.
+
+    ``day_classes[d]`` indexes ``class_feasible`` (feasibility tensors, or None for days nothing fits).
+    ``seed_capsule`` (item ids) and ``previous`` (per-day index triples or None) come
+    from an earlier plan when re-planning. Returns ``(chosen masks, outfits)``.
+    """
+    chosen = [np.zeros(n, dtype=bool) for n in inventory.shape]
+    chosen[2][-1] = True  # going without an upper layer costs nothing
+    for item_id in seed_capsule:
+        for s, slot in enumerate(SLOTS):
+            index = inventory.index_of(slot, item_id)
+            if index is not None:
+                chosen[s][index] = True
+    weights = Counter(day_classes)
+    choose_capsule(class_feasible, [weights[c] for c in range(len(class_feasible))], scores, chosen)
+    outfits = assign_outfits([class_feasible[c] for c in day_classes], chosen, scores, previous)
+    # Drop items no day ended up wearing (a seeded item may no longer be needed)
+    used = [np.zeros(n, dtype=bool) for n in inventory.shape]
+    for outfit in outfits:
+        if outfit is not None:
+            for mask, index in zip(used, outfit):
+                mask[index] = True
+    return used, outfits
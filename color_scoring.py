@@ -0,0 +1,261 @@
+import math
+import random
+import re
+from itertools import count, product
+
+import numpy as np
+
+from rule_engine import OUTFIT_COLUMNS
+
+# --- Colour Rules (from capsule.ipynb) ---
+# Psychological attributes (Energy, Calmness, Professionalism)
+COLOR_PSYCHOLOGY = {
+    'Pink': (0.7, 0.7, 0.6),
+    'Light Pink': (0.6, 0.8, 0.5),
+    'Dark Pink': (0.7, 0.6, 0.7),
+    'Red': (0.9, 0.3, 0.7),
+    'Light Red': (0.8, 0.5, 0.6),
+    'Dark Red': (0.7, 0.6, 0.8),
+    'Blue': (0.6, 0.8, 0.9),
+    'Light Blue': (0.5, 0.9, 0.8),
+    'Dark Blue': (0.7, 0.7, 1.0),
+    'Green': (0.5, 0.8, 0.7),
+    'Light Green': (0.4, 0.9, 0.6),
+    'Dark Green': (0.6, 0.7, 0.8),
+    'Yellow': (0.9, 0.5, 0.5),
+    'Light Yellow': (0.8, 0.7, 0.6),
+    'Dark Yellow': (0.7, 0.6, 0.7),
+    'Orange': (0.8, 0.5, 0.6),
+    'Light Orange': (0.7, 0.7, 0.5),
+    'Dark Orange': (0.7, 0.6, 0.7),
+    'Purple': (0.7, 0.6, 0.8),
+    'Light Purple': (0.6, 0.8, 0.7),
+    'Dark Purple': (0.7, 0.7, 0.9),
+    'White': (0.5, 0.9, 0.9),
+    'Gray': (0.3, 0.8, 0.9),
+    'Light Gray': (0.4, 0.9, 0.8),
+    'Dark Gray': (0.3, 0.7, 1.0),
+    'Black': (0.2, 0.7, 1.0),
+    'Beige': (0.4, 0.9, 0.7),
+    'Light Beige': (0.3, 1.0, 0.6),
+    'Dark Beige': (0.4, 0.8, 0.8)
+}
+
+COMPLEMENTS = {
+    'Red': 'Green',
+    'Blue': 'Orange',
+    'Yellow': 'Purple',
+    'Green': 'Red',
+    'Orange': 'Blue',
+    'Purple': 'Yellow'
+}
+
+# Analogous colors (same color family)
+COLOR_FAMILIES = {
+    'Red': ['Pink', 'Red', 'Orange'],
+    'Blue': ['Blue', 'Light Blue', 'Dark Blue', 'Navy'],
+    'Green': ['Green', 'Light Green', 'Dark Green', 'Olive'],
+    'Neutral': ['Black', 'White', 'Gray', 'Beige', 'Brown', 'Tan']
+}
+
+
+def get_psychology(color):
+    base_color = color.split(' ')[-1]  # Handle 'Light/Dark' prefixes
+    return COLOR_PSYCHOLOGY.get(base_color, (0.5, 0.5, 0.7))
+
+
+def color_harmony(color1, color2):
+    base1 = color1.split(' ')[-1]
+    base2 = color2.split(' ')[-1]
+
+    # Check complements
+    if base1 in COMPLEMENTS and COMPLEMENTS[base1] == base2:
+        return 2.5
+    if base2 in COMPLEMENTS and COMPLEMENTS[base2] == base1:
+        return 2.5
+
+    for family in COLOR_FAMILIES.values():
+        if base1 in family and base2 in family:
+            return 2.0 if abs(family.index(base1) - family.index(base2)) == 1 else 1.8
+
+    # Light-Dark contrast
+    lightness1 = 0 if 'Light' in color1 else (1 if 'Dark' in color1 else 0.5)
+    lightness2 = 0 if 'Light' in color2 else (1 if 'Dark' in color2 else 0.5)
+    if abs(lightness1 - lightness2) > 0.6:
+        return 1.7
+
+    return 1.0  # Neutral combination
+
+
+def normalize_color(value):
+    """Sheet spellings ('light-Brown', 'Grey', 'off-white') in the notebook's form ('Light Brown', 'Gray')."""
+    words = [word.capitalize() for word in re.split(r'[\s\-_/]+', value.strip()) if word]
+    return ' '.join('Gray' if word in ('Grey', 'Greys') else word for word in words)
+
+
+# --- Outfit Scoring ---
+# The notebook scores shirt/pants/shoes/jacket; here the dress stands in for shirt and
+# pants (psychology weight 0.4 + 0.2), the upper layer for the jacket.
+COLOR_SLOTS = {'dress_color': 0.6, 'shoes_color': 0.1, 'upper_layer_color': 0.3}
+# Harmony terms: dress-shoes is the notebook's pants-shoes, dress-layer its shirt-jacket + jacket-pants.
+HARMONY_PAIRS = (('dress_color', 'shoes_color', 2.0), ('dress_color', 'upper_layer_color', 3.5))
+HUE_PENALTY = 0.3
+# Cells meaning "no item", e.g. an outfit without an upper layer; such slots are left out.
+MISSING_COLORS = frozenset({'', 'N/A', 'None', 'No'})
+
+
+def outfit_color_score(colors):
+    """Scalar score of a {slot: colour} outfit, the notebook's ``calculate_outfit_score`` adapted.
+
+    Reference implementation for ``ColorScorer``, which computes the same value in bulk.
+    """
+    present = {slot: normalize_color(color) for slot, color in colors.items()
+               if slot in COLOR_SLOTS and color not in MISSING_COLORS}
+    pair_weight = sum(w for a, b, w in HARMONY_PAIRS)
+    active = [(w, color_harmony(present[a], present[b])) for a, b, w in HARMONY_PAIRS if a in present and b in present]
+    # Scaled so outfits with a missing piece are comparable to complete ones
+    harmony = pair_weight * sum(w * h for w, h in active) / sum(w for w, _ in active) if active else pair_weight
+
+    weight = sum(COLOR_SLOTS[slot] for slot in present) or 1.0
+    energy, calm, professional = (sum(COLOR_SLOTS[slot] * get_psychology(color)[i] for slot, color in present.items()) / weight
+                                  if present else get_psychology('')[i] for i in range(3))
+
+    # Penalize too many same-hue colors
+    hues = [color.split(' ')[-1] for color in present.values()]
+    hue_penalty = (len(hues) - len(set(hues))) * HUE_PENALTY
+
+    mood_balance = 2.5 - abs(energy - 0.6) - abs(calm - 0.7)
+    return max(0.0, harmony * mood_balance * professional * 1.5 - hue_penalty)
+
+
+class ColorScorer:
+    """Scores outfits from precomputed tables over the dataset's colour vocabulary.
+
+    Built once per dataset from ``CandidateStore.vocab``: for each colour slot a
+    psychology matrix and hue ids, and for each harmony pair a matrix of
+    ``color_harmony`` values, so scoring N outfits is a few gathers over (N,) arrays.
+    Every table has one extra trailing entry for values outside the vocabulary, scored as missing.
+    """
+
+    def __init__(self, vocab):
+        self.attributes = {slot: OUTFIT_COLUMNS.index(slot) for slot in COLOR_SLOTS}
+        self.lookups = {}
+        self.psychology = {}
+        self.active = {}
+        self.hues = {}
+        names = {}
+        hue_ids = {}
+        missing = count(-1, -1)
+        for slot, attribute in self.attributes.items():
+            values = list(vocab[attribute]) + [None]
+            self.lookups[slot] = {value: code for code, value in enumerate(vocab[attribute])}
+            names[slot] = [normalize_color(v) if v is not None and v not in MISSING_COLORS else None for v in values]
+            self.active[slot] = np.array([name is not None for name in names[slot]])
+            self.psychology[slot] = np.array([get_psychology(name or '') for name in names[slot]])
+            # Missing colours get negative hue ids of their own so they never count as a repeat
+            self.hues[slot] = np.array([hue_ids.setdefault(name.split(' ')[-1], len(hue_ids)) if name else next(missing)
+                                        for name in names[slot]])
+        self.harmony = {}
+        for a, b, _ in HARMONY_PAIRS:
+            self.harmony[(a, b)] = np.array([[color_harmony(x, y) if x and y else 1.0 for y in names[b]]
+                                             for x in names[a]])
+
+    def encode(self, outfits):
+        """(N, 7) vocabulary codes for string outfit tuples; unknown values get the trailing code."""
+        codes = np.zeros((len(outfits), len(OUTFIT_COLUMNS)), dtype=np.int64)
+        for slot, attribute in self.attributes.items():
+            lookup, unknown = self.lookups[slot], len(self.lookups[slot])
+            codes[:, attribute] = [lookup.get(outfit[attribute], unknown) for outfit in outfits]
+        return codes
+
+    def encode_pools(self, pools):
+        """Per-attribute arrays mapping positions in Tier 2 ``pools`` to vocabulary codes.
+
+        ``codes[:, a] = pool_codes[a][candidates[:, a]]`` then turns ``pool_candidates``
+        output into input for ``score``. Non-colour attributes map to 0.
+        """
+        pool_codes = [np.zeros(len(pool), dtype=np.int64) for pool in pools]
+        for slot, attribute in self.attributes.items():
+            lookup, unknown = self.lookups[slot], len(self.lookups[slot])
+            pool_codes[attribute] = np.array([lookup.get(value, unknown) for value in pools[attribute]], dtype=np.int64)
+        return pool_codes
+
+    def score(self, codes):
+        """Scores for an (N, 7) array of vocabulary codes (``outfit_color_score`` for each row)."""
+        codes = np.asarray(codes)
+        slot_codes = {slot: codes[:, attribute] for slot, attribute in self.attributes.items()}
+        active = {slot: self.active[slot][c] for slot, c in slot_codes.items()}
+
+        pair_weight = sum(w for _, _, w in HARMONY_PAIRS)
+        weighted = np.zeros(len(codes))
+        weights = np.zeros(len(codes))
+        for a, b, w in HARMONY_PAIRS:
+            both = w * (active[a] & active[b])
+            weighted += both * self.harmony[(a, b)][slot_codes[a], slot_codes[b]]
+            weights += both
+        harmony = pair_weight * np.divide(weighted, weights, out=np.ones(len(codes)), where=weights > 0)
+
+        mood = np.zeros((len(codes), 3))
+        slot_weight = np.zeros(len(codes))
+        for slot, w in COLOR_SLOTS.items():
+            mood += (w * active[slot])[:, None] * self.psychology[slot][slot_codes[slot]]
+            slot_weight += w * active[slot]
+        default = np.array(get_psychology(''))
+        mood = np.where(slot_weight[:, None] > 0, mood / np.maximum(slot_weight, 1e-9)[:, None], default)
+        energy, calm, professional = mood[:, 0], mood[:, 1], mood[:, 2]
+
+        hues = [self.hues[slot][slot_codes[slot]] for slot in COLOR_SLOTS]
+        repeats = np.zeros(len(codes))
+        for j in range(1, len(hues)):
+            repeats += np.any([hues[j] == hues[i] for i in range(j)], axis=0)
+
+        mood_balance = 2.5 - np.abs(energy - 0.6) - np.abs(calm - 0.7)
+        return np.maximum(0.0, harmony * mood_balance * professional * 1.5 - repeats * HUE_PENALTY)
+
+
+# --- Ranked Selection ---
+# Chosen outfits differ from each other in at least this many attributes when possible.
+MIN_OUTFIT_DISTANCE = 2
+# Candidate outfits scored per request when a row set or pool product is too large to enumerate.
+SCORED_CANDIDATES = 2048
+
+
+def pool_candidates(pools, rng=random, num_candidates=SCORED_CANDIDATES):
+    """(N, len(pools)) index tuples into ``pools``: every combination if few enough, else random draws."""
+    sizes = [len(pool) for pool in pools]
+    if math.prod(sizes) <= num_candidates:
+        return np.array(list(product(*(range(n) for n in sizes))), dtype=np.int64).reshape(-1, len(pools))
+    np_rng = np.random.default_rng(rng.getrandbits(64))
+    return np.column_stack([np_rng.integers(0, n, num_candidates) for n in sizes])
+
+
+def select_top_scored(scores, k, decode, existing_outfits=(), rejection_set=frozenset(), rng=random,
+                      exclude=(), min_distance=MIN_OUTFIT_DISTANCE):
+    """Up to ``k`` new high-scoring outfits that differ from each other.
+
+    Walks candidates from best to worst score (ties in random order), taking one
+    only if it differs from every outfit taken so far, including ``existing_outfits``,
+    in at least ``min_distance`` attributes. If that leaves fewer than ``k``, the
+    best remaining ones are added regardless of distance. ``decode(i)`` returns
+    candidate ``i`` as a string tuple; rejected and excluded outfits are never returned.
+    """
+    order = np.arange(len(scores))
+    if len(order) > 1:
+        np.random.default_rng(rng.getrandbits(64)).shuffle(order)
+        order = order[np.argsort(-np.asarray(scores)[order], kind='stable')]
+    taken = [tuple(outfit) for outfit in existing_outfits]
+    seen = set(taken)
+    chosen, passed_over = [], []
+    for i in order.tolist():
+        if len(chosen) >= k:
+            break
+        outfit = decode(i)
+        if outfit in seen or outfit in rejection_set or outfit in exclude:
+            continue
+        seen.add(outfit)
+        if all(sum(x != y for x, y in zip(outfit, other)) >= min_distance for other in taken):
+            chosen.append(outfit)
+            taken.append(outfit)
+        elif len(passed_over) < k:
+            passed_over.append(outfit)
+    return chosen + passed_over[:k - len(chosen)]
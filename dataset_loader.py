@@ -0,0 +1,165 @@
+"""Load the rule dataset, using a pre-built binary snapshot when one is fresh.
+
+Parsing dataset.xlsx through openpyxl dominates API start-up, so the normalized
+rule table and the indexes built on top of it are pickled next to the sheet.
+Build the snapshot ahead of a deploy with:
+
+    python dataset_loader.py [dataset.xlsx]
+"""
+import os
+import pickle
+import re
+import sys
+
+import pandas as pd
+
+from rule_engine import CandidateStore, RuleIndex
+
+# Bump whenever the pickled structures change shape so old snapshots are ignored.
+SNAPSHOT_FORMAT = 1
+
+
+# --- Data Loading and Column Standardization ---
+def read_rule_sheet(file_path='dataset.xlsx'):
+    """Load and standardize the dataset."""
+    if not os.path.exists(file_path):
+        print(f"Error: The file '{file_path}' was not found.")
+        return pd.DataFrame()
+
+    try:
+        # Load Excel file
+        excel_data = pd.ExcelFile(file_path)
+
+        # Parse first sheet
+        df = excel_data.parse(excel_data.sheet_names[0])
+
+        if df.empty:
+            print("Warning: Dataset is empty")
+            return pd.DataFrame()
+
+        # Standardize column names
+        original_columns = df.columns.tolist()
+        df.columns = [re.sub(r'[^a-zA-Z0-9]+', '_', str(col)).lower().strip('_') for col in original_columns]
+
+        # Fill NaN values with empty string for string operations
+        string_columns = df.select_dtypes(include=['object']).columns
+        df[string_columns] = df[string_columns].fillna('')
+
+        return df
+
+    except Exception as e:
+        print(f"Error loading dataset: {str(e)}")
+        return pd.DataFrame()
+
+
+class RuleDataset:
+    """The normalized rule table together with the indexes the recommender queries."""
+
+    def __init__(self, rule_data):
+        self.rule_data = rule_data
+        self.source = None
+        self.rule_index = RuleIndex(rule_data)
+        self.candidate_store = CandidateStore(rule_data)
+
+    @property
+    def num_rows(self):
+        return self.candidate_store.num_rows
+
+    @property
+    def empty(self):
+        return self.num_rows == 0
+
+
+# --- Binary Snapshot ---
+def snapshot_path_for(file_path):
+    return os.path.splitext(file_path)[0] + '.snapshot.pkl'
+
+
+def source_stamp(file_path):
+    stat = os.stat(file_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def write_snapshot(dataset, file_path, source, snapshot_path=None):
+    """Pickle ``dataset`` for ``file_path``, replacing any old snapshot atomically.
+
+    ``source`` is the sheet's stamp taken before it was parsed. If the sheet has
+    changed since, the dataset is already stale and ValueError is raised instead,
+    so workers never trust old rows under the new sheet's stamp.
+    """
+    if source_stamp(file_path) != source:
+        raise ValueError(f"'{file_path}' changed while it was being parsed")
+    snapshot_path = snapshot_path or snapshot_path_for(file_path)
+    payload = {"format": SNAPSHOT_FORMAT, "source": source, "dataset": dataset}
+    tmp_path = f"{snapshot_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, snapshot_path)
+    return snapshot_path
+
+
+def read_snapshot(file_path, snapshot_path=None):
+    """The snapshotted dataset for ``file_path``, or None if missing or stale.
+
+    A snapshot is only trusted if it was built from a sheet with the same mtime and
+    size as the current one. Snapshots are pickles: only load files this service wrote.
+    """
+    snapshot_path = snapshot_path or snapshot_path_for(file_path)
+    try:
+        with open(snapshot_path, 'rb') as f:
+            payload = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"[WARNING] Ignoring unreadable dataset snapshot '{snapshot_path}': {e}")
+        return None
+    if payload.get("format") != SNAPSHOT_FORMAT or payload.get("source") != source_stamp(file_path):
+        return None
+    return payload["dataset"]
+
+
+def load_dataset(file_path='dataset.xlsx', use_snapshot=True):
+    """Load the dataset and its indexes, from the snapshot when it matches the sheet.
+
+    After a fresh parse the snapshot is rewritten (best effort) so the next worker
+    to start can skip openpyxl entirely.
+    """
+    source = source_stamp(file_path) if os.path.exists(file_path) else None
+    if use_snapshot and source is not None:
+        dataset = read_snapshot(file_path)
+        if dataset is not None:
+            dataset.source = source
+            print(f"Dataset loaded from snapshot with {len(dataset.rule_data)} rows.")
+            return dataset
+
+    dataset = RuleDataset(read_rule_sheet(file_path))
+    # Stamp of the sheet as it was before parsing, so an edit made meanwhile still looks new
+    dataset.source = source
+    if dataset.rule_data.empty:
+        return dataset
+    print(f"Dataset loaded successfully with {len(dataset.rule_data)} rows.")
+    if use_snapshot:
+        try:
+            write_snapshot(dataset, file_path, source)
+        except Exception as e:
+            print(f"[WARNING] Could not write dataset snapshot: {e}")
+    return dataset
+
+
+def main(argv):
+    source = argv[0] if argv else 'dataset.xlsx'
+    stamp = source_stamp(source) if os.path.exists(source) else None
+    built = RuleDataset(read_rule_sheet(source))
+    if built.rule_data.empty:
+        sys.exit(f"Nothing to snapshot: '{source}' produced an empty dataset.")
+    try:
+        snapshot_path = write_snapshot(built, source, stamp)
+    except ValueError as e:
+        sys.exit(f"Not writing a snapshot: {e}; run again.")
+    print(f"Wrote {snapshot_path} ({len(built.rule_data)} rows).")
+
+
+if __name__ == '__main__':
+    # Run through the importable module so pickled classes resolve in the API workers
+    import dataset_loader
+    dataset_loader.main(sys.argv[1:])
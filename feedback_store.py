@@ -0,0 +1,383 @@
+import atexit
+import csv
+import io
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+from instrumentation import request_logger
+
+if os.name != 'nt':
+    import fcntl
+
+# Refreshes run on request threads and the writer thread, so lines below warnings are sampled
+request_log = request_logger('groomify.feedback')
+
+
+# --- Rejection Index ---
+class RejectionIndex:
+    """In-process set of rejected outfits, kept in sync with the append-only feedback CSV.
+
+    The file is parsed once; afterwards ``refresh()`` stats it and only parses the bytes
+    appended since the last read. A rewrite (new inode, shrink, or same size with a new
+    mtime) falls back to a full reload. Rows carrying a ``user_field`` value are one
+    user's feedback and are left to the per-user store.
+    """
+
+    def __init__(self, path, key_fields, feedback_field='feedback_type', rejected_value='rejected',
+                 user_field='user_id'):
+        self.path = path
+        self.key_fields = list(key_fields)
+        self.feedback_field = feedback_field
+        self.rejected_value = rejected_value
+        self.user_field = user_field
+        self.rejected = set()
+        self._lock = threading.Lock()
+        self._header = None
+        self._offset = 0
+        self._identity = None
+        self._mtime = None
+        self._size = None
+
+    def __contains__(self, outfit):
+        return tuple(outfit) in self.rejected
+
+    def __len__(self):
+        return len(self.rejected)
+
+    def refresh(self):
+        """Pick up new feedback rows. Returns True if the rejection set changed."""
+        with self._lock:
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                changed = bool(self.rejected)
+                self._reset()
+                return changed
+            if (stat.st_mtime_ns, stat.st_size) == (self._mtime, self._size):
+                return False
+
+            identity = (stat.st_dev, stat.st_ino)
+            previous = self.rejected
+            if identity != self._identity or stat.st_size < self._offset or stat.st_size == self._size:
+                self._reset()
+                self._identity = identity
+            self._read_tail()
+            self._mtime, self._size = stat.st_mtime_ns, stat.st_size
+            changed = self.rejected is not previous and self.rejected != previous
+            if changed:
+                request_log.info("Loaded %d rejected outfits for filtering.", len(self.rejected))
+            return changed
+
+    def _reset(self):
+        self.rejected = set()
+        self._header = None
+        self._offset = 0
+        self._identity = None
+        self._mtime = self._size = None
+
+    def _read_tail(self):
+        with open(self.path, 'rb') as f:
+            f.seek(self._offset)
+            chunk = f.read()
+        # Leave a partially written last line for the next refresh
+        end = chunk.rfind(b'\n') + 1
+        if not end:
+            return
+        self._offset += end
+
+        rows = csv.reader(io.StringIO(chunk[:end].decode('utf-8-sig' if self._header is None else 'utf-8')))
+        if self._header is None:
+            self._header = next(rows, None)
+            if not self._header:
+                self._header = None
+                return
+        columns = {name: i for i, name in enumerate(self._header)}
+        if self.feedback_field not in columns:
+            return
+
+        feedback_col = columns[self.feedback_field]
+        user_col = columns.get(self.user_field)
+        key_cols = [columns.get(field) for field in self.key_fields]
+        new_outfits = set()
+        for row in rows:
+            if len(row) <= feedback_col or row[feedback_col] != self.rejected_value:
+                continue
+            if user_col is not None and len(row) > user_col and row[user_col]:
+                continue
+            new_outfits.add(tuple(row[i] if i is not None and i < len(row) else 'N/A' for i in key_cols))
+        if not new_outfits <= self.rejected:
+            # Swap in a new set so readers holding the old one are never disturbed
+            self.rejected = self.rejected | new_outfits
+
+
+class SqliteRejectionIndex(RejectionIndex):
+    """RejectionIndex over the SQLite feedback backend; each refresh reads rows past the last rowid."""
+
+    def __init__(self, db_path, table, key_fields, feedback_field='feedback_type', rejected_value='rejected',
+                 user_field='user_id'):
+        super().__init__(db_path, key_fields, feedback_field, rejected_value, user_field)
+        self.table = table
+        self._last_rowid = 0
+
+    def refresh(self):
+        with self._lock:
+            if not os.path.exists(self.path):
+                return False
+            with closing(sqlite3.connect(self.path)) as conn:
+                columns = {row[1] for row in conn.execute(f"PRAGMA table_info({_quote(self.table)})")}
+                if self.feedback_field not in columns:
+                    return False
+                selected = ', '.join(_quote(f) if f in columns else "'N/A'" for f in self.key_fields)
+                user = f"COALESCE({_quote(self.user_field)}, '')" if self.user_field in columns else "''"
+                rows = conn.execute(
+                    f"SELECT rowid, {user}, {selected} FROM {_quote(self.table)} "
+                    f"WHERE rowid > ? AND {_quote(self.feedback_field)} = ? ORDER BY rowid",
+                    (self._last_rowid, self.rejected_value)).fetchall()
+            if not rows:
+                return False
+            self._last_rowid = rows[-1][0]
+            new_outfits = {tuple('N/A' if v is None else v for v in row[2:]) for row in rows if not row[1]}
+            if new_outfits <= self.rejected:
+                return False
+            self.rejected = self.rejected | new_outfits
+            request_log.info("Loaded %d rejected outfits for filtering.", len(self.rejected))
+            return True
+
+
+# --- Feedback Sinks ---
+def _quote(identifier):
+    return '"' + str(identifier).replace('"', '""') + '"'
+
+
+class CsvSink:
+    """Appends rows to CSV files, one exclusive file lock and one fsync per batch.
+
+    The header is written only if the file is empty once the lock is held, so
+    concurrent processes can never duplicate it or interleave rows. A file whose
+    header lacks some of the writer's columns is first rewritten under the new
+    header (see ``migrate``), so every row stays readable by any CSV reader.
+    Old rows are mapped to the new header by column name; only the targets in
+    ``verdict_last`` (the feedback log) may also hold the legacy over-wide rows.
+    """
+
+    def __init__(self, verdict_last=()):
+        self.verdict_last = frozenset(verdict_last)
+
+    def write(self, target, fieldnames, rows):
+        self._append(target, list(fieldnames), rows)
+
+    def migrate(self, target, fieldnames):
+        """Bring an existing file's header up to ``fieldnames`` without adding rows."""
+        if os.path.exists(target):
+            self._append(target, list(fieldnames), [])
+
+    def _append(self, target, fieldnames, rows):
+        while True:
+            with open(target, 'a+', newline='', encoding='utf-8') as f:
+                _lock_file(f)
+                try:
+                    if not _is_current(f, target):
+                        # Replaced by another process's migration while we waited for the lock
+                        continue
+                    f.seek(0, os.SEEK_END)
+                    writer = csv.writer(f)
+                    if f.tell() == 0:
+                        writer.writerow(fieldnames)
+                    elif _widen_header(f, target, fieldnames, target in self.verdict_last):
+                        continue
+                    writer.writerows(rows)
+                    f.flush()
+                    os.fsync(f.fileno())
+                    return
+                finally:
+                    _unlock_file(f)
+
+
+def _is_current(f, target):
+    try:
+        stat = os.stat(target)
+    except FileNotFoundError:
+        return False
+    own = os.fstat(f.fileno())
+    return (own.st_dev, own.st_ino) == (stat.st_dev, stat.st_ino)
+
+
+def _widen_header(f, target, fieldnames, verdict_last=False):
+    """Rewrite ``target`` under ``fieldnames`` if its header is a strict subset of them.
+
+    Rows are mapped by name. With ``verdict_last``, rows wider than the header come
+    from earlier feedback writers that put the verdict last and the columns the
+    header lacks before it; those extra values fill the new columns in order. The
+    file is replaced, not edited in place, so readers tailing it see a new file.
+    Returns True if it was rewritten. The caller holds the lock on ``f``.
+    """
+    f.seek(0)
+    reader = csv.reader(f)
+    header = next(reader, None) or []
+    if not header or header == fieldnames or not set(header) < set(fieldnames):
+        f.seek(0, os.SEEK_END)
+        return False
+    added = [name for name in fieldnames if name not in header]
+    tmp_path = f"{target}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', newline='', encoding='utf-8') as out:
+        writer = csv.writer(out)
+        writer.writerow(fieldnames)
+        for row in reader:
+            if verdict_last and len(row) > len(header):
+                values = dict(zip(header[:-1], row))
+                values[header[-1]] = row[-1]
+                values.update(zip(added, row[len(header) - 1:-1]))
+            else:
+                values = dict(zip(header, row))
+            writer.writerow([values.get(name, '') for name in fieldnames])
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp_path, target)
+    request_log.warning("Rewrote '%s' with the columns %s added to its header.", target, ', '.join(added))
+    return True
+
+
+class SqliteSink:
+    """Stores each target as a table in one SQLite database in WAL mode."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._conn = None
+
+    def write(self, target, fieldnames, rows):
+        if self._conn is None:
+            # Only ever used from the writer thread
+            self._conn = sqlite3.connect(self.db_path)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+        table = table_for(target)
+        with self._conn:
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS {_quote(table)} (created_at REAL)")
+            existing = {row[1] for row in self._conn.execute(f"PRAGMA table_info({_quote(table)})")}
+            for name in fieldnames:
+                if name not in existing:
+                    self._conn.execute(f"ALTER TABLE {_quote(table)} ADD COLUMN {_quote(name)} TEXT")
+            placeholders = ', '.join('?' for _ in range(len(fieldnames) + 1))
+            columns = ', '.join(['created_at'] + [_quote(name) for name in fieldnames])
+            now = time.time()
+            self._conn.executemany(f"INSERT INTO {_quote(table)} ({columns}) VALUES ({placeholders})",
+                                   [(now, *row) for row in rows])
+
+
+def table_for(target):
+    """SQLite table holding what the CSV backend would write to ``target``."""
+    return re.sub(r'[^a-zA-Z0-9_]+', '_', os.path.splitext(os.path.basename(target))[0])
+
+
+if os.name == 'nt':
+    # No advisory locks on Windows; writes from one process are still serialized
+    def _lock_file(f):
+        pass
+
+    def _unlock_file(f):
+        pass
+else:
+    def _lock_file(f):
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+    def _unlock_file(f):
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+# --- Buffered Writer ---
+class BufferedWriter:
+    """Background thread that drains a bounded queue of rows into a sink in batches.
+
+    ``submit()`` never touches the disk; it returns False when the queue is full so
+    callers can push back on the client instead of stalling a request thread.
+    """
+
+    def __init__(self, sink, max_queue=10000, batch_size=500, flush_interval=0.1, on_flush=None):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_flush = on_flush
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self._queue = queue.Queue(max_queue)
+        self._idle = threading.Condition()
+        self._pending = 0
+        self._thread = threading.Thread(target=self._run, name='feedback-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, target, fieldnames, rows):
+        """Queue ``rows`` for appending to ``target``. Returns False if the queue is full."""
+        with self._idle:
+            self._pending += 1
+        try:
+            self._queue.put_nowait((target, list(fieldnames), [list(row) for row in rows]))
+            return True
+        except queue.Full:
+            self._done(1)
+            self.dropped += 1
+            return False
+
+    def flush(self, timeout=None):
+        """Block until everything submitted so far is written. Returns False on timeout."""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def close(self, timeout=5.0):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+    def stats(self):
+        return {"queued": self._queue.qsize(), "written": self.written, "dropped": self.dropped,
+                "errors": self.errors}
+
+    def _done(self, count):
+        with self._idle:
+            self._pending -= count
+            if self._pending == 0:
+                self._idle.notify_all()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        # Group by target, keeping each target's rows in submission order
+        groups = {}
+        for target, fieldnames, rows in batch:
+            groups.setdefault(target, (fieldnames, []))[1].extend(rows)
+        for target, (fieldnames, rows) in groups.items():
+            try:
+                self.sink.write(target, fieldnames, rows)
+                self.written += len(rows)
+            except Exception as e:
+                self.errors += len(rows)
+                request_log.error("Could not write %d rows to '%s': %s", len(rows), target, e)
+        if self.on_flush is not None:
+            try:
+                self.on_flush(list(groups))
+            except Exception as e:
+                request_log.warning("Feedback flush callback failed: %s", e)
+        self._done(len(batch))
@@ -0,0 +1,119 @@
+import os
+import re
+import threading
+
+# Extensions the recommender will link to as item images.
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def tokenize(name):
+    """Lowercased alphanumeric tokens of a file name or item value."""
+    return [t for t in re.split(r'[^a-z0-9]+', name.lower()) if t]
+
+
+# --- Uploads Image Index ---
+class UploadsIndex:
+    """In-memory listing of the uploads folder, keyed by lowercased file name tokens.
+
+    ``find()`` answers item-image lookups without touching the disk, and ``mtime()``
+    gives the modification time recorded for a file at the last scan (for versioned
+    URLs). The listing is refreshed when the directory's mtime changes (one ``stat``
+    per ``refresh()``), so files saved by the cartoonify service show up on the next
+    lookup, or by an optional watcher thread. A file rewritten in place, which leaves
+    the directory untouched, keeps its old mtime until the next rescan.
+    """
+
+    def __init__(self, directory, extensions=IMAGE_EXTENSIONS):
+        self.directory = directory
+        self.extensions = tuple(extensions)
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._names = []
+        self._mtimes = {}
+        self._tokens = {}
+        self._lookups = {}
+        self._watcher = None
+        self.refresh()
+
+    def __len__(self):
+        return len(self._names)
+
+    def refresh(self):
+        """Rescan if the directory changed since the last scan. Returns True on rescan."""
+        try:
+            mtime = os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._mtime and self._mtime is not None:
+            return False
+        mtimes = {}
+        if mtime is not None:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if entry.name.lower().endswith(self.extensions):
+                        try:
+                            mtimes[entry.name] = entry.stat().st_mtime_ns
+                        except FileNotFoundError:
+                            pass
+        self._rebuild(mtimes, mtime)
+        return True
+
+    def mtime(self, filename):
+        """``st_mtime_ns`` of ``filename`` as of the last scan, or None if it wasn't listed."""
+        return self._mtimes.get(filename)
+
+    def find(self, item_value):
+        """Name of an image whose file name contains ``item_value`` (case-insensitive)."""
+        if not item_value:
+            return None
+        value = item_value.lower()
+        lookups = self._lookups
+        if value in lookups:
+            return lookups[value]
+
+        match = None
+        tokens = tokenize(value)
+        # Fast path: a value that is a single token usually names the file exactly
+        if len(tokens) == 1 and tokens[0] == value:
+            candidates = self._tokens.get(value)
+            if candidates:
+                match = candidates[0]
+        if match is None:
+            match = next((name for name in self._names if value in name.lower()), None)
+        lookups[value] = match
+        return match
+
+    def start_watcher(self, interval=5.0):
+        """Poll the folder every ``interval`` seconds from a daemon thread."""
+        if self._watcher is not None:
+            return
+        stop = threading.Event()
+
+        def watch():
+            while not stop.wait(interval):
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"[WARNING] Uploads rescan failed: {e}")
+
+        self._watcher = (threading.Thread(target=watch, name='uploads-index-watcher', daemon=True), stop)
+        self._watcher[0].start()
+
+    def stop_watcher(self):
+        if self._watcher is not None:
+            self._watcher[1].set()
+            self._watcher = None
+
+    def _rebuild(self, mtimes, mtime):
+        names = sorted(mtimes)
+        tokens = {}
+        for name in names:
+            for token in set(tokenize(os.path.splitext(name)[0])):
+                tokens.setdefault(token, []).append(name)
+        with self._lock:
+            # Swap whole structures so concurrent readers see either the old or new listing
+            self._names = names
+            self._mtimes = mtimes
+            self._tokens = tokens
+            self._lookups = {}
+            self._mtime = mtime
@@ -0,0 +1,267 @@
+"""Low-overhead metrics and sampled request logging for the Flask services.
+
+Counters, gauges and histograms live in a per-process registry and are rendered in
+the Prometheus text format at ``/metrics`` (see ``instrument_app``). Recording a
+value is a dict update under a lock, cheap enough for the request hot path; values
+owned by other objects (cache sizes, queue depth) are read only when scraped.
+
+Hot-path log lines go through ``request_logger``: warnings always pass, lower levels
+only for a sampled share of requests (LOG_SAMPLE_RATE), decided once per request so
+a sampled request logs all of its lines. LOG_LEVEL sets the threshold.
+"""
+import logging
+import math
+import os
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# Share of requests whose debug/info lines are logged (1 logs every request)
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '0.01'))
+
+# Latency buckets in seconds, from index lookups up to model inference.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+# --- Metrics ---
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=(), callback=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        # callback() -> {label value tuple: value}, read at scrape time instead of recorded values
+        self.callback = callback
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def samples(self):
+        """(suffix, label pairs, value) triples for rendering."""
+        if self.callback is not None:
+            values = self.callback()
+            values = values if isinstance(values, dict) else {(): values}
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [('', list(zip(self.labels, key)), value) for key, value in sorted(values.items())]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                # Per-bucket counts (the last one is +Inf), sum, count
+                series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), total, count) for key, (counts, total, count) in self._values.items()}
+        samples = []
+        for key, (counts, total, count) in sorted(values.items()):
+            labels = list(zip(self.labels, key))
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, math.inf), counts):
+                cumulative += bucket_count
+                samples.append(('_bucket', labels + [('le', format_value(bound))], cumulative))
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, count))
+        return samples
+
+
+class LapTimer:
+    """Times consecutive stages of one call: ``lap(stage)`` observes the time since the previous lap."""
+
+    def __init__(self, histogram, label='stage'):
+        self.histogram = histogram
+        self.label = label
+        self.last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.histogram.observe(now - self.last, **{self.label: stage})
+        self.last = now
+
+
+class Stopwatch:
+    """Wall time per named stage of a job, summed over repeats; may be shared by the job's threads.
+
+    Unlike the registry it is a plain dict, so a worker process can return it with
+    the job's result and the web process records it.
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.seconds[name] = self.seconds.get(name, 0.0) + elapsed
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name, help, labels=(), callback=None):
+        return self._register(Counter, name, help, labels, callback=callback)
+
+    def gauge(self, name, help, labels=(), callback=None):
+        return self._register(Gauge, name, help, labels, callback=callback)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, help, labels, buckets=buckets)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                print(f"[WARNING] Could not collect metric '{metric.name}': {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, labels, value in samples:
+                label_text = ','.join(f'{label}="{escape_label(text)}"' for label, text in labels)
+                lines.append(f"{metric.name}{suffix}{{{label_text}}} {format_value(value)}" if label_text
+                             else f"{metric.name}{suffix} {format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+# Shared by everything in the process
+REGISTRY = Registry()
+
+
+# --- Sampled Request Logging ---
+class RequestSampler(logging.Filter):
+    """Passes warnings and above; lower levels only for sampled requests (or a sampled share of
+    records outside a request)."""
+
+    def __init__(self, rate=LOG_SAMPLE_RATE):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        from flask import g, has_request_context
+        if record.levelno >= logging.WARNING:
+            return True
+        if has_request_context():
+            return g.get('log_sampled', False)
+        return random.random() < self.rate
+
+
+def request_logger(name):
+    """Logger for per-request lines, filtered by ``RequestSampler``."""
+    logger = logging.getLogger(name)
+    if not any(isinstance(f, RequestSampler) for f in logger.filters):
+        logger.addFilter(RequestSampler())
+    return logger
+
+
+def configure_logging():
+    logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+
+# --- Flask Integration ---
+def instrument_app(app, registry=REGISTRY):
+    """Time every request by endpoint, decide its log sampling, and serve ``/metrics``.
+
+    Streamed responses are timed until their headers are sent.
+    """
+    # Imported here so job worker processes can use the Stopwatch without loading Flask
+    from flask import Response, g, request
+
+    request_seconds = registry.histogram('http_request_duration_seconds', 'Request latency by route and status',
+                                         ('method', 'route', 'status'))
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+        g.log_sampled = random.random() < LOG_SAMPLE_RATE
+
+    @app.after_request
+    def observe_request(response):
+        started = g.pop('request_started', None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            request_seconds.observe(time.perf_counter() - started, method=request.method, route=route,
+                                    status=response.status_code)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(registry.render(), content_type=CONTENT_TYPE)
@@ -0,0 +1,182 @@
+import multiprocessing
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from concurrent.futures import TimeoutError as FutureTimeout
+
+
+class QueueFull(Exception):
+    """Raised by ``JobQueue.submit`` when the maximum number of unfinished jobs is reached."""
+
+
+class Job:
+    def __init__(self, job_id, future):
+        self.id = job_id
+        self.future = future
+        self.submitted_at = time.time()
+        self.finished_at = None
+
+    @property
+    def status(self):
+        if not self.future.done():
+            return 'running' if self.future.running() else 'queued'
+        return 'failed' if self.future.exception() is not None or self.output.get('result') is None else 'done'
+
+    @property
+    def output(self):
+        return self.future.result() if self.future.done() and self.future.exception() is None else {}
+
+    def wait(self, timeout=None):
+        """Block up to ``timeout`` seconds for the job to finish. Returns True if it did."""
+        try:
+            self.future.result(timeout)
+        except FutureTimeout:
+            return False
+        except Exception:
+            pass
+        return True
+
+    def timings(self):
+        output = self.output
+        timings = {"submitted_at": self.submitted_at}
+        if 'started_at' in output:
+            timings["queue_seconds"] = round(max(0.0, output['started_at'] - self.submitted_at), 4)
+            timings["processing_seconds"] = round(output['processing_seconds'], 4)
+        if 'cpu_seconds' in output:
+            timings["cpu_seconds"] = round(output['cpu_seconds'], 4)
+        if 'worker_peak_rss_mb' in output:
+            timings["worker_peak_rss_mb"] = output['worker_peak_rss_mb']
+        if output.get('stages'):
+            timings["stages"] = {stage: round(seconds, 4) for stage, seconds in output['stages'].items()}
+        if self.finished_at is not None:
+            timings["total_seconds"] = round(self.finished_at - self.submitted_at, 4)
+        return timings
+
+
+# --- Job Queue ---
+class JobQueue:
+    """Bounded queue of CPU-heavy jobs run by a pool of worker processes.
+
+    Workers are started with the ``spawn`` method so each one imports only the job
+    module and builds its own state (e.g. a warm model) in ``initializer``; with
+    ``workers=0`` jobs run on in-process threads instead. The service calls ``start()``
+    at boot so no request pays for spawning a worker or loading its model; otherwise
+    the pool is created on the first submit. Finished jobs are kept ``job_ttl``
+    seconds for polling.
+    """
+
+    def __init__(self, workers=2, max_pending=32, initializer=None, job_ttl=600.0, ready=None):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.initializer = initializer
+        self.job_ttl = job_ttl
+        # Picklable no-op run once per worker to make the pool spawn (and initialize) all of them
+        self.ready = ready
+        self.submitted = 0
+        self.rejected = 0
+        self._jobs = {}
+        self._pending = 0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def start(self, timeout=None):
+        """Create the pool and block until every worker has run ``initializer``.
+
+        Returns False if some worker was not ready within ``timeout`` seconds.
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = self._create_executor()
+            executor = self._executor
+        done, not_done = wait(self._prime(executor), timeout)
+        failed = [future for future in done if future.exception() is not None]
+        for future in failed:
+            print(f"[WARNING] Job worker failed to start: {future.exception()}")
+        return not not_done and not failed
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue ``fn(*args, **kwargs)`` and return its Job, or raise QueueFull."""
+        with self._lock:
+            self._purge()
+            if self._pending >= self.max_pending:
+                self.rejected += 1
+                raise QueueFull(f"{self._pending} jobs already pending")
+            self._pending += 1
+            self.submitted += 1
+            if self._executor is None:
+                self._executor = self._create_executor()
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for memory); replace the pool and retry once
+            print("[WARNING] Job worker pool broke, restarting it")
+            with self._lock:
+                self._executor = self._create_executor()
+            self._prime(self._executor)
+            try:
+                future = self._executor.submit(fn, *args, **kwargs)
+            except Exception:
+                self._finished(None)
+                raise
+        job = Job(uuid.uuid4().hex, future)
+        with self._lock:
+            self._jobs[job.id] = job
+        future.add_done_callback(lambda _: self._finished(job))
+        return job
+
+    def completed(self, output):
+        """Register an already-finished job (e.g. a cached result) so it can be polled like any other."""
+        future = Future()
+        future.set_result(output)
+        job = Job(uuid.uuid4().hex, future)
+        job.finished_at = job.submitted_at
+        with self._lock:
+            self._purge()
+            self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self):
+        with self._lock:
+            return {"workers": self.workers, "pending": self._pending, "max_pending": self.max_pending,
+                    "submitted": self.submitted, "rejected": self.rejected, "tracked_jobs": len(self._jobs)}
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def _finished(self, job):
+        if job is not None:
+            job.finished_at = time.time()
+        with self._lock:
+            self._pending -= 1
+
+    def _purge(self):
+        cutoff = time.time() - self.job_ttl
+        expired = [job_id for job_id, job in self._jobs.items() if job.finished_at is not None and job.finished_at < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def _prime(self, executor):
+        # Executors start workers as tasks arrive, one per task while none is idle
+        if self.ready is None:
+            return []
+        return [executor.submit(self.ready) for _ in range(self.pool_size)]
+
+    @property
+    def pool_size(self):
+        return self.workers if self.workers > 0 else 2
+
+    def _create_executor(self):
+        if self.workers <= 0:
+            return ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix='job-worker',
+                                      initializer=self.initializer)
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=self.initializer)
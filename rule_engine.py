@@ -0,0 +1,332 @@
+import math
+import random
+import re
+from functools import reduce
+from itertools import count, product
+
+import numpy as np
+
+# Columns the recommender filters on, in the order they are indexed.
+INDEXED_COLUMNS = ('gender', 'weather_range', 'event_name', 'outfittype', 'time')
+
+EMPTY_ROWS = np.empty(0, dtype=np.int32)
+
+# Each index built gets a new version so caches keyed on it go stale on reload.
+_index_versions = count(1)
+
+# Upper bound on remembered pattern lookups (event/outfit/time come from the client).
+MAX_CACHED_PATTERNS = 1024
+
+# Outfit attributes, in the order they appear in an outfit tuple.
+OUTFIT_COLUMNS = ('dress_type', 'dress_color', 'dress_fabric_texture', 'shoes_type',
+                  'shoes_color', 'upper_layer', 'upper_layer_color')
+
+# Below this many combinations a row set is enumerated exactly instead of sampled.
+ENUMERATE_LIMIT = 2048
+
+# Random draws allowed per requested outfit when sampling a large row set.
+SAMPLE_ATTEMPTS_PER_OUTFIT = 50
+
+# Candidate outfits scored per diversity selection (pools smaller than this are enumerated).
+DIVERSITY_CANDIDATES = 512
+
+
+def split_and_strip(s):
+    if not isinstance(s, str) or not s.strip(): return []
+    return [x.strip() for x in s.split(',') if x.strip()]
+
+
+# --- Rule Index ---
+class RuleIndex:
+    """Posting lists mapping each distinct column value to the row positions that hold it.
+
+    Built once per dataset load so request filtering only walks the (small) set of
+    distinct values instead of re-scanning every row with vectorized string ops.
+    """
+
+    def __init__(self, df):
+        self.version = next(_index_versions)
+        self.num_rows = len(df)
+        self.postings = {}
+        for column in INDEXED_COLUMNS:
+            self.postings[column] = {}
+            if column not in df.columns:
+                continue
+            values = df[column].astype(str)
+            if column == 'gender':
+                values = values.str.lower().str.strip()
+            groups = {}
+            for position, value in enumerate(values):
+                groups.setdefault(value, []).append(position)
+            self.postings[column] = {value: np.array(rows, dtype=np.int32) for value, rows in groups.items()}
+        self._match_cache = {}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_match_cache'] = {}
+        return state
+
+    def __setstate__(self, state):
+        # A loaded snapshot counts as a new build, so version-keyed caches start fresh
+        self.__dict__.update(state)
+        self.version = next(_index_versions)
+
+    def export(self):
+        """Flat ``(arrays, meta)`` form of the posting lists, for ``from_export``.
+
+        Each column's lists are concatenated into one array; ``meta`` holds the
+        distinct values and their bounds in it.
+        """
+        arrays, meta = {}, {"num_rows": self.num_rows, "columns": {}}
+        for column, postings in self.postings.items():
+            values = list(postings)
+            bounds = np.cumsum([0] + [len(postings[value]) for value in values]).tolist()
+            arrays[f"postings.{column}"] = np.concatenate([postings[value] for value in values]) if values else EMPTY_ROWS
+            meta["columns"][column] = (values, bounds)
+        return arrays, meta
+
+    @classmethod
+    def from_export(cls, arrays, meta):
+        """Rebuild an index around exported arrays (which may be read-only memory maps)."""
+        index = cls.__new__(cls)
+        index.version = next(_index_versions)
+        index.num_rows = meta["num_rows"]
+        index.postings = {}
+        for column, (values, bounds) in meta["columns"].items():
+            flat = arrays[f"postings.{column}"]
+            index.postings[column] = {value: flat[bounds[i]:bounds[i + 1]] for i, value in enumerate(values)}
+        index._match_cache = {}
+        return index
+
+    def exact(self, column, value):
+        """Row positions whose (normalized) value equals ``value``."""
+        return self.postings[column].get(value, EMPTY_ROWS)
+
+    def contains(self, column, pattern, case=True):
+        """Row positions whose value matches ``pattern``, like ``Series.str.contains``."""
+        key = (column, pattern, case)
+        rows = self._match_cache.get(key)
+        if rows is None:
+            regex = re.compile(pattern, 0 if case else re.IGNORECASE)
+            hits = [rows for value, rows in self.postings[column].items() if regex.search(value)]
+            rows = np.sort(np.concatenate(hits)) if hits else EMPTY_ROWS
+            if len(self._match_cache) >= MAX_CACHED_PATTERNS:
+                self._match_cache.clear()
+            self._match_cache[key] = rows
+        return rows
+
+
+def intersect_rows(*row_sets):
+    """Intersect sorted, unique row position arrays."""
+    return reduce(lambda a, b: np.intersect1d(a, b, assume_unique=True), row_sets)
+
+
+# --- Outfit Candidate Store ---
+class CandidateStore:
+    """Rule rows parsed once into integer-coded attribute lists.
+
+    Each attribute has a vocabulary (``vocab[a]`` maps code -> value) and a CSR layout
+    (``codes[a][offsets[a][r]:offsets[a][r + 1]]`` are row ``r``'s values), so the
+    Cartesian product of a row never has to be built to draw an outfit from it.
+    """
+
+    def __init__(self, df):
+        self.num_rows = len(df)
+        self.vocab = []
+        self.codes = []
+        self.offsets = []
+        lengths = []
+        blank = []
+        for column in OUTFIT_COLUMNS:
+            values = df[column].tolist() if column in df.columns else [''] * self.num_rows
+            lookup, vocab, codes, offsets = {}, [], [], [0]
+            for cell in values:
+                # Empty cells contribute a single 'N/A', as the recommender always did
+                for item in split_and_strip(cell) or ['N/A']:
+                    code = lookup.get(item)
+                    if code is None:
+                        code = lookup[item] = len(vocab)
+                        vocab.append(item)
+                    codes.append(code)
+                offsets.append(len(codes))
+            offsets = np.array(offsets, dtype=np.int64)
+            self.vocab.append(vocab)
+            self.codes.append(np.array(codes, dtype=np.int32))
+            self.offsets.append(offsets)
+            lengths.append(np.diff(offsets))
+            blank.append(np.array([not split_and_strip(cell) for cell in values], dtype=bool))
+        # lengths[a][r] = number of values row r offers for attribute a;
+        # blank[a][r] marks rows whose cell was empty (their single value is the 'N/A' filler)
+        self.blank = blank
+        self.lengths = np.vstack(lengths) if lengths and self.num_rows else np.zeros((len(OUTFIT_COLUMNS), 0), dtype=np.int64)
+        self.combo_counts = self.lengths.prod(axis=0)
+
+    def export(self):
+        """Flat ``(arrays, meta)`` form of the store, for ``from_export``."""
+        arrays = {"lengths": self.lengths, "combo_counts": self.combo_counts}
+        for a in range(len(OUTFIT_COLUMNS)):
+            arrays[f"codes.{a}"] = self.codes[a]
+            arrays[f"offsets.{a}"] = self.offsets[a]
+            arrays[f"blank.{a}"] = self.blank[a]
+        return arrays, {"num_rows": self.num_rows, "vocab": self.vocab}
+
+    @classmethod
+    def from_export(cls, arrays, meta):
+        """Rebuild a store around exported arrays (which may be read-only memory maps)."""
+        store = cls.__new__(cls)
+        store.num_rows = meta["num_rows"]
+        store.vocab = meta["vocab"]
+        store.codes = [arrays[f"codes.{a}"] for a in range(len(OUTFIT_COLUMNS))]
+        store.offsets = [arrays[f"offsets.{a}"] for a in range(len(OUTFIT_COLUMNS))]
+        store.blank = [arrays[f"blank.{a}"] for a in range(len(OUTFIT_COLUMNS))]
+        store.lengths = arrays["lengths"]
+        store.combo_counts = arrays["combo_counts"]
+        return store
+
+    def row_values(self, attribute, row):
+        """Codes offered by ``row`` for attribute index ``attribute``."""
+        return self.codes[attribute][self.offsets[attribute][row]:self.offsets[attribute][row + 1]]
+
+    def attribute_pool(self, rows, attribute):
+        """Distinct values of ``attribute`` across ``rows``, skipping blank cells.
+
+        Gathers every row's slice of the CSR code array in one vectorized step.
+        Returns ``['N/A']`` when no row offers a value.
+        """
+        rows = np.asarray(rows)[~self.blank[attribute][rows]]
+        if not len(rows):
+            return ['N/A']
+        starts = self.offsets[attribute][rows]
+        lengths = self.lengths[attribute][rows]
+        # Position k of the gather belongs to row i: starts[i] + (k - first k of row i)
+        firsts = np.cumsum(lengths) - lengths
+        positions = np.repeat(starts - firsts, lengths) + np.arange(int(lengths.sum()))
+        vocab = self.vocab[attribute]
+        return [vocab[code] for code in np.unique(self.codes[attribute][positions])]
+
+    def decode(self, outfit_codes):
+        return tuple(self.vocab[a][code] for a, code in enumerate(outfit_codes))
+
+    def combination(self, row, index):
+        """Decode the ``index``-th combination of ``row`` (mixed radix over its value lists)."""
+        outfit = [0] * len(OUTFIT_COLUMNS)
+        for a in range(len(OUTFIT_COLUMNS) - 1, -1, -1):
+            index, digit = divmod(index, int(self.lengths[a][row]))
+            outfit[a] = int(self.codes[a][self.offsets[a][row] + digit])
+        return tuple(outfit)
+
+    def iter_combinations(self, rows):
+        """Lazily yield every (possibly repeated) code tuple offered by ``rows``."""
+        for row in rows:
+            yield from product(*(self.row_values(a, row).tolist() for a in range(len(OUTFIT_COLUMNS))))
+
+    def enumerate_distinct(self, rows):
+        """Distinct code tuples offered by ``rows``, or None if there are too many to list."""
+        if int(self.combo_counts[rows].sum()) > ENUMERATE_LIMIT:
+            return None
+        return list(set(self.iter_combinations(rows)))
+
+    def sample_distinct(self, rows, max_outfits=3, existing_outfits=None, rng=random, candidates=None, exclude=()):
+        """Pick up to ``max_outfits`` distinct outfits (string tuples) from ``rows``.
+
+        Small row sets are enumerated exactly (``candidates`` may pass in a cached
+        ``enumerate_distinct(rows)``); large ones are sampled by drawing a global
+        combination index, so the product is never materialized. Outfits in
+        ``exclude`` are never picked.
+        """
+        recommendations = list(existing_outfits) if existing_outfits is not None else []
+        seen_outfits = {tuple(item) for item in recommendations}
+        if len(recommendations) >= max_outfits or not len(rows):
+            return recommendations
+
+        if candidates is None:
+            candidates = self.enumerate_distinct(rows)
+        if candidates is not None:
+            candidates = rng.sample(candidates, len(candidates))
+        else:
+            counts = self.combo_counts[rows]
+            candidates = self._sample_combinations(rows, counts, max_outfits * SAMPLE_ATTEMPTS_PER_OUTFIT, rng)
+
+        for outfit_codes in candidates:
+            if len(recommendations) >= max_outfits:
+                break
+            outfit = self.decode(outfit_codes)
+            if outfit not in seen_outfits and outfit not in exclude:
+                recommendations.append(outfit)
+                seen_outfits.add(outfit)
+        return recommendations
+
+    def sample_codes(self, rows, n, rng=random):
+        """(n, 7) array of random code tuples from ``rows``, drawn like ``_sample_combinations`` but vectorized."""
+        rows = np.asarray(rows)
+        cumulative = np.cumsum(self.combo_counts[rows])
+        index = np.random.default_rng(rng.getrandbits(64)).integers(0, int(cumulative[-1]), n)
+        position = np.searchsorted(cumulative, index, side='right')
+        index = index - np.where(position > 0, cumulative[position - 1], 0)
+        chosen = rows[position]
+        codes = np.empty((n, len(OUTFIT_COLUMNS)), dtype=np.int64)
+        # Mixed radix decode, last attribute fastest, as in combination()
+        for a in range(len(OUTFIT_COLUMNS) - 1, -1, -1):
+            index, digit = np.divmod(index, self.lengths[a][chosen])
+            codes[:, a] = self.codes[a][self.offsets[a][chosen] + digit]
+        return codes
+
+    def _sample_combinations(self, rows, counts, attempts, rng):
+        """Yield ``attempts`` random code tuples, weighting rows by their combination count."""
+        cumulative = np.cumsum(counts)
+        total = int(cumulative[-1])
+        for _ in range(attempts):
+            index = rng.randrange(total)
+            position = int(np.searchsorted(cumulative, index, side='right'))
+            offset = index - (int(cumulative[position - 1]) if position else 0)
+            yield self.combination(rows[position], offset)
+
+
+# --- Diversity Selection ---
+def select_diverse(pools, k, existing_outfits=(), rejection_set=frozenset(), rng=random,
+                   num_candidates=DIVERSITY_CANDIDATES, exclude=()):
+    """Pick up to ``k`` new outfits from per-attribute ``pools`` that are far apart.
+
+    Candidates are every combination when the pools are small, otherwise
+    ``num_candidates`` random draws. Rejected, excluded and already chosen outfits are dropped,
+    then greedy max-min selection repeatedly takes the candidate whose smallest
+    Hamming distance to everything chosen so far is largest. Cost is bounded by
+    ``num_candidates * k`` vectorized comparisons; ``rng`` makes it reproducible.
+    """
+    pools = [list(pool) for pool in pools]
+    sizes = [len(pool) for pool in pools]
+    np_rng = np.random.default_rng(rng.getrandbits(64))
+    if math.prod(sizes) <= num_candidates:
+        codes = np.array(list(product(*(range(n) for n in sizes))), dtype=np.int32)
+        np_rng.shuffle(codes)
+    else:
+        codes = np.column_stack([np_rng.integers(0, n, num_candidates, dtype=np.int32) for n in sizes])
+        # Drop duplicate draws, keeping the (random) draw order
+        _, first = np.unique(codes, axis=0, return_index=True)
+        codes = codes[np.sort(first)]
+
+    existing = {tuple(outfit) for outfit in existing_outfits}
+    decoded = [tuple(pools[a][code] for a, code in enumerate(row)) for row in codes.tolist()]
+    keep = [i for i, outfit in enumerate(decoded)
+            if outfit not in existing and outfit not in rejection_set and outfit not in exclude]
+    codes = codes[keep]
+    decoded = [decoded[i] for i in keep]
+    if not len(codes):
+        return []
+
+    # Distance of each candidate to the nearest outfit chosen so far; values missing
+    # from the pools encode as -1 so they differ from every candidate
+    lookups = [{value: code for code, value in enumerate(pool)} for pool in pools]
+    min_distance = np.full(len(codes), len(pools) + 1)
+    for outfit in existing:
+        encoded = np.array([lookups[a].get(value, -1) for a, value in enumerate(outfit[:len(pools)])])
+        min_distance = np.minimum(min_distance, (codes != encoded).sum(axis=1))
+
+    chosen = []
+    while len(chosen) < k:
+        best = int(np.argmax(min_distance))
+        if min_distance[best] == 0:
+            break
+        chosen.append(decoded[best])
+        min_distance = np.minimum(min_distance, (codes != codes[best]).sum(axis=1))
+    return chosen
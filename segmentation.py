@@ -0,0 +1,117 @@
+import inspect
+import os
+import threading
+import time
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+from rembg import new_session, remove
+
+# Model used for background removal; u2netp and isnet-general-use trade accuracy for speed.
+DEFAULT_MODEL = os.environ.get('REMBG_MODEL', 'u2net')
+
+# Sessions sharing U2Net's pre/post-processing (320x320 normalized input, first output
+# min-max scaled per image), which lets several images go through one inference call.
+BATCHABLE_SESSIONS = frozenset({'U2netSession', 'U2netpSession', 'U2netHumanSegSession',
+                                'U2netCustomSession', 'SiluetaSession'})
+U2NET_MEAN, U2NET_STD, U2NET_SIZE = (0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)
+
+
+def available_cores():
+    """CPU cores this worker may run on (respects taskset/cgroup affinity where supported)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+# --- Background Removal Sessions ---
+class SessionManager:
+    """Keeps one rembg/ONNX Runtime session per model for the life of the worker.
+
+    ``rembg.remove()`` without a session builds (or looks up) a model session on
+    every call, so the first request after boot pays the whole model load. Sessions
+    are created once here, with intra-op threads capped to the cores available to
+    this worker, and ``warm_up()`` runs one inference so start-up absorbs that cost.
+    """
+
+    def __init__(self, model_name=DEFAULT_MODEL, intra_op_threads=None):
+        self.model_name = model_name
+        self.intra_op_threads = intra_op_threads or int(os.environ.get('REMBG_THREADS', 0)) or available_cores()
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, model_name=None):
+        model_name = model_name or self.model_name
+        session = self._sessions.get(model_name)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(model_name)
+                if session is None:
+                    started = time.perf_counter()
+                    session = self._sessions[model_name] = self._create(model_name)
+                    print(f"Loaded background removal model '{model_name}' "
+                          f"({self.intra_op_threads} threads) in {time.perf_counter() - started:.2f}s")
+        return session
+
+    def remove(self, data, model_name=None, **kwargs):
+        """``rembg.remove`` using this worker's persistent session."""
+        return remove(data, session=self.get(model_name), **kwargs)
+
+    def masks(self, images, model_name=None):
+        """Foreground masks ('L' images sized like each input) for a list of PIL images.
+
+        U2Net-family models whose batch dimension is dynamic run the whole list as one
+        inference call; any other model falls back to one ``remove`` call per image.
+        """
+        session = self.get(model_name)
+        if len(images) < 2 or not self._batchable(session):
+            return [self.remove(image, model_name, only_mask=True) for image in images]
+
+        feeds = [session.normalize(image, U2NET_MEAN, U2NET_STD, U2NET_SIZE) for image in images]
+        input_name = next(iter(feeds[0]))
+        batch = np.concatenate([feed[input_name] for feed in feeds])
+        preds = session.inner_session.run(None, {input_name: batch})[0][:, 0, :, :]
+        masks = []
+        for image, pred in zip(images, preds):
+            pred = (pred - np.min(pred)) / (np.max(pred) - np.min(pred))
+            mask = Image.fromarray((pred.clip(0, 1) * 255).astype("uint8"), mode="L")
+            masks.append(mask.resize(image.size, Image.Resampling.LANCZOS))
+        return masks
+
+    def warm_up(self, model_name=None):
+        """Load the model and run one tiny inference. Safe to call from a post-fork hook."""
+        try:
+            buffer = BytesIO()
+            Image.new('RGB', (64, 64), (255, 255, 255)).save(buffer, format='PNG')
+            self.remove(buffer.getvalue(), model_name)
+            return True
+        except Exception as e:
+            print(f"[WARNING] Background removal warm-up failed: {e}")
+            return False
+
+    @staticmethod
+    def _batchable(session):
+        if type(session).__name__ not in BATCHABLE_SESSIONS:
+            return False
+        batch_dim = session.inner_session.get_inputs()[0].shape[0]
+        return not isinstance(batch_dim, int)
+
+    def _create(self, model_name):
+        if 'sess_opts' in inspect.signature(new_session).parameters:
+            import onnxruntime as ort
+            sess_opts = ort.SessionOptions()
+            sess_opts.intra_op_num_threads = self.intra_op_threads
+            sess_opts.inter_op_num_threads = 1
+            return new_session(model_name, sess_opts=sess_opts)
+        # Older rembg builds its SessionOptions from OMP_NUM_THREADS
+        previous = os.environ.get('OMP_NUM_THREADS')
+        os.environ['OMP_NUM_THREADS'] = str(self.intra_op_threads)
+        try:
+            return new_session(model_name)
+        finally:
+            if previous is None:
+                os.environ.pop('OMP_NUM_THREADS', None)
+            else:
+                os.environ['OMP_NUM_THREADS'] = previous
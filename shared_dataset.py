@@ -0,0 +1,162 @@
+"""Publish the rule indexes as memory-mapped arrays shared by every API worker on a node.
+
+One process parses the sheet and writes a *generation*: a directory holding the
+posting lists and the integer-coded candidate store as ``.npy`` files, plus a small
+pickle of the vocabularies. Workers map the arrays read-only, so the page cache keeps
+a single copy however many workers attach, and no worker holds the pandas frame.
+A generation is only announced once complete, by atomically replacing the CURRENT
+file, so readers always see a whole generation. Publish ahead of a deploy with:
+
+    python shared_dataset.py [dataset.xlsx] [shared-dir]
+
+Point the shared directory at a tmpfs such as /dev/shm to keep it off disk.
+"""
+import os
+import pickle
+import shutil
+import sys
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from dataset_loader import load_dataset, source_stamp
+from rule_engine import CandidateStore, RuleIndex
+
+if os.name != 'nt':
+    import fcntl
+
+# Bump whenever the exported layout changes so old generations are rebuilt.
+SHARED_FORMAT = 1
+CURRENT_FILE = 'CURRENT'
+META_FILE = 'meta.pkl'
+# Generations kept besides the current one; attached workers keep theirs mapped even after deletion.
+KEEP_GENERATIONS = 2
+
+
+class SharedDataset:
+    """Indexes attached from a published generation; there is no ``rule_data`` frame."""
+
+    rule_data = None
+
+    def __init__(self, generation, source, rule_index, candidate_store):
+        self.generation = generation
+        self.source = source
+        self.rule_index = rule_index
+        self.candidate_store = candidate_store
+
+    @property
+    def num_rows(self):
+        return self.candidate_store.num_rows
+
+    @property
+    def empty(self):
+        return self.num_rows == 0
+
+
+# --- Publishing ---
+def publish(dataset, root, source=None):
+    """Write ``dataset``'s indexes as a new generation under ``root`` and make it current."""
+    index_arrays, index_meta = dataset.rule_index.export()
+    store_arrays, store_meta = dataset.candidate_store.export()
+    generation = f"gen-{time.time_ns():x}-{os.getpid()}"
+    tmp_dir = os.path.join(root, f".{generation}.tmp")
+    os.makedirs(tmp_dir)
+    arrays = {**{f"index.{k}": v for k, v in index_arrays.items()}, **{f"store.{k}": v for k, v in store_arrays.items()}}
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), np.ascontiguousarray(array))
+    meta = {"format": SHARED_FORMAT, "source": source, "arrays": sorted(arrays),
+            "index": index_meta, "store": store_meta}
+    with open(os.path.join(tmp_dir, META_FILE), 'wb') as f:
+        pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_dir, os.path.join(root, generation))
+
+    pointer = os.path.join(root, f"{CURRENT_FILE}.{os.getpid()}.tmp")
+    with open(pointer, 'w') as f:
+        f.write(generation)
+    os.replace(pointer, os.path.join(root, CURRENT_FILE))
+    _prune(root, generation)
+    return generation
+
+
+def _prune(root, current):
+    generations = sorted(name for name in os.listdir(root) if name.startswith('gen-') and name != current)
+    for name in generations[:max(0, len(generations) - KEEP_GENERATIONS)]:
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+
+@contextmanager
+def publish_lock(root):
+    """Exclusive lock serializing publishers of ``root`` (no-op on Windows)."""
+    with open(os.path.join(root, '.lock'), 'w') as lock:
+        if os.name != 'nt':
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+# --- Attaching ---
+def current_generation(root):
+    try:
+        with open(os.path.join(root, CURRENT_FILE)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def attach(root, generation=None):
+    """Map a generation (the current one by default) read-only, or return None if there is none."""
+    generation = generation or current_generation(root)
+    if generation is None:
+        return None
+    directory = os.path.join(root, generation)
+    with open(os.path.join(directory, META_FILE), 'rb') as f:
+        meta = pickle.load(f)
+    if meta.get("format") != SHARED_FORMAT:
+        return None
+    arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r').view(np.ndarray)
+              for name in meta["arrays"]}
+    index_arrays = {name[len('index.'):]: a for name, a in arrays.items() if name.startswith('index.')}
+    store_arrays = {name[len('store.'):]: a for name, a in arrays.items() if name.startswith('store.')}
+    return SharedDataset(generation, meta["source"], RuleIndex.from_export(index_arrays, meta["index"]),
+                         CandidateStore.from_export(store_arrays, meta["store"]))
+
+
+def load_shared(file_path, root, force=False):
+    """Attach the generation built from the current ``file_path``, publishing it first if needed.
+
+    Workers starting together serialize on a lock file, so only the first one parses
+    the sheet; the others attach what it published. ``force`` publishes a fresh
+    generation even if the current one matches the sheet.
+    """
+    os.makedirs(root, exist_ok=True)
+    source = source_stamp(file_path) if os.path.exists(file_path) else None
+    dataset = None if force else attach(root)
+    if dataset is not None and dataset.source == source:
+        print(f"Attached shared dataset {dataset.generation} with {dataset.num_rows} rows.")
+        return dataset
+    with publish_lock(root):
+        dataset = None if force else attach(root)
+        if dataset is None or dataset.source != source:
+            built = load_dataset(file_path)
+            if built.empty:
+                return built
+            publish(built, root, built.source)
+            dataset = attach(root)
+    print(f"Attached shared dataset {dataset.generation} with {dataset.num_rows} rows.")
+    return dataset
+
+
+def main(argv):
+    source = argv[0] if argv else 'dataset.xlsx'
+    root = argv[1] if len(argv) > 1 else os.environ.get('DATASET_SHARED_DIR', '/dev/shm/groomify-dataset')
+    built = load_dataset(source)
+    if built.empty:
+        sys.exit(f"Nothing to publish: '{source}' produced an empty dataset.")
+    os.makedirs(root, exist_ok=True)
+    with publish_lock(root):
+        generation = publish(built, root, built.source)
+    print(f"Published {generation} to {root} ({built.num_rows} rows).")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
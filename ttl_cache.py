@@ -0,0 +1,72 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+# --- LRU/TTL Cache ---
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire ``ttl`` seconds after insertion."""
+
+    def __init__(self, maxsize=512, ttl=300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and (self.ttl is None or time.monotonic() - entry[0] < self.ttl):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def update(self, key, func):
+        """Replace a live entry with ``func(value)``, keeping its insertion time so it still expires on schedule."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and (self.ttl is None or time.monotonic() - entry[0] < self.ttl):
+                self._data[key] = (entry[0], func(entry[1]))
+
+    def get_or_create(self, key, factory):
+        """Return the cached value for ``key``, building it with ``factory()`` on a miss."""
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            # Built outside the lock; a concurrent miss may build it twice, which is harmless
+            value = factory()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
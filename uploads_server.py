@@ -0,0 +1,111 @@
+import os
+import tempfile
+from io import BytesIO
+from urllib.parse import quote
+
+from flask import abort, send_from_directory
+from PIL import Image, ImageOps
+from werkzeug.security import safe_join
+
+# Longest edge, in pixels, of the WebP thumbnails kept next to every upload.
+THUMBNAIL_SIZES = {'sm': 128, 'md': 320, 'lg': 640}
+ORIGINAL_SIZE = 'original'
+THUMBNAIL_DIR = '.thumbnails'
+
+# URLs carrying a version are immutable; unversioned ones are revalidated after UPLOADS_MAX_AGE.
+VERSIONED_MAX_AGE = 365 * 24 * 3600
+UPLOADS_MAX_AGE = int(os.environ.get('UPLOADS_MAX_AGE', '3600'))
+
+
+def thumbnail_name(filename, size):
+    return f"{THUMBNAIL_DIR}/{size}/{filename}.webp"
+
+
+# --- Thumbnail Generation ---
+def make_thumbnails(directory, filename, data=None, sizes=THUMBNAIL_SIZES):
+    """Write a WebP thumbnail of ``directory/filename`` for each of ``sizes``.
+
+    ``data`` is the upload's bytes when the caller already has them in memory.
+    Each file is written to a unique temp file and renamed, so readers never see a
+    partial one and concurrent writers of the same thumbnail never share a temp file.
+    """
+    image = Image.open(BytesIO(data) if data is not None else os.path.join(directory, filename))
+    longest = max(THUMBNAIL_SIZES[size] for size in sizes)
+    image.draft('RGB', (longest, longest))
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+    for size in sorted(sizes, key=THUMBNAIL_SIZES.get, reverse=True):
+        image.thumbnail((THUMBNAIL_SIZES[size], THUMBNAIL_SIZES[size]), Image.Resampling.LANCZOS)
+        path = os.path.join(directory, thumbnail_name(filename, size))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                image.save(f, format='WEBP', quality=80, method=4)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+def ensure_thumbnail(directory, filename, size):
+    """Relative path of an up-to-date thumbnail, generating it if missing or older than the upload."""
+    name = thumbnail_name(filename, size)
+    source = os.stat(os.path.join(directory, filename))
+    try:
+        if os.stat(os.path.join(directory, name)).st_mtime_ns >= source.st_mtime_ns:
+            return name
+    except FileNotFoundError:
+        pass
+    make_thumbnails(directory, filename, sizes=(size,))
+    return name
+
+
+# --- URLs and Serving ---
+def upload_version(directory, filename, mtime_ns=None):
+    """Short token that changes whenever the upload is rewritten (its mtime)."""
+    if mtime_ns is None:
+        try:
+            mtime_ns = os.stat(os.path.join(directory, filename)).st_mtime_ns
+        except OSError:
+            return None
+    return format(mtime_ns, 'x')
+
+
+def upload_url(directory, filename, size=ORIGINAL_SIZE, mtime_ns=None):
+    """``/uploads/`` URL of ``filename`` at ``size``, versioned so clients may cache it for good.
+
+    Pass ``mtime_ns`` when it is already known (e.g. from an ``UploadsIndex``) to skip the stat.
+    """
+    params = []
+    if size in THUMBNAIL_SIZES:
+        params.append(f"size={size}")
+    version = upload_version(directory, filename, mtime_ns)
+    if version:
+        params.append(f"v={version}")
+    url = f"/uploads/{quote(filename)}"
+    return f"{url}?{'&'.join(params)}" if params else url
+
+
+def send_upload(directory, filename, size=None, versioned=False):
+    """Serve an upload or one of its thumbnails with ETag/Last-Modified, conditional GET and Range support."""
+    directory = os.path.abspath(directory)
+    source = safe_join(directory, filename)
+    if source is None or THUMBNAIL_DIR in filename.split('/') or not os.path.isfile(source):
+        abort(404)
+    path = filename
+    if size and size != ORIGINAL_SIZE:
+        if size not in THUMBNAIL_SIZES:
+            abort(400, description=f"size must be one of {', '.join([ORIGINAL_SIZE, *THUMBNAIL_SIZES])}")
+        try:
+            path = ensure_thumbnail(directory, filename, size)
+        except (OSError, Image.DecompressionBombError) as e:
+            # Not something PIL can thumbnail; fall back to the original
+            print(f"[WARNING] Could not thumbnail upload '{filename}': {e}")
+    response = send_from_directory(directory, path, conditional=True, etag=True,
+                                   max_age=VERSIONED_MAX_AGE if versioned else UPLOADS_MAX_AGE)
+    response.cache_control.public = True
+    if versioned:
+        response.cache_control.immutable = True
+    return response
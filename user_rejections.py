@@ -0,0 +1,154 @@
+"""Per-user rejected outfits, kept compact on disk with only the active users in memory.
+
+Outfits are interned to 63-bit integer ids by hashing their seven attributes, so
+every worker derives the same id without a shared table. Each user's rejections are
+rows of one SQLite table clustered on (user_id, outfit_id); a worker loads a user's
+ids as one sorted int64 array the first time it serves them and keeps the most
+recently used users in an LRU. Membership is a hash plus a binary search over that
+user's own ids, however many users and rejections the store holds.
+
+Rejections recorded by other workers reach a cached user when the entry expires
+(USER_REJECTIONS_TTL); a worker's own writes show up immediately, including for a
+user it loads from disk before the background insert has landed.
+"""
+import hashlib
+import sqlite3
+import threading
+from array import array
+from bisect import bisect_left
+
+from ttl_cache import TTLCache
+
+ID_MASK = (1 << 63) - 1
+NO_IDS = array('q')
+
+
+def outfit_id(outfit):
+    """Stable id of an outfit tuple; positive, so it fits a SQLite INTEGER."""
+    digest = hashlib.blake2b('\x1f'.join(map(str, outfit)).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') & ID_MASK
+
+
+class UserRejections:
+    """Read-only view of one user's rejections, usable wherever a rejection set is expected.
+
+    Outfits in ``shared`` (feedback recorded without a user) count as rejected too.
+    """
+
+    def __init__(self, ids=NO_IDS, shared=frozenset()):
+        self.ids = ids
+        self.shared = shared
+
+    def __contains__(self, outfit):
+        outfit = tuple(outfit)
+        if outfit in self.shared:
+            return True
+        if not self.ids:
+            return False
+        key = outfit_id(outfit)
+        i = bisect_left(self.ids, key)
+        return i < len(self.ids) and self.ids[i] == key
+
+    def __len__(self):
+        return len(self.ids) + len(self.shared)
+
+
+class UserRejectionStore:
+    """SQLite-backed rejection ids per user with an LRU/TTL cache of hot users.
+
+    ``write()`` follows the feedback sink interface, so inserts can run on a
+    ``BufferedWriter`` thread while ``record()`` updates this worker's cache at once.
+    Recorded ids stay in a pending overlay until their insert commits, so a user
+    loaded from disk in between still gets them.
+    """
+
+    def __init__(self, db_path, max_users=10000, ttl=5.0):
+        self.db_path = db_path
+        self.cache = TTLCache(maxsize=max_users, ttl=ttl)
+        self._local = threading.local()
+        self._write_conn = None
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute("CREATE TABLE IF NOT EXISTS user_rejections "
+                     "(user_id TEXT NOT NULL, outfit_id INTEGER NOT NULL, PRIMARY KEY (user_id, outfit_id)) WITHOUT ROWID")
+        return conn
+
+    def _reader(self):
+        # One connection per request thread; SQLite connections are not shared
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def load(self, user_id):
+        """Sorted outfit ids rejected by ``user_id``: those on disk plus any not yet written."""
+        rows = self._reader().execute("SELECT outfit_id FROM user_rejections WHERE user_id = ? ORDER BY outfit_id",
+                                      (user_id,)).fetchall()
+        with self._pending_lock:
+            pending = self._pending.get(user_id)
+            if pending:
+                return array('q', sorted(pending.union(row[0] for row in rows)))
+        return array('q', [row[0] for row in rows]) if rows else NO_IDS
+
+    def ids(self, user_id):
+        return self.cache.get_or_create(user_id, lambda: self.load(user_id))
+
+    def for_user(self, user_id, shared=frozenset()):
+        """Rejection view for ``user_id``; with no user only ``shared`` applies."""
+        if not user_id:
+            return UserRejections(shared=shared)
+        return UserRejections(self.ids(user_id), shared)
+
+    def record(self, user_id, outfits):
+        """Add rejections to this worker's cached copy. Returns the (user_id, outfit_id) rows to ``write()``."""
+        new_ids = {outfit_id(outfit) for outfit in outfits}
+        with self._pending_lock:
+            self._pending.setdefault(user_id, set()).update(new_ids)
+        self._merge(user_id, new_ids)
+        return [(user_id, i) for i in sorted(new_ids)]
+
+    def cancel(self, rows):
+        """Forget pending rows that will never reach ``write()`` (e.g. the writer's queue was full)."""
+        self._settle(rows)
+
+    def write(self, target, fieldnames, rows):
+        """Insert (user_id, outfit_id) rows; ``target`` and ``fieldnames`` are unused. Writer thread only."""
+        if self._write_conn is None:
+            self._write_conn = self._connect()
+        with self._write_conn:
+            self._write_conn.executemany("INSERT OR IGNORE INTO user_rejections (user_id, outfit_id) VALUES (?, ?)",
+                                         rows)
+        # An entry loaded while these were pending may have missed them; it must not after they leave the overlay
+        for user_id, ids in self._settle(rows).items():
+            self._merge(user_id, ids)
+
+    def _merge(self, user_id, ids):
+        def merged(cached):
+            if ids.issubset(cached):
+                return cached
+            # A new array, so views handed to running requests never change under them
+            return array('q', sorted(ids.union(cached)))
+        # Keeps the entry's load time, or an active user would never see other workers' rejections
+        self.cache.update(user_id, merged)
+
+    def _settle(self, rows):
+        """Drop ``rows`` from the pending overlay. Returns their ids by user."""
+        by_user = {}
+        for user_id, i in rows:
+            by_user.setdefault(user_id, set()).add(i)
+        with self._pending_lock:
+            for user_id, ids in by_user.items():
+                pending = self._pending.get(user_id)
+                if pending is not None:
+                    pending -= ids
+                    if not pending:
+                        del self._pending[user_id]
+        return by_user
+
+    def stats(self):
+        return self.cache.stats()